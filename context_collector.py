@@ -108,11 +108,9 @@ def _should_ignore(path: str, root_dir: str) -> bool:
 
 # --- ГЛАВНАЯ ПУБЛИЧНАЯ ФУНКЦИЯ (С ИЗМЕНЕНИЯМИ) ---
 
-def gather_project_context(root_dir, mode='full', full_content_files=None, top_n_files=3):
-    # ... (начало функции без изменений)
-    if full_content_files is None: full_content_files = set()
-    else: full_content_files = {os.path.normpath(os.path.join(root_dir, f)) for f in full_content_files}
-    all_lines, file_sizes, file_paths_to_include = [], {}, []
+def _collect_context_files(root_dir, verbose=True):
+    """Обходит проект по правилам фильтрации. Возвращает (file_paths_to_include, file_sizes)."""
+    file_sizes, file_paths_to_include = {}, []
 
     for dirpath, dirnames, filenames in os.walk(root_dir, topdown=True):
         
@@ -141,11 +139,12 @@ def gather_project_context(root_dir, mode='full', full_content_files=None, top_n
 
                 # 3. Сообщаем, только если пропускаем ОГРОМНЫЙ ТЕКСТОВЫЙ файл
                 if file_size > MAX_FILE_SIZE_CHARS:
-                    print(f"{Colors.WARNING}ЛОГ: Пропускаю слишком большой ТЕКСТОВЫЙ файл ({file_size} байт): {os.path.relpath(filepath, root_dir)}{Colors.ENDC}")
+                    if verbose:
+                        print(f"{Colors.WARNING}ЛОГ: Пропускаю слишком большой ТЕКСТОВЫЙ файл ({file_size} байт): {os.path.relpath(filepath, root_dir)}{Colors.ENDC}")
                     continue
                 
                 # 4. Предупреждение о рефакторинге для включенных файлов — полезно, оставляем
-                if file_size > LARGE_FILE_THRESHOLD_CHARS:
+                if file_size > LARGE_FILE_THRESHOLD_CHARS and verbose:
                     print(f"{Colors.WARNING}ПРЕДУПРЕЖДЕНИЕ: Обнаружен большой файл ({file_size} байт): {os.path.relpath(filepath, root_dir)}. Возможно, требуется рефакторинг.{Colors.ENDC}")
 
             except OSError:
@@ -156,6 +155,60 @@ def gather_project_context(root_dir, mode='full', full_content_files=None, top_n
                 file_sizes[filepath] = len(content)
                 file_paths_to_include.append(filepath)
 
+    return file_paths_to_include, file_sizes
+
+def list_context_files(root_dir):
+    """Относительные пути файлов, которые попадают в контекст проекта."""
+    paths, _ = _collect_context_files(root_dir, verbose=False)
+    return [os.path.relpath(p, root_dir) for p in paths]
+
+def estimate_outline_savings(root_dir, rel_paths):
+    """
+    Для каждого файла оценивает, сколько токенов сэкономит замена полного содержимого
+    на outline (_summarize_content). Возвращает {rel_path: saved_tokens}.
+    """
+    savings = {}
+    for rel_path in rel_paths:
+        filepath = os.path.join(root_dir, rel_path)
+        content = _get_file_content(filepath)
+        if content is None:
+            continue
+        saved = _estimate_tokens(content) - _estimate_tokens(_summarize_content(content, filepath))
+        if saved > 0:
+            savings[rel_path] = saved
+    return savings
+
+def format_files(root_dir, rel_paths):
+    """
+    Текущее содержимое указанных файлов в том же формате, что и в контексте проекта
+    (для дельт сессии: только изменённые файлы). Удалённые и бинарные файлы помечаются.
+    """
+    lines = []
+    for rel_path in sorted(set(rel_paths)):
+        path = os.path.join(root_dir, rel_path)
+        lines.append(f"\nФайл: {rel_path}\n{'-' * len('Файл: ' + rel_path)}")
+        if not os.path.exists(path):
+            lines.append("Файл удалён.")
+        elif os.path.isdir(path) or _is_binary_file(path):
+            lines.append("Директория или бинарный файл — содержимое не выводится.")
+        else:
+            content = _get_file_content(path)
+            lines.append(content if content is not None else "Не удалось прочитать содержимое файла.")
+    return "\n".join(lines)
+
+def gather_project_context(root_dir, mode='full', full_content_files=None, top_n_files=3, outline_files=None):
+    """
+    Собирает контекст проекта: дерево файлов и содержимое.
+    mode='full' — все файлы целиком; иначе целиком только full_content_files, остальные — outline.
+    outline_files — файлы, которые выводятся как outline в ЛЮБОМ режиме (понижение приоритета,
+    например при превышении границы тарифа по токенам).
+    """
+    if full_content_files is None: full_content_files = set()
+    else: full_content_files = {os.path.normpath(os.path.join(root_dir, f)) for f in full_content_files}
+    outline_files = {os.path.normpath(os.path.join(root_dir, f)) for f in (outline_files or [])}
+    all_lines = []
+    file_paths_to_include, file_sizes = _collect_context_files(root_dir)
+
     # ... (вся остальная часть функции для генерации дерева и контента остается без изменений) ...
     sorted_by_size = sorted(file_sizes.items(), key=lambda item: item[1], reverse=True)
     top_files_set = {filepath for filepath, size in sorted_by_size[:top_n_files]}
@@ -191,7 +244,9 @@ def gather_project_context(root_dir, mode='full', full_content_files=None, top_n
             all_lines.append("Не удалось прочитать содержимое файла.")
             continue
         norm_path = os.path.normpath(path)
-        if mode == 'full' or norm_path in full_content_files:
+        if norm_path in outline_files:
+            all_lines.append(_summarize_content(content, path))
+        elif mode == 'full' or norm_path in full_content_files:
             all_lines.append(content)
         else:
             all_lines.append(_summarize_content(content, path))
@@ -0,0 +1,812 @@
+# Файл: sloth_backends.py
+"""
+Подключаемые бэкенды модели для Sloth.
+
+Протокол ModelBackend:
+- generate(prompt, model_name, options) → {"text", "input_tokens", "output_tokens", "cached_tokens",
+                                           "thinking_tokens", "ttft"}
+- stream(prompt, model_name, options)   → итератор текстовых кусков ответа
+- count_tokens(prompt, model_name)      → число входных токенов
+- usage()                               → накопленная статистика {requests, input_tokens, output_tokens,
+                                           cached_tokens, thinking_tokens}
+
+prompt — строка либо Conversation (тоже строка, плюс turns — ходы чата с ролями
+"user"/"model"); Conversation отправляется как многоходовый диалог (режим сессии).
+
+input_tokens включает cached_tokens (кэшированная часть промпта тарифицируется со скидкой);
+thinking_tokens (размышления) не входят в output_tokens, но тарифицируются как выход.
+
+options — словарь генерационных параметров: temperature, top_p, top_k,
+thinking_budget, timeout_seconds, stream, response_mime_type, response_schema.
+Неизвестные бэкенду ключи игнорируются. Структурированный вывод (JSON по схеме)
+передаётся только бэкендам с supports_structured_output = True.
+
+Адаптеры:
+- GenAIBackend   — новый google-genai (thinking_config доступен)
+- LegacyBackend  — старый google.generativeai (thinking недоступен)
+- VertexBackend  — vertexai (thinking_config доступен)
+- LocalHTTPBackend — локальный сервер модели с OpenAI- или Gemini-совместимым HTTP API,
+  пул keep-alive соединений (http.client), без внешних зависимостей.
+
+SDK импортируются лениво — только при создании соответствующего адаптера.
+
+Потоковый режим (options["stream"], по умолчанию api.stream): generate() собирает ответ
+из _stream() и засекает время до первого куска текста — ttft в результате. Без потока
+(или у бэкенда без _stream) ttft — None. _stream() отдаёт куски текста, а usage
+возвращает значением генератора (return), его учитывает вызывающий.
+
+Дедлайны: timeout_seconds из options превращается в Deadline на весь вызов generate().
+Где SDK это умеет, остаток дедлайна передаётся как HTTP-таймаут (GenAI http_options,
+Legacy request_options, сокет локального бэкенда). Поверх этого вызов идёт в daemon-потоке,
+и ожидающий поток сам прекращает ждать по истечении дедлайна (DeadlineExceeded) или по
+Ctrl+C — бэкенд при этом получает cancel_inflight() (локальный закрывает соединения).
+Deadline можно отменить и извне (deadline.cancel(), так sloth_core снимает проигравший
+хедж-запрос): generate() сразу завершается DeadlineExceeded.
+"""
+
+import http.client
+import importlib.util
+import inspect
+import json
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Iterator, Optional
+
+
+def _sdk_available(module_name: str) -> bool:
+    try:
+        return importlib.util.find_spec(module_name) is not None
+    except Exception:
+        return False
+
+# Наличие пакетов проверяем без импорта
+HAS_GOOGLE_GENAI = _sdk_available("google.genai")
+HAS_LEGACY_GENAI = _sdk_available("google.generativeai")
+HAS_VERTEX_AI = _sdk_available("vertexai")
+
+
+_STRUCTURED_KEYS = ("response_mime_type", "response_schema")
+
+
+# --- Дедлайны и отмена ---
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """Абсолютный срок запроса (monotonic) с кооперативной отменой."""
+
+    def __init__(self, seconds: Optional[float]):
+        self.seconds = float(seconds) if seconds else None
+        self.expires_at = time.monotonic() + self.seconds if self.seconds else None
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise DeadlineExceeded("Запрос отменён.")
+        if self.expired():
+            raise DeadlineExceeded(f"Превышен дедлайн запроса ({self.seconds:.0f} сек.).")
+
+
+def run_with_deadline(fn: Callable[[], Any], deadline: Deadline, on_cancel: Optional[Callable[[], None]] = None):
+    """Выполняет fn в daemon-потоке и ждёт не дольше дедлайна.
+
+    По истечении дедлайна — DeadlineExceeded, по Ctrl+C — KeyboardInterrupt дальше;
+    в обоих случаях дедлайн помечается отменённым и вызывается on_cancel().
+    Отмена дедлайна извне (deadline.cancel()) тоже прекращает ожидание с DeadlineExceeded,
+    но on_cancel() не вызывается: прервать транспорт — забота того, кто отменил.
+    """
+    if deadline.expires_at is None:
+        return fn()
+    future: Future = Future()
+
+    def _run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_run, daemon=True, name="sloth-request").start()
+    try:
+        while True:
+            # Короткие ожидания, чтобы Ctrl+C обрабатывался сразу
+            try:
+                return future.result(timeout=min(0.5, deadline.remaining() or 0.0) or 0.01)
+            except FutureTimeoutError:
+                if deadline.cancelled:
+                    raise DeadlineExceeded("Запрос отменён.") from None
+                if deadline.expired():
+                    raise DeadlineExceeded(f"Превышен дедлайн запроса ({deadline.seconds:.0f} сек.).")
+    except (DeadlineExceeded, KeyboardInterrupt):
+        if deadline.cancelled and not deadline.expired():
+            raise
+        deadline.cancel()
+        if on_cancel is not None:
+            try:
+                on_cancel()
+            except Exception:
+                pass
+        raise
+
+
+class Conversation(str):
+    """Многоходовый промпт сессии. Строковое значение — весь текст диалога (для оценок,
+    хэшей и логов), turns — ((role, text), ...), role ∈ {"user", "model"}."""
+
+    def __new__(cls, turns):
+        # Тексты храним как есть: PromptText последнего хода сохраняет секции для профилировщика
+        turns = tuple((role, text) for role, text in turns)
+        obj = super().__new__(cls, "\n\n".join(str(text) for _, text in turns))
+        obj.turns = turns
+        return obj
+
+
+def _google_contents(prompt_text):
+    """contents для Google SDK: строка как есть, Conversation — список ходов."""
+    turns = getattr(prompt_text, "turns", None)
+    if not turns:
+        return prompt_text
+    return [{"role": role, "parts": [{"text": str(text)}]} for role, text in turns]
+
+
+def _accepts_kwarg(cls, name: str) -> bool:
+    """Принимает ли конструктор типа параметр name (проверка возможностей установленной версии SDK)."""
+    if cls is None:
+        return False
+    fields = getattr(cls, "__dataclass_fields__", None) or getattr(cls, "__annotations__", None) or {}
+    if name in fields:
+        return True
+    try:
+        return name in inspect.signature(cls).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (≈ 4 символа на токен)."""
+    if not text:
+        return 0
+    return max(1, int(len(text) / 4))
+
+
+USAGE_KEYS = ("input_tokens", "output_tokens", "cached_tokens", "thinking_tokens")
+
+
+def _usage_from_metadata(um) -> Dict[str, int]:
+    usage = dict.fromkeys(USAGE_KEYS, 0)
+    try:
+        if um:
+            usage["input_tokens"] = getattr(um, "prompt_token_count", getattr(um, "input_tokens", 0)) or 0
+            usage["output_tokens"] = getattr(um, "candidates_token_count", getattr(um, "output_tokens", 0)) or 0
+            usage["cached_tokens"] = getattr(um, "cached_content_token_count", 0) or 0
+            usage["thinking_tokens"] = getattr(um, "thoughts_token_count", 0) or 0
+    except Exception:
+        pass
+    return usage
+
+
+def _usage_from_gemini_json(um: Dict[str, Any]) -> Dict[str, int]:
+    return {
+        "input_tokens": um.get("promptTokenCount", 0) or 0,
+        "output_tokens": um.get("candidatesTokenCount", 0) or 0,
+        "cached_tokens": um.get("cachedContentTokenCount", 0) or 0,
+        "thinking_tokens": um.get("thoughtsTokenCount", 0) or 0,
+    }
+
+
+def _usage_from_openai_json(usage: Dict[str, Any]) -> Dict[str, int]:
+    return {
+        "input_tokens": usage.get("prompt_tokens", 0) or 0,
+        "output_tokens": usage.get("completion_tokens", 0) or 0,
+        "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0,
+        "thinking_tokens": (usage.get("completion_tokens_details") or {}).get("reasoning_tokens", 0) or 0,
+    }
+
+
+def _text_from_response(resp) -> str:
+    # Пытаемся взять текст максимально надёжно
+    try:
+        text = getattr(resp, "text", None)
+    except Exception:
+        # Некоторые SDK бросают исключение из .text, если у кандидата нет текстовых частей
+        text = None
+    if text:
+        return text
+    parts_text = []
+    try:
+        parts = getattr(resp, "parts", None)
+        if parts:
+            for p in parts:
+                t = getattr(p, "text", None)
+                if t:
+                    parts_text.append(t)
+        else:
+            # google-genai иногда возвращает candidates
+            for c in getattr(resp, "candidates", None) or []:
+                ct = getattr(c, "content", None)
+                for p in (getattr(ct, "parts", None) or []) if ct else []:
+                    t = getattr(p, "text", None)
+                    if t:
+                        parts_text.append(t)
+    except Exception:
+        pass
+    return "".join(parts_text)
+
+
+class ModelBackend:
+    """Базовый класс бэкенда. Наследники реализуют _generate/_stream/count_tokens."""
+
+    service_name = "base"
+    supports_thinking = False
+    supports_structured_output = False
+    supports_streaming = False
+
+    def __init__(self, defaults: Optional[Dict[str, Any]] = None):
+        self.defaults: Dict[str, Any] = dict(defaults or {})
+        self._usage = {"requests": 0, **dict.fromkeys(USAGE_KEYS, 0)}
+        self._usage_lock = threading.Lock()
+
+    # --- протокол ---
+    def generate(self, prompt_text: str, model_name: str, options: Optional[Dict[str, Any]] = None,
+                 deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        options = self._options(options)
+        deadline = deadline or Deadline(options.get("timeout_seconds"))
+        deadline.check()
+        if deadline.remaining() is not None:
+            # HTTP-таймаут — остаток дедлайна, а не полный таймаут заново
+            options["timeout_seconds"] = max(1.0, deadline.remaining())
+        generate = self._generate_streamed if (options.get("stream") and self.supports_streaming) else self._generate
+        result = run_with_deadline(lambda: generate(prompt_text, model_name, options), deadline, self.cancel_inflight)
+        result.setdefault("ttft", None)
+        self._record_usage({k: result.get(k, 0) for k in USAGE_KEYS})
+        return result
+
+    def stream(self, prompt_text: str, model_name: str, options: Optional[Dict[str, Any]] = None,
+               deadline: Optional[Deadline] = None) -> Iterator[str]:
+        """Итератор кусков текста. Usage учитывается после исчерпания итератора.
+        Дедлайн проверяется между кусками (сами куски ограничены HTTP-таймаутом)."""
+        options = self._options(options)
+        deadline = deadline or Deadline(options.get("timeout_seconds"))
+        chunks = self._stream(prompt_text, model_name, options)
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration as stop:
+                self._record_usage(stop.value or {})
+                return
+            if deadline.cancelled or deadline.expired():
+                self.cancel_inflight()
+                deadline.check()
+            yield chunk
+
+    def cancel_inflight(self) -> None:
+        """Прервать запросы в полёте, если транспорт это позволяет (по умолчанию — нельзя)."""
+
+    def count_tokens(self, prompt_text: str, model_name: str) -> int:
+        return estimate_tokens(prompt_text)
+
+    def usage(self) -> Dict[str, int]:
+        with self._usage_lock:
+            return dict(self._usage)
+
+    def ping(self, model_name: str) -> None:
+        """Короткий пробный запрос (режим --check-backend)."""
+        options = self._options(None)
+        run_with_deadline(lambda: self._generate("ping", model_name, options),
+                          Deadline(options.get("timeout_seconds")), self.cancel_inflight)
+
+    # --- для наследников ---
+    def _generate(self, prompt_text: str, model_name: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def _stream(self, prompt_text: str, model_name: str, options: Dict[str, Any]) -> Iterator[str]:
+        # По умолчанию — один кусок из обычного _generate
+        result = self._generate(prompt_text, model_name, options)
+        yield result["text"]
+        return {k: result.get(k, 0) for k in USAGE_KEYS}
+
+    def _generate_streamed(self, prompt_text: str, model_name: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        """Как _generate, но через поток: ttft — секунды до первого непустого куска текста."""
+        started = time.monotonic()
+        ttft = None
+        parts = []
+        chunks = self._stream(prompt_text, model_name, options)
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration as stop:
+                usage = stop.value or {}
+                break
+            if chunk and ttft is None:
+                ttft = time.monotonic() - started
+            parts.append(chunk)
+        return {"text": "".join(parts), **{k: int(usage.get(k, 0) or 0) for k in USAGE_KEYS}, "ttft": ttft}
+
+    def _options(self, options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        merged = dict(self.defaults)
+        for k, v in (options or {}).items():
+            if v is not None:
+                merged[k] = v
+        return merged
+
+    def _record_usage(self, usage: Dict[str, int]) -> None:
+        with self._usage_lock:
+            self._usage["requests"] += 1
+            for k in USAGE_KEYS:
+                self._usage[k] += int(usage.get(k, 0) or 0)
+
+
+# --- Google GenAI SDK ---
+class GenAIBackend(ModelBackend):
+    service_name = "Google GenAI SDK"
+    supports_thinking = True
+    supports_structured_output = True
+    supports_streaming = True
+
+    def __init__(self, api_key: str, defaults: Optional[Dict[str, Any]] = None):
+        super().__init__(defaults)
+        from google import genai as genai_new
+        from google.genai.types import GenerateContentConfig, ThinkingConfig
+        try:
+            from google.genai.types import HttpOptions
+        except ImportError:
+            HttpOptions = None
+        self._types = (GenerateContentConfig, ThinkingConfig)
+        # HTTP-таймаут на запрос доступен в поздних версиях SDK (http_options в конфиге запроса)
+        self._HttpOptions = HttpOptions if _accepts_kwarg(GenerateContentConfig, "http_options") else None
+        self.client = genai_new.Client(api_key=api_key)
+
+    def _config(self, options: Dict[str, Any]):
+        GenerateContentConfig, ThinkingConfig = self._types
+        kwargs = {
+            "temperature": options.get("temperature"),
+            "top_p": options.get("top_p"),
+            "top_k": options.get("top_k"),
+            "response_mime_type": options.get("response_mime_type"),
+            "response_schema": options.get("response_schema"),
+            # критично: не задаём max_output_tokens
+        }
+        if options.get("thinking_budget") is not None:
+            kwargs["thinking_config"] = ThinkingConfig(thinking_budget=int(options["thinking_budget"]))
+        if options.get("timeout_seconds") and self._HttpOptions is not None:
+            # timeout в HttpOptions — в миллисекундах
+            kwargs["http_options"] = self._HttpOptions(timeout=int(float(options["timeout_seconds"]) * 1000))
+        return GenerateContentConfig(**{k: v for k, v in kwargs.items() if v is not None})
+
+    def _generate(self, prompt_text, model_name, options):
+        response = self.client.models.generate_content(
+            model=model_name,
+            contents=_google_contents(prompt_text),
+            config=self._config(options),
+        )
+        return {"text": _text_from_response(response), **_usage_from_metadata(getattr(response, "usage_metadata", None))}
+
+    def _stream(self, prompt_text, model_name, options):
+        last_um = None
+        for chunk in self.client.models.generate_content_stream(
+            model=model_name,
+            contents=_google_contents(prompt_text),
+            config=self._config(options),
+        ):
+            last_um = getattr(chunk, "usage_metadata", None) or last_um
+            text = _text_from_response(chunk)
+            if text:
+                yield text
+        return _usage_from_metadata(last_um)
+
+    def count_tokens(self, prompt_text, model_name):
+        resp = self.client.models.count_tokens(model=model_name, contents=_google_contents(prompt_text))
+        return int(getattr(resp, "total_tokens", 0) or 0)
+
+
+# --- Старый google.generativeai ---
+class LegacyBackend(ModelBackend):
+    service_name = "Google AI (Legacy SDK)"
+    supports_thinking = False
+    supports_streaming = True
+
+    _SAFETY = {
+        'HARM_CATEGORY_HARASSMENT': 'block_medium_and_above',
+        'HARM_CATEGORY_HATE_SPEECH': 'block_medium_and_above',
+        'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'block_medium_and_above',
+        'HARM_CATEGORY_DANGEROUS_CONTENT': 'block_none',
+    }
+
+    def __init__(self, api_key: str, defaults: Optional[Dict[str, Any]] = None):
+        super().__init__(defaults)
+        import google.generativeai as genai_legacy
+        genai_legacy.configure(api_key=api_key)
+        self._sdk = genai_legacy
+        self._models: Dict[str, Any] = {}
+        # response_schema появился в поздних версиях SDK; в старых неизвестный ключ конфига — ошибка
+        self.supports_structured_output = _accepts_kwarg(getattr(genai_legacy, "GenerationConfig", None), "response_schema")
+
+    def _model(self, model_name: str):
+        if model_name not in self._models:
+            self._models[model_name] = self._sdk.GenerativeModel(model_name=model_name, safety_settings=self._SAFETY)
+        return self._models[model_name]
+
+    def _generation_config(self, options):
+        # ВАЖНО: generation_config без max_output_tokens; thinking тут недоступен
+        keys = ("temperature", "top_p", "top_k") + (_STRUCTURED_KEYS if self.supports_structured_output else ())
+        return {k: options[k] for k in keys if options.get(k) is not None}
+
+    def _request_options(self, options):
+        return {"timeout": options["timeout_seconds"]} if options.get("timeout_seconds") else None
+
+    def _generate(self, prompt_text, model_name, options):
+        response = self._model(model_name).generate_content(
+            _google_contents(prompt_text),
+            generation_config=self._generation_config(options),
+            request_options=self._request_options(options),
+        )
+        text = _text_from_response(response) or str(response)
+        return {"text": text, **_usage_from_metadata(getattr(response, "usage_metadata", None))}
+
+    def _stream(self, prompt_text, model_name, options):
+        response = self._model(model_name).generate_content(
+            _google_contents(prompt_text),
+            generation_config=self._generation_config(options),
+            request_options=self._request_options(options),
+            stream=True,
+        )
+        last_um = None
+        for chunk in response:
+            last_um = getattr(chunk, "usage_metadata", None) or last_um
+            text = _text_from_response(chunk)
+            if text:
+                yield text
+        return _usage_from_metadata(last_um)
+
+    def count_tokens(self, prompt_text, model_name):
+        resp = self._model(model_name).count_tokens(_google_contents(prompt_text))
+        return int(getattr(resp, "total_tokens", 0) or 0)
+
+
+# --- Vertex AI SDK ---
+class VertexBackend(ModelBackend):
+    service_name = "Vertex AI"
+    supports_thinking = True
+    supports_streaming = True
+
+    def __init__(self, project: Optional[str], location: str, defaults: Optional[Dict[str, Any]] = None):
+        super().__init__(defaults)
+        import vertexai
+        from vertexai.generative_models import GenerativeModel, HarmCategory, HarmBlockThreshold
+        # Эти импорты могут отсутствовать в старых версиях пакета; обрабатываем мягко
+        try:
+            from vertexai.generative_models import GenerationConfig as VertexGenerationConfig  # тип конфигурации
+        except Exception:
+            VertexGenerationConfig = None
+        try:
+            from vertexai.generative_models import ThinkingConfig as VertexThinkingConfig     # thinking конфиг
+        except Exception:
+            VertexThinkingConfig = None
+        vertexai.init(project=project, location=location)
+        self._GenerativeModel = GenerativeModel
+        self._GenerationConfig = VertexGenerationConfig
+        self._ThinkingConfig = VertexThinkingConfig
+        self.supports_structured_output = _accepts_kwarg(VertexGenerationConfig, "response_schema")
+        self._safety = {
+            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+        }
+        self._models: Dict[str, Any] = {}
+
+    def _model(self, model_name: str):
+        if model_name not in self._models:
+            self._models[model_name] = self._GenerativeModel(model_name=model_name, safety_settings=self._safety)
+        return self._models[model_name]
+
+    def _generation_config(self, options):
+        # Собираем конфиг без max_output_tokens
+        keys = ("temperature", "top_p", "top_k") + (_STRUCTURED_KEYS if self.supports_structured_output else ())
+        conf = {k: options[k] for k in keys if options.get(k) is not None}
+        budget = options.get("thinking_budget")
+        # Добавим thinking_config, если класс доступен в установленной версии SDK
+        if budget is not None and self._ThinkingConfig is not None:
+            try:
+                return self._GenerationConfig(**conf, thinking_config=self._ThinkingConfig(thinking_budget=int(budget)))
+            except Exception:
+                # Если типизированный конфиг недоступен, передадим словарь (некоторые версии принимают dict)
+                conf["thinking_config"] = {"thinking_budget": int(budget)}
+        return conf
+
+    def _generate(self, prompt_text, model_name, options):
+        response = self._model(model_name).generate_content(_google_contents(prompt_text), generation_config=self._generation_config(options))
+        text = _text_from_response(response) or str(response)
+        return {"text": text, **_usage_from_metadata(getattr(response, "usage_metadata", None))}
+
+    def _stream(self, prompt_text, model_name, options):
+        last_um = None
+        for chunk in self._model(model_name).generate_content(
+            _google_contents(prompt_text), generation_config=self._generation_config(options), stream=True
+        ):
+            last_um = getattr(chunk, "usage_metadata", None) or last_um
+            text = _text_from_response(chunk)
+            if text:
+                yield text
+        return _usage_from_metadata(last_um)
+
+    def count_tokens(self, prompt_text, model_name):
+        resp = self._model(model_name).count_tokens(_google_contents(prompt_text))
+        return int(getattr(resp, "total_tokens", 0) or 0)
+
+
+# --- Локальный HTTP-сервер модели ---
+class LocalHTTPError(RuntimeError):
+    pass
+
+
+class LocalHTTPBackend(ModelBackend):
+    """
+    Бэкенд для локального сервера модели (llama.cpp, vLLM, Ollama, LM Studio и т.п.).
+
+    api="openai" — POST {url}/v1/chat/completions (SSE при stream)
+    api="gemini" — POST {url}/v1beta/models/{model}:generateContent / :streamGenerateContent / :countTokens
+
+    Соединения переиспользуются (keep-alive) через небольшой пул http.client-соединений.
+    """
+
+    service_name = "Local HTTP"
+    supports_thinking = False
+    supports_structured_output = True
+    supports_streaming = True
+
+    def __init__(self, url: str, api: str = "openai", model: Optional[str] = None, api_key: Optional[str] = None,
+                 pool_size: int = 4, defaults: Optional[Dict[str, Any]] = None):
+        super().__init__(defaults)
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ValueError(f"Некорректный URL локального бэкенда: '{url}'")
+        self.api = (api or "openai").lower()
+        if self.api not in ("openai", "gemini"):
+            raise ValueError(f"Неизвестный API локального бэкенда: '{api}' (ожидается openai или gemini)")
+        self.model = model
+        self.api_key = api_key
+        self._scheme = parsed.scheme
+        self._host = parsed.hostname
+        self._port = parsed.port
+        self._base_path = parsed.path.rstrip("/")
+        self._pool: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue(maxsize=max(1, int(pool_size)))
+        self._inflight = set()
+        self._inflight_lock = threading.Lock()
+
+    # --- пул соединений ---
+    def _new_connection(self, timeout):
+        cls = http.client.HTTPSConnection if self._scheme == "https" else http.client.HTTPConnection
+        return cls(self._host, self._port, timeout=timeout)
+
+    def _acquire(self, timeout):
+        try:
+            conn = self._pool.get_nowait()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+        except queue.Empty:
+            conn = self._new_connection(timeout)
+        with self._inflight_lock:
+            self._inflight.add(conn)
+        return conn
+
+    def _release(self, conn):
+        with self._inflight_lock:
+            self._inflight.discard(conn)
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _close(self, conn):
+        with self._inflight_lock:
+            self._inflight.discard(conn)
+        conn.close()
+
+    def cancel_inflight(self):
+        """Закрывает сокеты запросов в полёте: блокирующее чтение в рабочем потоке сразу завершится ошибкой."""
+        with self._inflight_lock:
+            conns, self._inflight = list(self._inflight), set()
+        for conn in conns:
+            try:
+                if conn.sock is not None:
+                    conn.sock.shutdown(2)
+            except OSError:
+                pass
+            conn.close()
+
+    def _headers(self):
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        if self.api_key:
+            if self.api == "openai":
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            else:
+                headers["x-goog-api-key"] = self.api_key
+        return headers
+
+    def _open(self, path: str, payload: Dict[str, Any], timeout):
+        """Отправляет POST и возвращает (conn, response). Одна повторная попытка на «протухшем» keep-alive."""
+        body = json.dumps(payload).encode("utf-8")
+        for attempt in range(2):
+            conn = self._acquire(timeout)
+            try:
+                conn.request("POST", self._base_path + path, body=body, headers=self._headers())
+                resp = conn.getresponse()
+                return conn, resp
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self._close(conn)
+                if attempt:
+                    raise
+            except Exception:
+                # Таймаут, отказ в соединении, SSL: соединение не вернётся в пул, сокет закрываем
+                self._close(conn)
+                raise
+        raise LocalHTTPError("Не удалось отправить запрос локальному бэкенду.")
+
+    def _post_json(self, path: str, payload: Dict[str, Any], timeout) -> Dict[str, Any]:
+        conn, resp = self._open(path, payload, timeout)
+        try:
+            raw = resp.read()
+        except Exception:
+            self._close(conn)
+            raise
+        if resp.status >= 400:
+            self._close(conn)
+            raise LocalHTTPError(f"HTTP {resp.status} от локального бэкенда: {raw[:500].decode('utf-8', 'replace')}")
+        if resp.will_close:
+            self._close(conn)
+        else:
+            self._release(conn)
+        return json.loads(raw.decode("utf-8") or "{}")
+
+    def _iter_sse(self, path: str, payload: Dict[str, Any], timeout) -> Iterator[Dict[str, Any]]:
+        conn, resp = self._open(path, payload, timeout)
+        if resp.status >= 400:
+            raw = resp.read()
+            self._close(conn)
+            raise LocalHTTPError(f"HTTP {resp.status} от локального бэкенда: {raw[:500].decode('utf-8', 'replace')}")
+        finished = False
+        try:
+            while True:
+                line = resp.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                yield json.loads(data.decode("utf-8"))
+            finished = True
+        finally:
+            if finished:
+                try:
+                    resp.read()  # дочитываем хвост, чтобы соединение можно было переиспользовать
+                except Exception:
+                    finished = False
+            # Недочитанный поток нельзя вернуть в пул
+            if finished and not resp.will_close:
+                self._release(conn)
+            else:
+                self._close(conn)
+
+    # --- протокол ---
+    def _model_name(self, model_name):
+        return self.model or model_name
+
+    @staticmethod
+    def _openai_messages(prompt_text):
+        turns = getattr(prompt_text, "turns", None) or (("user", prompt_text),)
+        return [{"role": "assistant" if role == "model" else "user", "content": str(text)} for role, text in turns]
+
+    @staticmethod
+    def _gemini_contents(prompt_text):
+        turns = getattr(prompt_text, "turns", None) or (("user", prompt_text),)
+        return [{"role": role, "parts": [{"text": str(text)}]} for role, text in turns]
+
+    def _openai_payload(self, prompt_text, model_name, options, stream):
+        payload = {
+            "model": self._model_name(model_name),
+            "messages": self._openai_messages(prompt_text),
+            "stream": stream,
+        }
+        for k in ("temperature", "top_p"):
+            if options.get(k) is not None:
+                payload[k] = options[k]
+        if options.get("response_mime_type") == "application/json":
+            # Схему OpenAI-совместимые серверы понимают по-разному; json_object поддерживается шире всего
+            payload["response_format"] = {"type": "json_object"}
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def _gemini_payload(self, prompt_text, options):
+        gen_conf = {}
+        for src, dst in (("temperature", "temperature"), ("top_p", "topP"), ("top_k", "topK")):
+            if options.get(src) is not None:
+                gen_conf[dst] = options[src]
+        if options.get("response_mime_type"):
+            gen_conf["responseMimeType"] = options["response_mime_type"]
+        if options.get("response_schema"):
+            gen_conf["responseSchema"] = options["response_schema"]
+        return {"contents": self._gemini_contents(prompt_text), "generationConfig": gen_conf}
+
+    @staticmethod
+    def _gemini_text(data):
+        parts = []
+        for c in data.get("candidates") or []:
+            for p in ((c.get("content") or {}).get("parts") or []):
+                if p.get("text"):
+                    parts.append(p["text"])
+        return "".join(parts)
+
+    def _generate(self, prompt_text, model_name, options):
+        timeout = options.get("timeout_seconds")
+        if self.api == "openai":
+            data = self._post_json("/v1/chat/completions", self._openai_payload(prompt_text, model_name, options, False), timeout)
+            choices = data.get("choices") or [{}]
+            text = ((choices[0].get("message") or {}).get("content")) or ""
+            return {"text": text, **_usage_from_openai_json(data.get("usage") or {})}
+        path = f"/v1beta/models/{urllib.parse.quote(self._model_name(model_name))}:generateContent"
+        data = self._post_json(path, self._gemini_payload(prompt_text, options), timeout)
+        return {"text": self._gemini_text(data), **_usage_from_gemini_json(data.get("usageMetadata") or {})}
+
+    def _stream(self, prompt_text, model_name, options):
+        timeout = options.get("timeout_seconds")
+        usage = dict.fromkeys(USAGE_KEYS, 0)
+        if self.api == "openai":
+            events = self._iter_sse("/v1/chat/completions", self._openai_payload(prompt_text, model_name, options, True), timeout)
+            for event in events:
+                if event.get("usage"):
+                    usage = _usage_from_openai_json(event["usage"])
+                for choice in event.get("choices") or []:
+                    text = (choice.get("delta") or {}).get("content")
+                    if text:
+                        yield text
+        else:
+            path = f"/v1beta/models/{urllib.parse.quote(self._model_name(model_name))}:streamGenerateContent?alt=sse"
+            for event in self._iter_sse(path, self._gemini_payload(prompt_text, options), timeout):
+                if event.get("usageMetadata"):
+                    usage = _usage_from_gemini_json(event["usageMetadata"])
+                text = self._gemini_text(event)
+                if text:
+                    yield text
+        return usage
+
+    def count_tokens(self, prompt_text, model_name):
+        if self.api == "gemini":
+            path = f"/v1beta/models/{urllib.parse.quote(self._model_name(model_name))}:countTokens"
+            data = self._post_json(path, {"contents": self._gemini_contents(prompt_text)},
+                                   self.defaults.get("timeout_seconds"))
+            return int(data.get("totalTokens", 0) or 0)
+        # В OpenAI-совместимом API нет стандартного эндпоинта подсчёта — локальная оценка
+        return estimate_tokens(prompt_text)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
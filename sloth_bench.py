@@ -0,0 +1,585 @@
+# Файл: sloth_bench.py
+"""
+Бенчмарки Sloth (запускаются вручную или в CI).
+
+Команды:
+  startup  — время холодного импорта CLI в стиле `python -X importtime`.
+             Печатает самые тяжёлые модули и завершается с кодом 1,
+             если медиана превысила порог (регрессия).
+
+  blocks   — потоковый разбор блоков ответа (sloth_blocks): фазз-корпус из
+             синтетических ответов с мутациями (обрезка, потерянные ``` и boundary,
+             CRLF, мусор) — без исключений, разбор кусками = разбор целиком;
+             и пропускная способность (МБ/с) на ответах в несколько МБ против
+             прежней регулярки.
+
+  hashing  — хэширование синтетического дерева (много маленьких файлов и несколько
+             больших): прежний последовательный get_file_hash против sloth_tree
+             (буфер/mmap, пул потоков, память хэшей по inode/mtime/size) и время take().
+
+  leaks    — скан утечек протокола перед verify на синтетическом проекте с большим
+             node_modules: прежний полный обход против sloth_leaks.LeakScanner
+             (первый полный скан с отсечением папок и скан только изменённых файлов).
+
+  edits    — выходные токены правки: write_file (файл целиком) против edit_file
+             (хунки SEARCH/REPLACE) на синтетических точечных изменениях реальных
+             файлов; проверяет, что правка применяется и даёт ожидаемый текст.
+             С --telemetry сравнивает фактические output_tokens на запрос фаз
+             исполнения до и после даты --since (telemetry.file, JSONL).
+
+Порог берётся из аргумента --threshold-ms, затем из sloth_config.json
+(bench.startup_threshold_ms), иначе 400 мс.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+from colors import Colors, Symbols
+import config as sloth_config
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Строка отчёта importtime: "import time:       123 |        456 | package.module"
+_IMPORTTIME_RE = re.compile(r"^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S.*)$")
+
+
+def _parse_importtime(stderr: str):
+    """Разбирает вывод -X importtime. Возвращает (total_us, [(cumulative_us, self_us, module)])."""
+    rows = []
+    total_us = 0
+    for line in stderr.splitlines():
+        m = _IMPORTTIME_RE.match(line)
+        if not m:
+            continue
+        self_us, cumulative_us = int(m.group(1)), int(m.group(2))
+        indent = len(m.group(3))
+        module = m.group(4).strip()
+        rows.append((cumulative_us, self_us, module))
+        # Верхний уровень (отступ в 1 пробел) — суммируем кумулятивное время
+        if indent <= 1:
+            total_us += cumulative_us
+    return total_us, rows
+
+
+def bench_startup(module: str = "sloth_cli", runs: int = 5, threshold_ms: float | None = None, top: int = 10) -> int:
+    if threshold_ms is None:
+        threshold_ms = float(sloth_config.get("bench.startup_threshold_ms", 400))
+
+    env = dict(os.environ)
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    totals_ms = []
+    heaviest = {}
+    for _ in range(max(1, runs)):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=BASE_DIR, capture_output=True, text=True, env=env,
+        )
+        if proc.returncode != 0:
+            print(f"{Colors.FAIL}{Symbols.CROSS} Импорт {module} завершился ошибкой:\n{proc.stderr[-2000:]}{Colors.ENDC}")
+            return 2
+        total_us, rows = _parse_importtime(proc.stderr)
+        totals_ms.append(total_us / 1000.0)
+        for cumulative_us, _self_us, name in rows:
+            heaviest[name] = max(heaviest.get(name, 0), cumulative_us)
+
+    median_ms = statistics.median(totals_ms)
+    print(f"{Colors.BOLD}{Colors.HEADER}--- STARTUP: import {module} ({len(totals_ms)} прогонов) ---{Colors.ENDC}")
+    print(f"  Медиана: {median_ms:.1f} мс | мин: {min(totals_ms):.1f} мс | макс: {max(totals_ms):.1f} мс | порог: {threshold_ms:.0f} мс")
+    print(f"  Самые тяжёлые модули (кумулятивно):")
+    for name, cumulative_us in sorted(heaviest.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+        print(f"    {cumulative_us / 1000.0:8.1f} мс  {name}")
+
+    if median_ms > threshold_ms:
+        print(f"{Colors.FAIL}{Symbols.CROSS} РЕГРЕССИЯ: старт {median_ms:.1f} мс > порога {threshold_ms:.0f} мс.{Colors.ENDC}")
+        return 1
+    print(f"{Colors.OKGREEN}{Symbols.CHECK} Время старта в пределах порога.{Colors.ENDC}")
+    return 0
+
+
+def _edit_block_for(lines, changed, context=2):
+    """Блок edit_file: по хунку SEARCH/REPLACE на каждую изменённую строку с context строками вокруг
+    (контекст расширяется, пока фрагмент не станет уникальным — как того требуют правила промпта)."""
+    import sloth_edits
+
+    text = "\n".join(lines)
+    hunks = []
+    for i, new_line in sorted(changed.items()):
+        for extra in range(0, 20):
+            lo, hi = max(0, i - context - extra), min(len(lines), i + context + extra + 1)
+            search = lines[lo:hi]
+            if text.count("\n".join(search)) == 1:
+                break
+        replace = [new_line if lo + k == i else l for k, l in enumerate(search)]
+        hunks.append((search, replace, i - lo))
+    # Файл с маркерами SEARCH/REPLACE в начале строк — правка в формате unified diff
+    markers = {sloth_edits.SEARCH_MARKER, sloth_edits.DIVIDER_MARKER, sloth_edits.REPLACE_MARKER}
+    if any(l.rstrip() in markers for search, _, _ in hunks for l in search):
+        return "\n".join(
+            "@@ @@\n" + "\n".join((f"-{l}\n+{replace[k]}" if k == at else f" {l}") for k, l in enumerate(search))
+            for search, replace, at in hunks
+        )
+    return "\n".join(
+        "<<<<<<< SEARCH\n" + "\n".join(search) + "\n=======\n" + "\n".join(replace) + "\n>>>>>>> REPLACE"
+        for search, replace, _ in hunks
+    )
+
+
+def bench_edits(paths=None, changes: int = 3, min_lines: int = 200, seed: int = 1,
+                telemetry: str | None = None, since: str | None = None) -> int:
+    import sloth_edits
+    from sloth_backends import estimate_tokens
+
+    files = []
+    for pattern in paths or [os.path.join(BASE_DIR, "*.py")]:
+        files.extend(sorted(glob.glob(pattern)))
+    rng = random.Random(seed)
+    rows, failures = [], 0
+    for path in files:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                original = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+        lines = original.split("\n")
+        candidates = [i for i, l in enumerate(lines) if l.strip()]
+        if len(lines) < min_lines or len(candidates) < changes:
+            continue
+        # Изменения разнесены, чтобы хунки не перекрывались
+        picked = []
+        for i in rng.sample(candidates, len(candidates)):
+            if all(abs(i - j) > 6 for j in picked):
+                picked.append(i)
+            if len(picked) == changes:
+                break
+        changed = {i: lines[i] + "  # bench" for i in picked}
+        expected = "\n".join(changed.get(i, l) for i, l in enumerate(lines))
+        rel = os.path.relpath(path, BASE_DIR)
+        write_tokens = estimate_tokens(f'```write_file path="{rel}"\n{expected}\n```')
+        block = _edit_block_for(lines, changed)
+        edit_tokens = estimate_tokens(f'```edit_file path="{rel}"\n{block}\n```')
+        started = time.perf_counter()
+        try:
+            result, _ = sloth_edits.apply_edit(original, block)
+            ok = result == expected
+        except sloth_edits.EditError:
+            ok = False
+        apply_ms = (time.perf_counter() - started) * 1000
+        failures += 0 if ok else 1
+        rows.append((rel, len(lines), write_tokens, edit_tokens, apply_ms, ok))
+
+    print(f"{Colors.BOLD}{Colors.HEADER}--- EDITS: write_file vs edit_file ({changes} изм. строк на файл, файлов: {len(rows)}) ---{Colors.ENDC}")
+    for rel, n_lines, write_tokens, edit_tokens, apply_ms, ok in rows:
+        mark = "" if ok else f"  {Colors.FAIL}НЕ ПРИМЕНИЛАСЬ{Colors.ENDC}"
+        print(f"  {rel:<28} {n_lines:>6} строк | write_file ~{write_tokens:>6} т. | edit_file ~{edit_tokens:>5} т. | "
+              f"применение {apply_ms:6.2f} мс{mark}")
+    if rows:
+        total_write = sum(r[2] for r in rows)
+        total_edit = sum(r[3] for r in rows)
+        print(f"  Итого выходных токенов: write_file ~{total_write} т. → edit_file ~{total_edit} т. "
+              f"({total_edit / total_write:.1%} от полной перезаписи)")
+
+    if telemetry:
+        _telemetry_output_tokens(os.path.expanduser(telemetry), since)
+    if failures:
+        print(f"{Colors.FAIL}{Symbols.CROSS} Правка не применилась в {failures} файлах.{Colors.ENDC}")
+        return 1
+    return 0
+
+
+def _legacy_parse_blocks(text: str) -> list:
+    """Прежний разбор parse_all_blocks (DOTALL-регулярка) — база для сравнения скорости."""
+    blocks = []
+    for match in re.finditer(r"```(\w+)([^\n]*)?\n(.*?)\n```", text, re.DOTALL):
+        content = match.group(3)
+        boundary_match = re.search(r'boundary\s*=\s*"([^"]+)"', match.group(2) or "")
+        if boundary_match and content.endswith(boundary_match.group(1)):
+            content = content.rsplit(boundary_match.group(1), 1)[0].rstrip("\r\n")
+        blocks.append((match.group(1), content))
+    return blocks
+
+
+def _synthetic_response(rng: random.Random, target_chars: int, boundary: str):
+    """Ответ модели из случайных блоков (вложенные ```, boundary, однострочные блоки) и ожидаемый разбор."""
+    words = ["def", "return", "x", "self", "value", "# комментарий", "print(x)", "if", "else:", "{", "}", "``inline``"]
+
+    def body(lines, nested):
+        out = []
+        for _ in range(lines):
+            if nested and rng.random() < 0.05:
+                out += [f"```{rng.choice(['python', 'bash', 'json'])}", " ".join(rng.choices(words, k=4)), "```"]
+            else:
+                out.append("    " * rng.randint(0, 3) + " ".join(rng.choices(words, k=rng.randint(1, 8))))
+        return "\n".join(out)
+
+    parts, expected, size, n = [], [], 0, 0
+    while size < target_chars:
+        n += 1
+        kind = rng.choice(["summary", "bash", "write_file", "write_file_lead", "edit_file", "verify_run", "text"])
+        if kind == "text":
+            chunk = body(rng.randint(1, 3), False)
+        elif kind == "verify_run":
+            chunk = "```verify_run```"
+            expected.append(("verify_run", ""))
+        elif kind in ("summary", "bash"):
+            content = body(rng.randint(1, 20), nested=True)
+            chunk = f"```{kind}\n{content}\n```"
+            expected.append((kind, content))
+        elif kind == "write_file_lead":
+            # Формат промпта исполнения: маркер сразу после заголовка, конец — по ```
+            content = body(rng.randint(5, 400), nested=True)
+            chunk = f'```write_file path="pkg/f{n}.py"\n\n{boundary}\n{content}\n```'
+            expected.append(("write_file", content))
+        else:
+            content = body(rng.randint(5, 400), nested=True)
+            if rng.random() < 0.3:
+                content += "\n```"  # непарная ``` внутри файла — держится только на boundary
+            chunk = f'```{kind} path="pkg/f{n}.py" boundary="{boundary}"\n{content}\n{boundary}\n```'
+            expected.append((kind, content))
+        parts.append(chunk)
+        size += len(chunk) + 1
+    return "\n".join(parts), expected
+
+
+def _chunked(text: str, rng: random.Random):
+    """Нарезка ответа на куски случайной длины — как при стриминге."""
+    pos = 0
+    while pos < len(text):
+        step = rng.choice([1, 7, 64, 4096])
+        yield text[pos:pos + step]
+        pos += step
+
+
+def _parse_stream(chunks, boundary):
+    import sloth_blocks
+
+    parser = sloth_blocks.BlockParser(boundary)
+    blocks = []
+    for chunk in chunks:
+        blocks += parser.feed(chunk)
+    blocks += parser.close()
+    return [(b["type"], b["content"]) for b in blocks], parser.errors
+
+
+def bench_blocks(size_mb: float = 4.0, cases: int = 300, seed: int = 1) -> int:
+    """Фазз-корпус и пропускная способность потокового разбора блоков (sloth_blocks)."""
+    import sloth_blocks
+
+    rng = random.Random(seed)
+    boundary = "SLOTH_BOUNDARY_bench"
+    failures = []
+
+    # --- Фазз: корректные ответы, мутации и нарезка на куски ---
+    mutations = ("none", "truncate", "drop_fence", "drop_boundary", "crlf", "garbage")
+    for case in range(cases):
+        text, expected = _synthetic_response(rng, rng.randint(200, 6000), boundary)
+        mutation = mutations[case % len(mutations)]
+        if mutation == "truncate":
+            text = text[:rng.randint(0, len(text))]
+        elif mutation == "drop_fence":
+            idx = [m.start() for m in re.finditer(r"(?m)^```$", text)]
+            if idx:
+                at = rng.choice(idx)
+                text = text[:at] + text[at + 3:]
+        elif mutation == "drop_boundary":
+            text = text.replace(f"\n{boundary}\n```", "\n```", 1)
+        elif mutation == "crlf":
+            text = text.replace("\n", "\r\n")
+        elif mutation == "garbage":
+            at = rng.randint(0, len(text))
+            text = text[:at] + rng.choice(["```", "``", "\n```\n", "```python", boundary, "\x00"]) + text[at:]
+        try:
+            whole, _ = sloth_blocks.parse_blocks(text, boundary)
+            whole = [(b["type"], b["content"]) for b in whole]
+            streamed, _ = _parse_stream(_chunked(text, rng), boundary)
+        except Exception as e:
+            failures.append(f"кейс {case} ({mutation}): исключение {e!r}")
+            continue
+        if streamed != whole:
+            failures.append(f"кейс {case} ({mutation}): потоковый разбор расходится с разбором целиком")
+        elif mutation == "none" and whole != expected:
+            failures.append(f"кейс {case}: разбор не совпал с ожидаемым")
+        elif mutation == "crlf" and [(t, c.replace("\r", "")) for t, c in whole] != expected:
+            failures.append(f"кейс {case} (crlf): разбор не совпал с ожидаемым")
+        elif mutation == "truncate" and whole != expected[:len(whole)]:
+            # Обрезанный ответ не должен порождать недописанный файл
+            failures.append(f"кейс {case} (truncate): блоки не являются префиксом ожидаемых")
+
+    print(f"{Colors.BOLD}{Colors.HEADER}--- BLOCKS: фазз-корпус ({cases} кейсов, мутации: {', '.join(mutations)}) ---{Colors.ENDC}")
+    for failure in failures[:20]:
+        print(f"  {Colors.FAIL}{failure}{Colors.ENDC}")
+    if not failures:
+        print(f"  {Colors.OKGREEN}{Symbols.CHECK} Все кейсы: без исключений, поток = целиком, ожидаемый разбор совпал.{Colors.ENDC}")
+
+    # --- Пропускная способность на больших ответах ---
+    text, expected = _synthetic_response(rng, int(size_mb * 1024 * 1024), boundary)
+    mb = len(text) / (1024 * 1024)
+    print(f"{Colors.BOLD}{Colors.HEADER}--- BLOCKS: пропускная способность ({mb:.1f} МБ, блоков: {len(expected)}) ---{Colors.ENDC}")
+    started = time.perf_counter()
+    whole, _ = sloth_blocks.parse_blocks(text, boundary)
+    whole_s = time.perf_counter() - started
+    chunks = [text[i:i + 64] for i in range(0, len(text), 64)]
+    started = time.perf_counter()
+    streamed, _ = _parse_stream(chunks, boundary)
+    stream_s = time.perf_counter() - started
+    started = time.perf_counter()
+    legacy = _legacy_parse_blocks(text)
+    legacy_s = time.perf_counter() - started
+    correct = [(b["type"], b["content"]) for b in whole] == expected
+    legacy_correct = sum((Counter(legacy) & Counter(expected)).values())
+    print(f"  BlockParser целиком:       {mb / whole_s:7.1f} МБ/с ({whole_s * 1000:.0f} мс) | разбор {'верный' if correct else 'НЕВЕРНЫЙ'}")
+    print(f"  BlockParser кусками по 64: {mb / stream_s:7.1f} МБ/с ({stream_s * 1000:.0f} мс) | совпадает с целиком: {'да' if streamed == [(b['type'], b['content']) for b in whole] else 'НЕТ'}")
+    print(f"  Прежняя регулярка:         {mb / legacy_s:7.1f} МБ/с ({legacy_s * 1000:.0f} мс) | верных блоков: {legacy_correct}/{len(expected)}")
+    if not correct:
+        failures.append("большой ответ разобран неверно")
+    return 1 if failures else 0
+
+
+def _legacy_file_hash(filepath):
+    """Прежний get_file_hash: SHA-256 последовательно кусками по 8 КБ — база для сравнения."""
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(8192)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _buffered_file_hash(filepath):
+    """SHA-256 тем же чтением, что у sloth_tree (буфер 1 МБ / mmap), но последовательно и без памяти."""
+    import sloth_tree
+
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath, "rb") as f:
+        return sloth_tree._digest_file(f, os.fstat(f.fileno()).st_size, hashlib.sha256())
+
+
+def bench_hashing(small: int = 4000, large: int = 3, large_mb: int = 32, seed: int = 1) -> int:
+    """Хэширование синтетического дерева: прежний get_file_hash против sloth_tree (пул потоков + память)."""
+    import shutil
+    import tempfile
+    import sloth_tree
+
+    rng = random.Random(seed)
+    root = tempfile.mkdtemp(prefix="sloth-hash-bench-")
+    try:
+        paths = []
+        for i in range(small):
+            path = os.path.join(root, f"d{i % 50}", f"f{i}.txt")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(rng.randbytes(rng.randint(1, 32) * 1024))
+            paths.append(path)
+        for i in range(large):
+            path = os.path.join(root, f"large{i}.bin")
+            with open(path, "wb") as f:
+                f.write(rng.randbytes(large_mb << 20))
+            paths.append(path)
+        # Файлы «старые»: иначе защита от гонки с mtime не даст запомнить хэши
+        old = time.time() - 60
+        for path in paths:
+            os.utime(path, (old, old))
+        total_mb = sum(os.path.getsize(p) for p in paths) / (1 << 20)
+
+        print(f"{Colors.BOLD}{Colors.HEADER}--- HASHING: {len(paths)} файлов, {total_mb:.0f} МБ "
+              f"(алгоритм: {sloth_tree.DIGEST_NAME}, потоков: {sloth_tree.HASH_WORKERS}) ---{Colors.ENDC}")
+        rows = []
+        started = time.perf_counter()
+        for path in paths:
+            _legacy_file_hash(path)
+        rows.append(("Прежний get_file_hash (8 КБ, последовательно)", time.perf_counter() - started))
+        started = time.perf_counter()
+        for path in paths:
+            _buffered_file_hash(path)
+        rows.append(("SHA-256 буфером/mmap, последовательно", time.perf_counter() - started))
+        sloth_tree._MEMO.clear()
+        started = time.perf_counter()
+        cold = sloth_tree.hash_files(paths)
+        rows.append(("hash_files, холодный (пул потоков)", time.perf_counter() - started))
+        started = time.perf_counter()
+        warm = sloth_tree.hash_files(paths)
+        rows.append(("hash_files, повтор (память по inode/mtime/size)", time.perf_counter() - started))
+        started = time.perf_counter()
+        snapshot = sloth_tree.take(root)
+        rows.append(("take() — снимок дерева по метаданным", time.perf_counter() - started))
+
+        base = rows[0][1]
+        for label, seconds in rows:
+            print(f"  {label:<48} {seconds * 1000:8.1f} мс | {total_mb / seconds:8.0f} МБ/с | "
+                  f"{len(paths) / seconds:9.0f} файлов/с | ×{base / seconds:.1f}")
+        if cold != warm or len(snapshot) < len(paths):
+            print(f"{Colors.FAIL}{Symbols.CROSS} Результаты хэширования не совпали.{Colors.ENDC}")
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def _legacy_scan_for_token(root_dir: str, token: str = "SLOTH_BOUNDARY", max_per_file: int = 3, max_files: int = 50):
+    """Прежний _scan_project_for_token из sloth_cli: полный обход с неработающим пропуском папок."""
+    findings = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        if os.path.basename(dirpath) in {".git", "node_modules", ".venv", "venv", ".idea", ".vscode", "dist", "build"}:
+            continue
+        for fn in filenames:
+            fpath = os.path.join(dirpath, fn)
+            try:
+                if os.path.getsize(fpath) > 2 * 1024 * 1024:
+                    continue
+                with open(fpath, "r", encoding="utf-8", errors="ignore") as f:
+                    per_file = 0
+                    for i, line in enumerate(f, start=1):
+                        if token in line:
+                            findings.append(f"{os.path.relpath(fpath, root_dir)}:{i}: {line.strip()}")
+                            per_file += 1
+                            if per_file >= max_per_file:
+                                break
+                if len(findings) >= max_files:
+                    break
+            except Exception:
+                continue
+    return findings
+
+
+def bench_leaks(sources: int = 2000, deps: int = 20000, changed: int = 5, seed: int = 1) -> int:
+    """Скан утечек перед verify: прежний полный обход против LeakScanner (отсечение папок, только изменённые файлы)."""
+    import shutil
+    import tempfile
+    import sloth_leaks
+
+    rng = random.Random(seed)
+    root = tempfile.mkdtemp(prefix="sloth-leaks-bench-")
+    try:
+        def _write(rel, text):
+            path = os.path.join(root, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+
+        line = "export const value = compute(input, options);\n"
+        for i in range(sources):
+            _write(f"src/m{i % 40}/f{i}.ts", line * rng.randint(20, 200))
+        for i in range(deps):
+            _write(f"node_modules/pkg{i % 500}/lib/sub/f{i}.js", line * rng.randint(5, 50))
+        leaked = [f"src/m{i % 40}/f{i}.ts" for i in rng.sample(range(sources), changed)]
+        kinds = ("SLOTH_BOUNDARY_0123abcd\n", "```write_file path=\"x.ts\"\n", "<<<<<<< SEARCH\n")
+        for i, rel in enumerate(leaked):
+            with open(os.path.join(root, rel), "a", encoding="utf-8") as f:
+                f.write(kinds[i % len(kinds)])
+
+        print(f"{Colors.BOLD}{Colors.HEADER}--- LEAKS: {sources} исходников, {deps} файлов в node_modules, "
+              f"утечек в {changed} файлах ---{Colors.ENDC}")
+        started = time.perf_counter()
+        legacy = _legacy_scan_for_token(root)
+        legacy_s = time.perf_counter() - started
+
+        scanner = sloth_leaks.LeakScanner(root)
+        started = time.perf_counter()
+        full = scanner.scan()
+        full_s, full_files = time.perf_counter() - started, scanner.files_scanned
+        # Итерация модели: исправлены файлы с утечками и изменено ещё несколько
+        for rel in leaked:
+            _write(rel, line * 10)
+        touched = leaked + [f"src/m{i % 40}/f{i}.ts" for i in rng.sample(range(sources), changed)]
+        scanner.note_changes(touched)
+        started = time.perf_counter()
+        incremental = scanner.scan()
+        incremental_s, incremental_files = time.perf_counter() - started, scanner.files_scanned
+
+        print(f"  {'Прежний полный обход (только SLOTH_BOUNDARY)':<46} {legacy_s * 1000:9.1f} мс | находок: {len(legacy)}")
+        print(f"  {'LeakScanner, первый (полный) скан':<46} {full_s * 1000:9.1f} мс | находок: {len(full)} | файлов: {full_files}")
+        print(f"  {'LeakScanner, скан после итерации':<46} {incremental_s * 1000:9.1f} мс | находок: {len(incremental)} | файлов: {incremental_files}")
+        found = {f.split(":", 1)[0] for f in full}
+        if found != set(leaked) or incremental:
+            print(f"{Colors.FAIL}{Symbols.CROSS} Находки не совпали с ожидаемыми: {sorted(found)}{Colors.ENDC}")
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def _telemetry_output_tokens(path: str, since: str | None) -> None:
+    """Фактические output_tokens на запрос фаз исполнения: до и после даты since."""
+    phases = ("INITIAL_CODING", "REVIEWING", "FIXING_ERROR")
+    cutoff = datetime.fromisoformat(since).timestamp() if since else None
+    before, after = [], []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("phase") not in phases:
+                    continue
+                bucket = after if cutoff is None or entry.get("ts", 0) >= cutoff else before
+                bucket.append(int(entry.get("output_tokens", 0) or 0))
+    except OSError as e:
+        print(f"{Colors.WARNING}{Symbols.WARNING}  Не удалось прочитать телеметрию {path}: {e}{Colors.ENDC}")
+        return
+    print(f"  Телеметрия ({path}), output_tokens на запрос исполнения:")
+    for label, values in (("до", before), ("после", after)):
+        if values:
+            print(f"    {label:<6} {since or '':<10} | запросов: {len(values):<4} | медиана: {statistics.median(values):.0f} | "
+                  f"среднее: {statistics.mean(values):.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sloth: бенчмарки производительности.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_startup = sub.add_parser("startup", help="Время импорта CLI (python -X importtime) с порогом регрессии.")
+    p_startup.add_argument("--module", default="sloth_cli", help="Импортируемый модуль (по умолчанию sloth_cli).")
+    p_startup.add_argument("--runs", type=int, default=5, help="Количество прогонов (по умолчанию 5).")
+    p_startup.add_argument("--threshold-ms", type=float, default=None, help="Порог медианы в мс (bench.startup_threshold_ms, по умолчанию 400).")
+    p_startup.add_argument("--top", type=int, default=10, help="Сколько самых тяжёлых модулей показать.")
+
+    p_edits = sub.add_parser("edits", help="Выходные токены: write_file (весь файл) против edit_file (хунки).")
+    p_edits.add_argument("paths", nargs="*", help="Файлы или glob-шаблоны (по умолчанию *.py Sloth).")
+    p_edits.add_argument("--changes", type=int, default=3, help="Изменённых строк на файл (по умолчанию 3).")
+    p_edits.add_argument("--min-lines", type=int, default=200, help="Минимальный размер файла в строках.")
+    p_edits.add_argument("--seed", type=int, default=1, help="Seed выбора строк.")
+    p_edits.add_argument("--telemetry", default=None, help="JSONL телеметрии (telemetry.file) для сравнения до/после.")
+    p_edits.add_argument("--since", default=None, help="Дата внедрения edit_file (YYYY-MM-DD) для --telemetry.")
+
+    p_blocks = sub.add_parser("blocks", help="Потоковый разбор блоков ответа: фазз-корпус и МБ/с против прежней регулярки.")
+    p_blocks.add_argument("--size-mb", type=float, default=4.0, help="Размер синтетического ответа для замера скорости (МБ).")
+    p_blocks.add_argument("--cases", type=int, default=300, help="Количество кейсов фазз-корпуса.")
+    p_blocks.add_argument("--seed", type=int, default=1, help="Seed генерации корпуса.")
+
+    p_hashing = sub.add_parser("hashing", help="Хэширование дерева файлов: прежний get_file_hash против sloth_tree.")
+    p_hashing.add_argument("--small", type=int, default=4000, help="Маленьких файлов (1–32 КБ).")
+    p_hashing.add_argument("--large", type=int, default=3, help="Больших файлов.")
+    p_hashing.add_argument("--large-mb", type=int, default=32, help="Размер большого файла (МБ).")
+    p_hashing.add_argument("--seed", type=int, default=1, help="Seed генерации дерева.")
+
+    p_leaks = sub.add_parser("leaks", help="Скан утечек протокола перед verify: полный обход против LeakScanner.")
+    p_leaks.add_argument("--sources", type=int, default=2000, help="Исходников в src/.")
+    p_leaks.add_argument("--deps", type=int, default=20000, help="Файлов в node_modules/.")
+    p_leaks.add_argument("--changed", type=int, default=5, help="Файлов с утечками (и изменённых за итерацию).")
+    p_leaks.add_argument("--seed", type=int, default=1, help="Seed генерации проекта.")
+
+    args = parser.parse_args()
+    if args.command == "startup":
+        sys.exit(bench_startup(args.module, args.runs, args.threshold_ms, args.top))
+    if args.command == "edits":
+        sys.exit(bench_edits(args.paths, args.changes, args.min_lines, args.seed, args.telemetry, args.since))
+    if args.command == "blocks":
+        sys.exit(bench_blocks(args.size_mb, args.cases, args.seed))
+    if args.command == "hashing":
+        sys.exit(bench_hashing(args.small, args.large, args.large_mb, args.seed))
+    if args.command == "leaks":
+        sys.exit(bench_leaks(args.sources, args.deps, args.changed, args.seed))
@@ -0,0 +1,189 @@
+# Файл: sloth_blocks.py
+"""
+Потоковый разбор fenced-блоков ответа модели (```tag ... ```) для Sloth.
+
+Однопроходный построчный автомат вместо DOTALL-регулярки с ленивым `.*?`:
+  - вне блока строка с ```tag открывает блок (```verify_run``` в одну строку —
+    пустой блок сразу);
+  - блок без boundary закрывается строкой ``` с учётом вложенности: ```lang внутри
+    блока открывает вложенный фрагмент, и его ``` блок не закрывает;
+  - write_file/edit_file с boundary (атрибут boundary="..." в заголовке или маркер
+    запуска, переданный в BlockParser) заканчивается строкой, равной boundary;
+    до неё любые ``` — содержимое файла. Блок отдаётся сразу на строке boundary,
+    не дожидаясь закрывающей ```. Если boundary стоит сразу после заголовка (формат
+    промпта исполнения), он пропускается, а блок заканчивается на boundary или на
+    непарной ```, что раньше. Если boundary так и не пришёл, блок закрывается по
+    первой непарной ``` (как раньше), а остаток ответа разбирается заново;
+  - незакрытый блок отбрасывается.
+Все отклонения от формата попадают в errors: смещение (символ) и строка начала блока.
+
+feed(chunk) принимает ответ кусками и возвращает блоки, закрытые этим куском;
+close() дочитывает хвост. Время и память линейны по размеру ответа.
+"""
+
+import re
+from typing import Dict, List, Optional
+
+_OPEN_RE = re.compile(r"```(\w+)(.*)$")
+_NESTED_OPEN_RE = re.compile(r"^```\w")
+_BOUNDARY_ATTR_RE = re.compile(r'boundary\s*=\s*"([^"]+)"')
+FILE_BLOCK_TYPES = ("write_file", "edit_file")
+
+
+class BlockParser:
+    def __init__(self, boundary: Optional[str] = None):
+        self.boundary = boundary
+        self.errors: List[Dict] = []
+        self._parts: List[str] = []
+        self._offset = 0
+        self._line_no = 1
+        self._block: Optional[Dict] = None
+        self._ready: List[Dict] = []
+
+    # --- вход ---
+    def feed(self, chunk: str) -> List[Dict]:
+        """Дописывает кусок ответа. Возвращает блоки, закрытые этим куском."""
+        start = 0
+        nl = chunk.find("\n")
+        while nl >= 0:
+            if self._parts:
+                self._parts.append(chunk[start:nl])
+                line = "".join(self._parts)
+                self._parts = []
+            else:
+                line = chunk[start:nl]
+            self._line(line, self._offset, self._line_no)
+            self._offset += len(line) + 1
+            self._line_no += 1
+            start = nl + 1
+            nl = chunk.find("\n", start)
+        if start < len(chunk):
+            self._parts.append(chunk[start:])
+        return self._take()
+
+    def close(self) -> List[Dict]:
+        """Конец ответа: дочитывает последнюю строку и разбирается с незакрытым блоком."""
+        if self._parts:
+            line = "".join(self._parts)
+            self._parts = []
+            self._line(line, self._offset, self._line_no)
+            self._offset += len(line)
+        while self._block is not None:
+            block, self._block = self._block, None
+            if block["done"]:
+                self._error(block, f"после {block['boundary']} нет закрывающей ```")
+                continue
+            fence = block["fence"]
+            if block["boundary"] and fence is not None:
+                self._error(block, f"boundary {block['boundary']} не найден — блок закрыт по первой непарной ```")
+                self._emit(block, block["lines"][:fence])
+                # Остаток после этой ``` — снова обычный текст ответа
+                for line, offset, line_no in zip(block["lines"][fence + 1:], block["offsets"][fence + 1:],
+                                                 block["line_nos"][fence + 1:]):
+                    self._line(line, offset, line_no)
+                continue
+            self._error(block, "блок не закрыт (нет ```" + (f" и {block['boundary']}" if block["boundary"] else "") + ") — пропущен")
+        return self._take()
+
+    # --- автомат ---
+    def _line(self, line: str, offset: int, line_no: int) -> None:
+        block = self._block
+        if block is None:
+            self._open(line, offset, line_no)
+            return
+        stripped = line.strip()
+        if block["done"]:
+            # Блок уже отдан по boundary, ждём закрывающую ```
+            if not stripped:
+                return
+            self._block = None
+            if stripped != "```":
+                self._error(block, f"после {block['boundary']} ожидалась ```")
+                self._open(line, offset, line_no)
+            return
+        if block["boundary"]:
+            if stripped == block["boundary"]:
+                if not block["lead_skipped"] and not any(l.strip() for l in block["lines"]):
+                    # Маркер сразу после заголовка (формат промпта исполнения) — не конец, а начало
+                    block["lead_skipped"] = True
+                    block["lines"], block["offsets"], block["line_nos"] = [], [], []
+                    return
+                self._emit(block, block["lines"])
+                block["done"] = True
+                return
+            if block["lead_skipped"] and stripped == "```" and not block["depth"]:
+                # Маркер был только в начале: конец блока — непарная ```, как у обычных блоков
+                self._block = None
+                self._emit(block, block["lines"])
+                return
+            self._append(block, line, offset, line_no)
+            if stripped.startswith("```"):
+                if _NESTED_OPEN_RE.match(stripped):
+                    block["depth"] += 1
+                elif stripped == "```":
+                    if block["depth"]:
+                        block["depth"] -= 1
+                    elif block["fence"] is None:
+                        block["fence"] = len(block["lines"]) - 1
+            return
+        if stripped.startswith("```"):
+            if stripped == "```" and not block["depth"]:
+                self._block = None
+                self._emit(block, block["lines"])
+                return
+            if _NESTED_OPEN_RE.match(stripped):
+                block["depth"] += 1
+            elif stripped == "```":
+                block["depth"] -= 1
+        block["lines"].append(line)
+
+    def _open(self, line: str, offset: int, line_no: int) -> None:
+        match = _OPEN_RE.search(line)
+        if not match:
+            return
+        block_type = match.group(1)
+        header_args = match.group(2).strip()
+        block = {
+            "type": block_type, "header_args": header_args, "offset": offset + match.start(), "line": line_no,
+            "lines": [], "offsets": [], "line_nos": [], "depth": 0, "fence": None,
+            "boundary": None, "lead_skipped": False, "done": False,
+        }
+        if header_args.endswith("```"):
+            # Однострочный блок: ```verify_run```
+            block["header_args"] = header_args[:-3].strip()
+            self._emit(block, [])
+            return
+        if block_type in FILE_BLOCK_TYPES:
+            boundary_match = _BOUNDARY_ATTR_RE.search(header_args)
+            block["boundary"] = boundary_match.group(1) if boundary_match else self.boundary
+        self._block = block
+
+    @staticmethod
+    def _append(block: Dict, line: str, offset: int, line_no: int) -> None:
+        # Смещения нужны только для повторного разбора хвоста, если boundary не придёт
+        block["lines"].append(line)
+        block["offsets"].append(offset)
+        block["line_nos"].append(line_no)
+
+    # --- выход ---
+    def _emit(self, block: Dict, lines: List[str]) -> None:
+        self._ready.append({
+            "type": block["type"],
+            "header": f"```{block['type']} {block['header_args']}".strip(),
+            "content": "\n".join(lines).rstrip("\r\n") if block["boundary"] else "\n".join(lines),
+        })
+
+    def _error(self, block: Dict, message: str) -> None:
+        self.errors.append({"offset": block["offset"], "line": block["line"], "type": block["type"], "message": message})
+
+    def _take(self) -> List[Dict]:
+        ready, self._ready = self._ready, []
+        return ready
+
+
+def parse_blocks(text: str, boundary: Optional[str] = None):
+    """Разбор ответа целиком. Возвращает (blocks, errors)."""
+    parser = BlockParser(boundary)
+    blocks = parser.feed(text or "")
+    blocks += parser.close()
+    return blocks, parser.errors
@@ -0,0 +1,113 @@
+# Файл: sloth_cascade.py
+"""
+Каскад моделей для Sloth: сначала быстрая модель, эскалация на сильную при неудаче.
+
+- В фазах из cascade.phases (по умолчанию REVIEWING и FIXING_ERROR) ход сначала
+  делает быстрая модель (cascade.fast_model), если серия неудач не длиннее
+  cascade.max_failure_streak («простой» ход).
+- Эскалация на модель профиля фазы происходит при:
+    parse      — ответ без действий (нет write_file/bash/manual/done_summary);
+    validation — путь write_file не прошёл _parse_and_validate_filepath;
+    verify     — верификация после хода быстрой модели упала.
+- Статистика (попытки быстрой модели и эскалации по причинам, по фазам) копится
+  между запусками в cascade_stats.json. Если доля эскалаций в фазе выше
+  cascade.max_escalation_rate (при не менее cascade.min_samples попыток),
+  фаза перестаёт начинаться с быстрой модели.
+
+Настройки (sloth_config.json, секция "cascade"):
+  enabled, phases, fast_model, max_failure_streak, max_escalation_rate, min_samples, stats_file.
+"""
+
+import json
+import os
+import time
+from typing import Dict, Optional
+
+from colors import Colors
+import config as sloth_config
+
+TIER_FAST = "fast"
+TIER_STRONG = "strong"
+ESCALATION_REASONS = ("parse", "validation", "verify")
+
+
+class ModelCascade:
+    def __init__(self, fast_model: str, enabled: Optional[bool] = None, stats_file: Optional[str] = None):
+        self.enabled = bool(enabled if enabled is not None else sloth_config.get("cascade.enabled", False))
+        self.fast_model = sloth_config.get("cascade.fast_model", None) or fast_model
+        self.phases = {str(p).upper() for p in sloth_config.get("cascade.phases", ["REVIEWING", "FIXING_ERROR"])}
+        self.max_failure_streak = int(sloth_config.get("cascade.max_failure_streak", 1))
+        self.max_escalation_rate = float(sloth_config.get("cascade.max_escalation_rate", 0.5))
+        self.min_samples = int(sloth_config.get("cascade.min_samples", 5))
+        self.stats_file = os.path.expanduser(
+            stats_file or sloth_config.get("cascade.stats_file", "~/.cache/sloth/cascade_stats.json")
+        )
+        self.stats: Dict[str, Dict[str, int]] = self._load()
+        self.session: Dict[str, Dict[str, int]] = {}
+
+    # --- статистика ---
+    def _load(self) -> Dict[str, Dict[str, int]]:
+        try:
+            with open(self.stats_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return {k: dict(v) for k, v in data.get("phases", {}).items() if isinstance(v, dict)}
+        except Exception:
+            return {}
+
+    def save(self) -> None:
+        if not self.session:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.stats_file), exist_ok=True)
+            tmp_path = self.stats_file + f".{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"updated": time.time(), "phases": self.stats}, f, indent=2)
+            os.replace(tmp_path, self.stats_file)
+        except OSError:
+            # Каталог кэша недоступен или диск полон: пороги этой сессии уже посчитаны по self.stats
+            # в памяти, теряется только накопление статистики для следующих запусков
+            pass
+
+    def _bump(self, phase: str, key: str) -> None:
+        for table in (self.stats, self.session):
+            entry = table.setdefault(phase, {})
+            entry[key] = entry.get(key, 0) + 1
+
+    def escalation_rate(self, phase: str) -> float:
+        entry = self.stats.get(phase, {})
+        attempts = entry.get("fast_attempts", 0)
+        if not attempts:
+            return 0.0
+        return sum(entry.get(r, 0) for r in ESCALATION_REASONS) / attempts
+
+    # --- выбор ---
+    def choose(self, phase: str, failure_streak: int = 0, force_strong: bool = False) -> str:
+        """Уровень модели для хода: TIER_FAST или TIER_STRONG."""
+        if not self.enabled or force_strong or phase not in self.phases:
+            return TIER_STRONG
+        if failure_streak > self.max_failure_streak:
+            return TIER_STRONG
+        attempts = self.stats.get(phase, {}).get("fast_attempts", 0)
+        if attempts >= self.min_samples and self.escalation_rate(phase) > self.max_escalation_rate:
+            return TIER_STRONG
+        return TIER_FAST
+
+    def record_attempt(self, phase: str) -> None:
+        self._bump(phase, "fast_attempts")
+
+    def record_escalation(self, phase: str, reason: str) -> None:
+        self._bump(phase, reason)
+        print(f"{Colors.CYAN}⤴️  ЛОГ: Каскад: эскалация {phase} на сильную модель (причина: {reason}).{Colors.ENDC}", flush=True)
+
+    # --- отчёт ---
+    def report(self) -> None:
+        if not self.session:
+            return
+        print(f"\n{Colors.BOLD}{Colors.HEADER}--- КАСКАД МОДЕЛЕЙ ({self.fast_model}) ---{Colors.ENDC}", flush=True)
+        for phase, entry in self.session.items():
+            reasons = ", ".join(f"{r}: {entry.get(r, 0)}" for r in ESCALATION_REASONS)
+            print(
+                f"  Фаза: {phase:<14} | попыток быстрой модели: {entry.get('fast_attempts', 0):<2} | "
+                f"эскалации: {reasons} | доля эскалаций (всего): {self.escalation_rate(phase) * 100:.0f}%",
+                flush=True,
+            )
@@ -2,17 +2,18 @@
 import os
 import sys
 import time
+import random
 import re
 import json
 import platform
 import subprocess
 import signal
 import argparse
-# --- ИЗМЕНЕННЫЙ БЛОК ИМПОРТА TKINTER ---
+import importlib.util
+# --- TKINTER: проверяем наличие без импорта; сам модуль грузим только при показе диалога ---
 try:
-    from tkinter import Tk, filedialog
-    TKINTER_AVAILABLE = True
-except ImportError:
+    TKINTER_AVAILABLE = importlib.util.find_spec("tkinter") is not None
+except Exception:
     TKINTER_AVAILABLE = False
 import uuid
 import shutil
@@ -21,6 +22,16 @@ from colors import Colors, Symbols
 import sloth_core
 import sloth_runner
 import context_collector
+import sloth_health
+import sloth_cascade
+import sloth_telemetry
+import sloth_history
+import sloth_session
+import sloth_edits
+import sloth_snapshots
+import sloth_blocks
+import sloth_tree
+import sloth_leaks
 import config as sloth_config
 
 # --- КОНСТАНТЫ ИНТЕРФЕЙСА ---
@@ -90,53 +101,24 @@ def _execute_verify_with_timeout(command: str, timeout_seconds: int):
                 stdout, stderr = proc.communicate()
         return 124, stdout or "", stderr or ""
 
-def _scan_project_for_token(root_dir: str, token: str = "SLOTH_BOUNDARY", max_per_file: int = 3, max_files: int = 50):
-    """Ищет служебный маркер в текстовых файлах проекта. Возвращает список строк с местами попаданий.
-    По умолчанию ограничивает количество совпадений.
-    """
-    findings = []
-    try:
-        for dirpath, dirnames, filenames in os.walk(root_dir):
-            # пропускаем скрытые папки и node_modules/.git/.venv/venv/.idea
-            base = os.path.basename(dirpath)
-            if base in {".git", "node_modules", ".venv", "venv", ".idea", ".vscode", "dist", "build"}:
-                continue
-            for fn in filenames:
-                # пропустим бинарные/крупные/очевидные артефакты
-                lower = fn.lower()
-                if any(lower.endswith(ext) for ext in [".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".pdf", ".zip", ".tar", ".gz", ".woff", ".woff2", ".ttf", ".eot", ".mp4", ".mov", ".mp3", ".bin"]):
-                    continue
-                fpath = os.path.join(dirpath, fn)
-                # ограничим размер файла
-                try:
-                    if os.path.getsize(fpath) > 2 * 1024 * 1024:
-                        continue
-                except Exception:
-                    continue
-                try:
-                    with open(fpath, "r", encoding="utf-8", errors="ignore") as f:
-                        per_file = 0
-                        for i, line in enumerate(f, start=1):
-                            if token in line:
-                                rel = os.path.relpath(fpath, root_dir)
-                                findings.append(f"{rel}:{i}: {line.strip()}")
-                                per_file += 1
-                                if per_file >= max_per_file:
-                                    break
-                    if len(findings) >= max_files:
-                        break
-                except Exception:
-                    continue
-    except Exception:
-        pass
-    return findings
+def _write_failure_target(block, error):
+    """Что сообщить модели как упавшее действие: блок, если ошибка при его разборе, иначе путь из исключения."""
+    if block is not None:
+        return f"{block['type']} ({block['header']})"
+    filename = getattr(error, "filename", None)
+    if filename and os.path.basename(filename).startswith(".sloth-tmp-"):
+        # Временный файл рядом с целью — сообщаем папку, в которую не удалось записать
+        filename = os.path.dirname(filename)
+    if filename:
+        return f"write_file ({os.path.relpath(filename, os.getcwd())})"
+    return "write_file (запись группы файлов)"
 
 def _parse_and_validate_filepath(header_line: str, project_root_dir: str) -> str:
     """
-    Извлекает и валидирует путь к файлу из полного заголовка write_file.
+    Извлекает и валидирует путь к файлу из полного заголовка write_file (или edit_file).
     Возвращает безопасный, АБСОЛЮТНЫЙ путь к файлу или вызывает ValueError.
     """
-    if not header_line.startswith("```write_file"):
+    if not header_line.startswith(("```write_file", "```edit_file")):
         raise ValueError(f"Некорректный заголовок write_file: отсутствует префикс ```write_file. Получено: '{header_line}'")
 
     match = re.search(r'path\s*=\s*"([^"]+)"', header_line)
@@ -160,18 +142,18 @@ def _parse_and_validate_filepath(header_line: str, project_root_dir: str) -> str
 
     return intended_file_abs
 
-def get_project_context(is_fast_mode, files_to_include_fully=None):
+def get_project_context(is_fast_mode, files_to_include_fully=None, outline_files=None):
     print(f"{Colors.CYAN}{Symbols.SPINNER} ЛОГ: Обновляю контекст проекта...{Colors.ENDC}", end='\r', flush=True)
     start_time = time.time()
     try:
         if is_fast_mode:
-            context_data = context_collector.gather_project_context(os.getcwd(), mode='full')
+            context_data = context_collector.gather_project_context(os.getcwd(), mode='full', outline_files=outline_files)
         else:
             mode = 'summarized'
             if files_to_include_fully:
                 print(f"{Colors.GREY}{Symbols.INFO}  Полное содержимое файлов: {len(files_to_include_fully)} шт.{Colors.ENDC}", flush=True)
             context_data = context_collector.gather_project_context(
-                os.getcwd(), mode=mode, full_content_files=files_to_include_fully
+                os.getcwd(), mode=mode, full_content_files=files_to_include_fully, outline_files=outline_files
             )
         duration = time.time() - start_time
         print(f"{Colors.OKGREEN}{Symbols.CHECK} ЛОГ: Контекст успешно обновлен за {duration:.2f} сек. Размер: {len(context_data)} символов.{' '*10}{Colors.ENDC}", flush=True)
@@ -214,39 +196,93 @@ def get_user_input():
     error_log = _read_multiline_input(log_prompt)
     return user_goal, error_log
 
-def parse_all_blocks(text: str) -> list[dict]:
+def parse_all_blocks(text: str, boundary: str | None = None) -> list[dict]:
     """
-    Находит и извлекает все блоки ```tag...``` из текста.
-    Специально обработан для 'write_file' с boundary, чтобы корректно извлекать
-    содержимое файла, даже если оно содержит вложенные ``` блоки.
+    Находит и извлекает все блоки ```tag...``` из текста (sloth_blocks.BlockParser).
+    'write_file'/'edit_file' с boundary читаются до строки boundary, поэтому содержимое
+    файла может содержать вложенные ``` блоки. Нарушения формата печатаются предупреждением.
     """
-    # Этот паттерн находит ```, тег, заголовок, затем (жадно) ВЕСЬ контент до финального ```
-    pattern = re.compile(r"```(\w+)([^\n]*)?\n(.*?)\n```", re.DOTALL)
-    
+    blocks, errors = sloth_blocks.parse_blocks(text, boundary)
+    for error in errors:
+        print(f"{Colors.WARNING}{Symbols.WARNING}  Блок {error['type']} (строка {error['line']}, смещение {error['offset']}): {error['message']}{Colors.ENDC}", flush=True)
+    return blocks
+
+def parse_structured_actions(text: str):
+    """
+    Разбирает ответ JSON-протокола {"actions": [...]} за один проход.
+    Возвращает список блоков в формате parse_all_blocks или None, если это не JSON-протокол.
+    """
+    raw = (text or "").strip()
+    # Некоторые модели всё же оборачивают JSON в ```json ... ```
+    fenced = re.match(r"^```(?:json)?\s*\n(.*)\n```$", raw, re.DOTALL)
+    if fenced:
+        raw = fenced.group(1)
+    if not raw.startswith("{"):
+        return None
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return None
+    actions = data.get("actions") if isinstance(data, dict) else None
+    if not isinstance(actions, list):
+        return None
     blocks = []
-    for match in pattern.finditer(text):
-        block_type = match.group(1).strip()
-        header_args = (match.group(2) or "").strip()
-        full_header = f"```{block_type} {header_args}".strip()
-        content = match.group(3)  # Сначала берем весь контент "как есть"
-
-        # НОВАЯ ЛОГИКА: Проверяем, есть ли в этом блоке boundary
-        if block_type == 'write_file':
-            boundary_match = re.search(r'boundary\s*=\s*"([^"]+)"', header_args)
-            if boundary_match:
-                boundary = boundary_match.group(1)
-                # Если контент заканчивается на boundary, отрезаем его
-                # Используем split, чтобы безопасно отделить контент от границы
-                if content.endswith(boundary):
-                    content = content.rsplit(boundary, 1)[0].rstrip('\r\n')
-
-        blocks.append({
-            "type": block_type,
-            "header": full_header,
-            "content": content
-        })
+    for action in actions:
+        if not isinstance(action, dict) or action.get("type") not in sloth_core.ACTION_TYPES:
+            continue
+        block_type = action["type"]
+        header = f"```{block_type}"
+        if block_type in ("write_file", "edit_file"):
+            header = f'```{block_type} path="{action.get("path") or ""}"'
+        blocks.append({"type": block_type, "header": header, "content": action.get("content") or ""})
     return blocks
 
+def parse_model_actions(text: str, structured: bool, boundary: str | None = None):
+    """Блоки действий из ответа: JSON-протокол (если ждали его) с откатом на parse_all_blocks.
+    Возвращает (blocks, used_structured)."""
+    if structured:
+        blocks = parse_structured_actions(text)
+        if blocks is not None:
+            return blocks, True
+    return parse_all_blocks(text, boundary), False
+
+PROTOCOL_STAT_KEYS = ("turns", "no_actions", "validation", "boundary", "json_fallback", "edit_failed", "mixed")
+
+def _protocol_bump(protocol_stats, mode, key):
+    entry = protocol_stats.setdefault(mode, dict.fromkeys(PROTOCOL_STAT_KEYS, 0))
+    entry[key] += 1
+
+def protocol_report(protocol_stats):
+    """Потраченные впустую итерации по протоколу ответа (blocks / json) — за запуск и накопительно."""
+    if not protocol_stats:
+        return
+    stats_path = os.path.join(sloth_core.VALIDATION_CACHE_DIR, "protocol_stats.json")
+    try:
+        with open(stats_path, "r", encoding="utf-8") as f:
+            totals = json.load(f)
+    except Exception:
+        totals = {}
+    print(f"\n{Colors.BOLD}{Colors.HEADER}--- ПРОТОКОЛ ОТВЕТА: ПОТЕРЯННЫЕ ИТЕРАЦИИ ---{Colors.ENDC}", flush=True)
+    for mode, entry in protocol_stats.items():
+        total = totals.setdefault(mode, dict.fromkeys(PROTOCOL_STAT_KEYS, 0))
+        for key in PROTOCOL_STAT_KEYS:
+            total[key] = total.get(key, 0) + entry[key]
+        wasted = entry['no_actions'] + entry['validation'] + entry['boundary'] + entry['edit_failed']
+        wasted_total = total['no_actions'] + total['validation'] + total['boundary'] + total['edit_failed']
+        print(
+            f"  Режим: {mode:<6} | ходов: {entry['turns']:<3} | впустую: {wasted} "
+            f"(нет действий: {entry['no_actions']}, валидация: {entry['validation']}, boundary: {entry['boundary']}, edit_file: {entry['edit_failed']}) | "
+            f"откат JSON→blocks: {entry['json_fallback']} | файлы+bash за один ход: {entry['mixed']} (всего {total['mixed']}) | "
+            f"всего запусков: {wasted_total}/{total['turns']} впустую",
+            flush=True,
+        )
+    try:
+        os.makedirs(sloth_core.VALIDATION_CACHE_DIR, exist_ok=True)
+        with open(stats_path, "w", encoding="utf-8") as f:
+            json.dump(totals, f, indent=2)
+    except Exception:
+        pass
+
 def update_history_with_attempt(history_file_path, goal, summary):
     try:
         with open(history_file_path, 'r+', encoding='utf-8') as f:
@@ -304,12 +340,55 @@ def cost_report(cost_log, total_cost):
         else:
             iteration = entry['iteration']
             print(f"  Фаза: {phase:<12} | Итерация: {iteration:<2} | Стоимость: ${cost:.6f}", flush=True)
+    # Проигравшие хедж-запросы тоже тарифицируются — показываем их отдельно и добавляем к итогу
+    hedge_entries = sloth_core.hedge_spend_entries()
+    if hedge_entries:
+        hedge_cost = sum(
+            calculate_cost(e['model'], e['input_tokens'], e['output_tokens'], e['cached_tokens'], e['thinking_tokens'])
+            for e in hedge_entries if e['billable']
+        )
+        unsettled = sum(1 for e in hedge_entries if not e['settled'])
+        note = f" (ещё не завершились: {unsettled}, вход оценён по длине промпта)" if unsettled else ""
+        print(f"  Хеджирование: доп. запросов: {len(hedge_entries)} | Стоимость: ${hedge_cost:.6f}{note}", flush=True)
+        total_cost += hedge_cost
     print(f"{Colors.BOLD}\n  Общая стоимость задачи: ${total_cost:.6f}{Colors.ENDC}", flush=True)
 
-def calculate_cost(model_name, input_tokens, output_tokens):
+def _cost_entry(phase, iteration, cost, duration, answer):
+    return {
+        "phase": phase, "iteration": iteration, "cost": cost, "duration": duration,
+        "model": answer.get("model"), "thinking_budget": answer.get("thinking_budget"),
+        "input_tokens": answer.get("input_tokens", 0), "output_tokens": answer.get("output_tokens", 0),
+    }
+
+def phase_report(cost_log):
+    """Сводка по фазам: число запросов, латентность (сред./p95), токены, стоимость и профиль."""
+    phases = {}
+    for entry in cost_log:
+        phases.setdefault(entry['phase'], []).append(entry)
+    if not phases:
+        return
+    print(f"\n{Colors.BOLD}{Colors.HEADER}--- ОТЧЕТ ПО ФАЗАМ (профили генерации) ---{Colors.ENDC}", flush=True)
+    for phase, entries in phases.items():
+        durations = [e.get('duration', 0.0) for e in entries]
+        models = ", ".join(sorted({str(e.get('model')) for e in entries if e.get('model')})) or "—"
+        budgets = sorted({e['thinking_budget'] for e in entries if e.get('thinking_budget') is not None})
+        budget_str = "/".join(str(b) for b in budgets) or "—"
+        print(
+            f"  Фаза: {phase:<14} | запросов: {len(entries):<2} | "
+            f"время: сред. {sum(durations) / len(durations):.2f} сек., p95 {sloth_health.percentile(durations, 95):.2f} сек. | "
+            f"токены: {sum(e.get('input_tokens', 0) for e in entries)}/{sum(e.get('output_tokens', 0) for e in entries)} | "
+            f"стоимость: ${sum(e['cost'] for e in entries):.6f} | модель: {models} | thinking: {budget_str}",
+            flush=True,
+        )
+
+def calculate_cost(model_name, input_tokens, output_tokens, cached_tokens=0, thinking_tokens=0):
     """
     Расчёт стоимости запроса.
 
+    - input_tokens включает cached_tokens: кэшированная часть идёт по цене входа,
+      умноженной на sloth_core.CACHED_INPUT_PRICE_FACTOR.
+    - thinking_tokens (размышления) тарифицируются по цене выхода.
+
     - Если заданы ENV-переменные, используется OVERRIDE со ставками за 1000 токенов:
         SLOTH_COST_IN_RATE, SLOTH_COST_OUT_RATE.
       Это поведение сохранено для обратной совместимости.
@@ -325,13 +404,17 @@ def calculate_cost(model_name, input_tokens, output_tokens):
 
     try:
         in_tokens = float(input_tokens or 0)
-        out_tokens = float(output_tokens or 0)
+        out_tokens = float(output_tokens or 0) + float(thinking_tokens or 0)
+        cached = min(float(cached_tokens or 0), in_tokens)
     except Exception:
-        in_tokens, out_tokens = 0.0, 0.0
+        in_tokens, out_tokens, cached = 0.0, 0.0, 0.0
+    cached_factor = getattr(sloth_core, "CACHED_INPUT_PRICE_FACTOR", 1.0)
+    # Эквивалент «полных» входных токенов с учётом скидки на кэш
+    billed_in = (in_tokens - cached) + cached * cached_factor
 
     if in_rate > 0 or out_rate > 0:
         # ENV-override трактуем КАК ставку за 1,000 токенов (исторически)
-        return (in_tokens / 1000.0) * in_rate + (out_tokens / 1000.0) * out_rate
+        return (billed_in / 1000.0) * in_rate + (out_tokens / 1000.0) * out_rate
 
     # 2) Если ENV не задан — используем таблицу тарифов из sloth_core.MODEL_PRICING (по tiers)
     pricing = getattr(sloth_core, "MODEL_PRICING", {}) or {}
@@ -376,7 +459,89 @@ def calculate_cost(model_name, input_tokens, output_tokens):
     out_price_per_1k = pick_tier_price(((mp.get("output") or {}).get("tiers") or []), out_tokens)
 
     # Цены из MODEL_PRICING считаем за 1,000,000 токенов (единица прайсинга от Google)
-    return (in_tokens / 1_000_000.0) * in_price_per_1k + (out_tokens / 1_000_000.0) * out_price_per_1k
+    return (billed_in / 1_000_000.0) * in_price_per_1k + (out_tokens / 1_000_000.0) * out_price_per_1k
+
+def _usage_summary(answer):
+    text = f"Вход: {answer.get('input_tokens', 0)} т."
+    if answer.get('cached_tokens'):
+        text += f" (кэш: {answer['cached_tokens']} т.)"
+    text += f", Выход: {answer.get('output_tokens', 0)} т."
+    if answer.get('thinking_tokens'):
+        text += f", Размышления: {answer['thinking_tokens']} т."
+    return text
+
+def answer_cost(answer, default_model):
+    """Стоимость ответа send_request_to_model с учётом фактической модели и бэкенда."""
+    if not answer.get("billable", True):
+        return 0.0
+    return calculate_cost(
+        answer.get("model") or default_model, answer.get("input_tokens", 0), answer.get("output_tokens", 0),
+        answer.get("cached_tokens", 0), answer.get("thinking_tokens", 0),
+    )
+
+def _files_mentioned_in(text, rel_paths):
+    """Файлы, упомянутые в тексте задачи/ошибки (по относительному пути или имени файла)."""
+    if not text:
+        return set()
+    return {p for p in rel_paths if p in text or os.path.basename(p) in text}
+
+def preflight_shape_prompt(prompt, build_prompt, is_fast_mode, files_to_include_fully, model_name, phase,
+                           changed_files, mention_text, run_log_file_path):
+    """
+    Предварительный подсчёт токенов промпта и ужатие контекста под границу тарифа.
+
+    Если промпт пересекает границу ценового тарифа модели (например, 200k токенов),
+    файлы с наименьшим приоритетом переводятся из полного содержимого в outline —
+    сначала те, что дают наибольшую экономию. Недавно изменённые файлы (changed_files)
+    и файлы, упомянутые в задаче или ошибке (mention_text), не трогаем. Возвращает (prompt, context_duration).
+    """
+    if not sloth_core.PREFLIGHT_ENABLED or not prompt:
+        return prompt, 0.0
+    tokens, source = sloth_core.preflight_count_tokens(prompt, model_name, phase=phase)
+    boundary = sloth_core.tier_boundary_tokens(model_name)
+    if not boundary:
+        return prompt, 0.0
+    limit = int(boundary * sloth_core.PREFLIGHT_SAFETY_MARGIN)
+    if tokens <= limit:
+        print(f"{Colors.GREY}{Symbols.INFO}  Preflight: {tokens} т. ({source}) — ниже границы тарифа {boundary} т.{Colors.ENDC}", flush=True)
+        return prompt, 0.0
+
+    root = os.getcwd()
+    all_files = context_collector.list_context_files(root)
+    protected_files = {os.path.normpath(p) for p in (changed_files or set())}
+    protected_files |= _files_mentioned_in(mention_text, all_files)
+    candidates = all_files if is_fast_mode else list(files_to_include_fully or [])
+    candidates = [os.path.normpath(p) for p in candidates if os.path.normpath(p) not in protected_files]
+    savings = context_collector.estimate_outline_savings(root, candidates)
+    needed = tokens - limit
+    demoted, planned = [], 0
+    for rel_path, saved in sorted(savings.items(), key=lambda kv: kv[1], reverse=True):
+        if planned >= needed:
+            break
+        demoted.append(rel_path)
+        planned += saved
+    if not demoted:
+        print(f"{Colors.WARNING}{Symbols.WARNING}  Preflight: {tokens} т. ({source}) выше границы тарифа {boundary} т., но понижать нечего — отправляю как есть.{Colors.ENDC}", flush=True)
+        return prompt, 0.0
+
+    project_context, duration = get_project_context(is_fast_mode, files_to_include_fully, outline_files=demoted)
+    if not project_context:
+        return prompt, duration
+    shaped_prompt = build_prompt(project_context)
+    new_tokens, new_source = sloth_core.preflight_count_tokens(shaped_prompt, model_name, phase=phase)
+    expected_out = sloth_core.PREFLIGHT_EXPECTED_OUTPUT_TOKENS
+    saved_cost = calculate_cost(model_name, tokens, expected_out) - calculate_cost(model_name, new_tokens, expected_out)
+    summary = (
+        f"Граница тарифа: {boundary} т. (запас {sloth_core.PREFLIGHT_SAFETY_MARGIN:.0%}) | "
+        f"было: {tokens} т. ({source}) → стало: {new_tokens} т. ({new_source}) | "
+        f"экономия: {tokens - new_tokens} т., ~${saved_cost:.4f} на запрос\n"
+        f"В outline переведены ({len(demoted)}): " + ", ".join(demoted)
+    )
+    print(f"{Colors.CYAN}✂️  ЛОГ: Preflight ужал контекст. {summary}{Colors.ENDC}", flush=True)
+    _log_run(run_log_file_path, f"PREFLIGHT (Состояние: {phase})", summary)
+    if new_tokens > limit:
+        print(f"{Colors.WARNING}{Symbols.WARNING}  Preflight: промпт всё ещё выше границы тарифа ({new_tokens} т.).{Colors.ENDC}", flush=True)
+    return shaped_prompt, duration
 
 def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_file_path, verify_timeout_seconds=15, log_trim_limit=20000):
     total_start_time = time.time()
@@ -395,7 +560,33 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
         state = "INITIAL_CODING"
 
     iteration_count = 1
-    attempt_history, final_message = [], ""
+    final_message = ""
+
+    def summarize_history(digest):
+        """Опциональное резюме старых попыток дешёвой моделью (history.llm_summary)."""
+        nonlocal total_cost
+        model_instance, active_service = sloth_core.get_active_service_details()
+        profile = sloth_core.resolve_generation_profile("CONTEXT_PREP")
+        start_model_time = time.time()
+        answer = sloth_core.send_request_to_model(
+            model_instance, active_service, sloth_core.get_history_summary_prompt(digest, initial_task),
+            iteration_count, phase="CONTEXT_PREP", profile=profile,
+        )
+        model_duration = time.time() - start_model_time
+        timings['model'] += model_duration
+        if not answer:
+            return None
+        cost = answer_cost(answer, profile["model"])
+        total_cost += cost
+        cost_log.append(_cost_entry("HISTORY_SUMMARY", iteration_count, cost, model_duration, answer))
+        return answer["text"]
+
+    # Старые записи сворачиваются в дайджест, в промпт идут только последние history.keep_last
+    attempt_history = sloth_history.AttemptHistory(summarizer=summarize_history)
+    # Прежнее содержимое файлов по итерациям — для --rollback без ходов модели
+    snapshot_store = sloth_snapshots.SnapshotStore(os.path.join(os.path.dirname(history_file_path), "snapshots"), os.getcwd())
+    # Утечки протокола (SLOTH_BOUNDARY, заголовки блоков, маркеры хунков) ищем только в изменённых файлах
+    leak_scanner = sloth_leaks.LeakScanner(os.getcwd())
     BOUNDARY_TOKEN = f"SLOTH_BOUNDARY_{uuid.uuid4().hex}"
 
     # Variables to pass data between states
@@ -428,6 +619,16 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
     # Детектор повторяющихся правок тех же файлов
     prev_changed_files = None
     repeat_same_files_count = 0
+    failure_streak, streak_iteration = 0, None
+    no_answer_streak = 0
+    # Каскад моделей: быстрая модель first, эскалация на сильную при неудаче
+    cascade = sloth_cascade.ModelCascade(sloth_core.CONTEXT_PREP_MODEL_NAME)
+    turn_tier, force_strong = sloth_cascade.TIER_STRONG, False
+    # Потерянные итерации по протоколу ответа: {"blocks"|"json": {turns, no_actions, ...}}
+    protocol_stats = {}
+    prompt_profiler = sloth_telemetry.PromptProfiler()
+    # Чат-сессия (session.enabled): после якорного хода — только дельты
+    chat_session = sloth_session.ChatSession()
 
     while iteration_count <= MAX_ITERATIONS and state != "DONE":
         model_instance, active_service = sloth_core.get_active_service_details()
@@ -443,13 +644,13 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
                 print(f"{Colors.OKGREEN}{Symbols.CHECK} Подготовлено батчей: {len(batches)}{' '*10}{Colors.ENDC}", flush=True)
 
                 aggregated_files = set()
-                override_model = getattr(sloth_core, 'CONTEXT_PREP_MODEL_NAME', None) or "gemini-2.5-flash"
+                profile = sloth_core.resolve_generation_profile("CONTEXT_PREP")
                 for bi, batch_text in enumerate(batches, start=1):
                     prompt = sloth_core.get_context_prep_prompt(batch_text, initial_task, BOUNDARY_TOKEN)
                     _log_run(run_log_file_path, f"ЗАПРОС (Состояние: CONTEXT_PREP, Батч: {bi})", prompt)
                     print(f"{Colors.CYAN}{Symbols.SPINNER} Обрабатываю батч {bi}/{len(batches)}...{Colors.ENDC}", end='\r', flush=True)
                     start_model_time = time.time()
-                    answer = sloth_core.send_request_to_model(model_instance, active_service, prompt, iteration_count=0, model_name_override=override_model)
+                    answer = sloth_core.send_request_to_model(model_instance, active_service, prompt, iteration_count=0, phase="CONTEXT_PREP", profile=profile)
                     model_duration = time.time() - start_model_time
                     timings['model'] += model_duration
                     if not answer:
@@ -457,12 +658,12 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
                         continue
                     _log_run(run_log_file_path, f"ОТВЕТ (Состояние: CONTEXT_PREP, Батч: {bi})", answer['text'])
 
-                    # Отчёт о стоимости для override-модели
+                    # Отчёт о стоимости для модели профиля
                     try:
-                        cost = calculate_cost(override_model, answer["input_tokens"], answer["output_tokens"])
+                        cost = answer_cost(answer, profile["model"])
                         total_cost += cost
-                        cost_log.append({"phase": "CONTEXT_PREP", "iteration": bi, "cost": cost})
-                        print(f"{Colors.GREY}📊 CONTEXT_PREP[{bi}]: Вход: {answer['input_tokens']} т., Выход: {answer['output_tokens']} т. | Время: {model_duration:.2f} сек. | Стоимость: ~${cost:.6f}{' '*10}{Colors.ENDC}", flush=True)
+                        cost_log.append(_cost_entry("CONTEXT_PREP", bi, cost, model_duration, answer))
+                        print(f"{Colors.GREY}📊 CONTEXT_PREP[{bi}]: {_usage_summary(answer)} | Время: {model_duration:.2f} сек. | Стоимость: ~${cost:.6f}{' '*10}{Colors.ENDC}", flush=True)
                     except Exception:
                         pass
 
@@ -499,6 +700,7 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
 
         # --- 1. GENERATE PROMPT BASED ON STATE ---
         current_prompt = None
+        structured = False
         log_iter = iteration_count if state != "PLANNING" else 0
         
         if state == "PLANNING":
@@ -506,63 +708,120 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
             # На этапе планирования учитываем жадно отобранные файлы из CONTEXT_PREP (если есть)
             project_context, duration = get_project_context(is_fast_mode=False, files_to_include_fully=files_to_include_fully)
             timings['context'] += duration
+            build_prompt = lambda ctx: sloth_core.get_clarification_and_planning_prompt(ctx, initial_task, boundary=BOUNDARY_TOKEN)
             if project_context:
-                current_prompt = sloth_core.get_clarification_and_planning_prompt(project_context, initial_task, boundary=BOUNDARY_TOKEN)
+                current_prompt = build_prompt(project_context)
         else: # Any execution state
             print(f"\n{Colors.BOLD}{Colors.HEADER}{Symbols.ROCKET} --- ЭТАП: ИСПОЛНЕНИЕ ({state}) | ИТЕРАЦИЯ {iteration_count}/{MAX_ITERATIONS} ---{Colors.ENDC}", flush=True)
+            structured = sloth_core.structured_output_enabled(state)
             project_context, duration = get_project_context(is_fast_mode, files_to_include_fully)
             timings['context'] += duration
+            if state == "INITIAL_CODING":
+                fix_history = load_fix_history(history_file_path) if is_fix_mode else None
+                build_prompt = lambda ctx: sloth_core.get_initial_prompt(ctx, initial_task, fix_history, BOUNDARY_TOKEN, structured)
+            elif state == "REVIEWING":
+                build_prompt = lambda ctx: sloth_core.get_review_prompt(ctx, initial_task, iteration_count, attempt_history, BOUNDARY_TOKEN, structured)
+            elif state == "FIXING_ERROR":
+                build_prompt = lambda ctx: sloth_core.get_error_fixing_prompt(failed_command, error_message, initial_task, ctx, iteration_count, attempt_history, BOUNDARY_TOKEN, structured)
+            elif state == "ANALYZING_LOGS":
+                build_prompt = lambda ctx: sloth_core.get_log_analysis_prompt(ctx, initial_task, attempt_history, logs_collected, BOUNDARY_TOKEN, structured)
             if project_context:
-                if state == "INITIAL_CODING":
-                    fix_history = load_fix_history(history_file_path) if is_fix_mode else None
-                    current_prompt = sloth_core.get_initial_prompt(project_context, initial_task, fix_history, BOUNDARY_TOKEN)
-                elif state == "REVIEWING":
-                    current_prompt = sloth_core.get_review_prompt(project_context, initial_task, iteration_count, attempt_history, BOUNDARY_TOKEN)
-                elif state == "FIXING_ERROR":
-                    current_prompt = sloth_core.get_error_fixing_prompt(failed_command, error_message, initial_task, project_context, iteration_count, attempt_history, BOUNDARY_TOKEN)
-                elif state == "ANALYZING_LOGS":
-                    current_prompt = sloth_core.get_log_analysis_prompt(project_context, initial_task, attempt_history, logs_collected, BOUNDARY_TOKEN)
+                current_prompt = build_prompt(project_context)
             
         if not project_context:
             final_message = f"{Colors.FAIL}КРИТИЧЕСКАЯ ОШИБКА: Не удалось получить контекст проекта.{Colors.ENDC}"
             break
-        
+
+        # Профиль генерации фазы (profiles.{STATE}); adaptive-правила учитывают серию неудач
+        if streak_iteration != iteration_count:
+            failure_streak = failure_streak + 1 if state in ("FIXING_ERROR", "ANALYZING_LOGS") else 0
+            streak_iteration = iteration_count
+        profile = sloth_core.resolve_generation_profile(state, failures=failure_streak, iteration=iteration_count)
+        if profile["rules_applied"]:
+            print(f"{Colors.CYAN}📈 ЛОГ: Профиль {state} усилен adaptive-правилами ({profile['rules_applied']}) после {failure_streak} неудач подряд: model={profile['model']}, {profile['options']}.{Colors.ENDC}", flush=True)
+        turn_tier = cascade.choose(state, failure_streak, force_strong)
+        if state in cascade.phases:
+            force_strong = False
+        if turn_tier == sloth_cascade.TIER_FAST:
+            cascade.record_attempt(state)
+            profile = dict(profile, model=cascade.fast_model)
+            print(f"{Colors.CYAN}⚡ ЛОГ: Каскад: ход {state} делает быстрая модель {cascade.fast_model}.{Colors.ENDC}", flush=True)
+        if structured:
+            profile = dict(profile, options={**profile["options"], **sloth_core.STRUCTURED_OUTPUT_OPTIONS})
+
+        # --- Чат-сессия: ход дельтой поверх уже отправленного контекста ---
+        # Ходы быстрой модели каскада идут мимо сессии (иначе каждая смена модели — пересборка)
+        in_session = chat_session.covers(state) and turn_tier != sloth_cascade.TIER_FAST
+        session_delta = in_session and chat_session.can_continue(state, profile["model"])
+        session_logs = logs_collected
+        if session_delta:
+            session_logs = chat_session.unseen_logs(logs_collected)
+            session_prompt = sloth_core.get_session_turn_prompt(
+                state, initial_task, iteration_count, list(attempt_history[chat_session.history_seen:]),
+                context_collector.format_files(os.getcwd(), chat_session.pending_files),
+                failed_command, error_message, session_logs,
+            )
+            current_prompt = chat_session.conversation(session_prompt)
+            print(f"{Colors.GREY}💬 Сессия: ход дельтой (~{sloth_core.estimate_prompt_tokens(session_prompt)} т. нового, "
+                  f"в диалоге {len(chat_session.turns) // 2} ходов).{Colors.ENDC}", flush=True)
+        else:
+            # --- Preflight: точный подсчёт токенов и ужатие под границу тарифа ---
+            current_prompt, duration = preflight_shape_prompt(
+                current_prompt, build_prompt, is_fast_mode, files_to_include_fully,
+                profile["model"], state, prev_changed_files,
+                "\n".join(filter(None, [initial_task, error_message, failed_command])), run_log_file_path,
+            )
+            timings['context'] += duration
+            session_prompt = current_prompt
+
+        composition = prompt_profiler.record(state, log_iter, sloth_core.prompt_breakdown(current_prompt))
+        print(f"{Colors.GREY}🧩 Состав промпта: {composition}{Colors.ENDC}", flush=True)
+        _log_run(run_log_file_path, f"СОСТАВ ПРОМПТА (Состояние: {state}, Итерация: {log_iter})", composition)
         _log_run(run_log_file_path, f"ЗАПРОС (Состояние: {state}, Итерация: {log_iter})", current_prompt)
         # Лог подготовки запроса печатается в sloth_core.send_request_to_model(); здесь не дублируем
         print(f"{Colors.CYAN}{Symbols.SPINNER} Думаю...{Colors.ENDC}", end='\r', flush=True)
         start_model_time = time.time()
         
         # --- 2. SEND REQUEST TO MODEL ---
-        # Для стадии анализа логов используем более дешёвую быстромодель (Flash)
-        override_model = sloth_core.CONTEXT_PREP_MODEL_NAME if state == "ANALYZING_LOGS" else None
         answer_data = sloth_core.send_request_to_model(
             model_instance,
             active_service,
             current_prompt,
             log_iter,
-            model_name_override=override_model,
+            phase=state,
+            profile=profile,
         )
         model_duration = time.time() - start_model_time
         timings['model'] += model_duration
 
         if not answer_data:
-            print(f"{Colors.WARNING}🔄 ЛОГ: Ответ от модели не получен, пробую снова...{Colors.ENDC}", flush=True)
-            time.sleep(5)
+            no_answer_streak += 1
+            if no_answer_streak > sloth_core.API_MAX_RETRIES:
+                final_message = f"{Colors.FAIL}КРИТИЧЕСКАЯ ОШИБКА: Модель не ответила {no_answer_streak} раз подряд (ошибки или дедлайн).{Colors.ENDC}"
+                break
+            retry_delay = min(sloth_core.API_RETRY_MAX_BACKOFF_SECONDS,
+                              sloth_core.API_RETRY_BACKOFF_SECONDS * 2 ** (no_answer_streak - 1)) * random.uniform(0.8, 1.2)
+            print(f"{Colors.WARNING}🔄 ЛОГ: Ответ от модели не получен, повтор {no_answer_streak}/{sloth_core.API_MAX_RETRIES} через {retry_delay:.0f} сек...{Colors.ENDC}", flush=True)
+            time.sleep(retry_delay)
             continue
+        no_answer_streak = 0
         
         answer_text = answer_data["text"]
         _log_run(run_log_file_path, f"ОТВЕТ (Состояние: {state}, Итерация: {log_iter})", answer_text)
+        if in_session:
+            chat_session.record(session_prompt, answer_text, profile["model"], len(attempt_history),
+                                delta=session_delta, logs=session_logs)
 
-        cost = calculate_cost(sloth_core.MODEL_NAME, answer_data["input_tokens"], answer_data["output_tokens"])
+        cost = answer_cost(answer_data, profile["model"])
         total_cost += cost
-        cost_log.append({"phase": state, "iteration": log_iter, "cost": cost})
-        print(f"{Colors.GREY}📊 Статистика: Вход: {answer_data['input_tokens']} т., Выход: {answer_data['output_tokens']} т. | Время: {model_duration:.2f} сек. | Стоимость: ~${cost:.6f}{' '*10}{Colors.ENDC}", flush=True)
+        cost_log.append(_cost_entry(state, log_iter, cost, model_duration, answer_data))
+        print(f"{Colors.GREY}📊 Статистика: {_usage_summary(answer_data)} | Время: {model_duration:.2f} сек. | Стоимость: ~${cost:.6f}{' '*10}{Colors.ENDC}", flush=True)
 
         # --- 3. PROCESS RESPONSE AND DETERMINE NEXT STATE ---
         # --- НОВЫЙ, НАДЕЖНЫЙ КОД ---
         if state == "PLANNING":
             # Парсим блоки планирования: теперь ожидаем только clarification ИЛИ plan
-            all_plan_blocks = parse_all_blocks(answer_text)
+            all_plan_blocks = parse_all_blocks(answer_text, BOUNDARY_TOKEN)
             clarification_block = next((b for b in all_plan_blocks if b['type'] == 'clarification'), None)
 
             if clarification_block:
@@ -594,62 +853,157 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
                 time.sleep(5)
                 state = "PLANNING"
         else: # Любое состояние исполнения
-            all_blocks = parse_all_blocks(answer_text)
+            all_blocks, used_structured = parse_model_actions(answer_text, structured, BOUNDARY_TOKEN)
+            turn_mode = "json" if structured else "blocks"
+            _protocol_bump(protocol_stats, turn_mode, "turns")
+            if structured and not used_structured:
+                print(f"{Colors.WARNING}{Symbols.WARNING}  Ответ не в JSON-протоколе — разбираю как блоки.{Colors.ENDC}", flush=True)
+                _protocol_bump(protocol_stats, turn_mode, "json_fallback")
 
             strategy_description = next((b['content'] for b in all_blocks if b['type'] == 'summary'), "Стратегия не описана")
-            commands_to_run_block = next((b for b in all_blocks if b['type'] == 'bash'), None)
-            write_file_blocks = [b for b in all_blocks if b['type'] == 'write_file']
+            # Действия ответа выполняются по порядку: файлы, затем блоки bash, затем verify_run
+            command_blocks = [b for b in all_blocks if b['type'] == 'bash']
+            # write_file и edit_file применяются в порядке ответа
+            write_file_blocks = [b for b in all_blocks if b['type'] in ('write_file', 'edit_file')]
             manual_block = next((b for b in all_blocks if b['type'] == 'manual'), None)
             verify_run_present = any(b['type'] == 'verify_run' for b in all_blocks)
             done_summary_block = next((b for b in all_blocks if b['type'] == 'done_summary'), None)
             is_done = done_summary_block is not None
 
-            action_taken, success = False, False
+            # Каскад: ответ быстрой модели без действий или с невалидными путями — переспрашиваем сильную
+            if turn_tier == sloth_cascade.TIER_FAST:
+                escalation_reason = None
+                if not (write_file_blocks or command_blocks or manual_block or is_done):
+                    escalation_reason = "parse"
+                else:
+                    for block in write_file_blocks:
+                        try:
+                            _parse_and_validate_filepath(block['header'], os.getcwd())
+                        except ValueError:
+                            escalation_reason = "validation"
+                            break
+                if escalation_reason:
+                    _protocol_bump(protocol_stats, turn_mode, "no_actions" if escalation_reason == "parse" else escalation_reason)
+                    cascade.record_escalation(state, escalation_reason)
+                    force_strong = True
+                    continue
+
+            action_taken, success, actions_failed = False, False, False
             iteration_changed_files = set()
             iteration_created_paths = set()
+            iteration_deleted_paths = set()
+            iteration_noop_files = set()
+            iteration_command_results = []
 
             if write_file_blocks:
                 action_taken = True
-                for block in write_file_blocks:
-                    try:
+                # Этап 1: все блоки валидируются и применяются в памяти; ошибка любого блока — дерево не тронуто
+                staged_contents = {}
+                # Блок, который сейчас разбирается; после цикла — None: ошибки записи относятся к пути из исключения
+                current_block = None
+                try:
+                    for block in write_file_blocks:
+                        current_block = block
                         safe_filepath = _parse_and_validate_filepath(block['header'], os.getcwd())
                         relative_path_for_display = os.path.relpath(safe_filepath, os.getcwd())
-                        
+
+                        if block['type'] == 'edit_file':
+                            # Несколько правок одного файла в ответе применяются поверх друг друга
+                            original = staged_contents.get(relative_path_for_display)
+                            if original is None:
+                                original = ""
+                                if os.path.exists(safe_filepath):
+                                    with open(safe_filepath, "r", encoding="utf-8", newline="") as f:
+                                        original = f.read()
+                            new_content, hunk_count = sloth_edits.apply_edit(original, block['content'])
+                            print(f"\n{Colors.OKBLUE}✂️  Правлю файл: {relative_path_for_display} (хунков: {hunk_count}){Colors.ENDC}", flush=True)
+                            staged_contents[relative_path_for_display] = new_content
+                            continue
+
                         # --- ДОБАВЛЕНА ПРОВЕРКА ---
                         # Защита от случайного стирания файла
                         if not block['content'] and os.path.exists(safe_filepath):
                             print(f"{Colors.WARNING}⚠️  ПРЕДУПРЕЖДЕНИЕ: Модель предложила очистить существующий файл {relative_path_for_display}. Действие пропущено.{Colors.ENDC}", flush=True)
                             continue # Переходим к следующему файлу, не выполняя запись
                         # --- КОНЕЦ ПРОВЕРКИ ---
-                        
+
                         print(f"\n{Colors.OKBLUE}📝 Перезаписываю файл: {relative_path_for_display}{Colors.ENDC}", flush=True)
-                        existed_before = os.path.exists(safe_filepath)
-                        os.makedirs(os.path.dirname(safe_filepath), exist_ok=True)
-                        with open(safe_filepath, "w", encoding="utf-8", newline="") as f:
-                            f.write(block['content'])
-
-                        print(f"{Colors.OKGREEN}✅ Файл успешно перезаписан: {relative_path_for_display}{Colors.ENDC}", flush=True)
-                        success = True
-                        iteration_changed_files.add(relative_path_for_display)
-                        if not existed_before:
-                            iteration_created_paths.add(relative_path_for_display)
-                    except ValueError as e:
-                        print(f"{Colors.FAIL}❌ ОШИБКА ВАЛИДАЦИИ: {e}{Colors.ENDC}", flush=True)
-                        success, failed_command, error_message = False, f"write_file ({block['header']})", str(e)
-                        break
-                    except Exception as e:
-                        print(f"{Colors.FAIL}❌ ОШИБКА при записи файла '{block['header']}': {e}{Colors.ENDC}", flush=True)
-                        success, failed_command, error_message = False, f"write_file ({block['header']})", str(e)
-                        break
+                        staged_contents[relative_path_for_display] = block['content']
+                    current_block = None
+
+                    # Файлы с тем же содержимым не трогаем: mtime не меняется, watcher-ы не срабатывают
+                    changed_contents = {p: text for p, text in staged_contents.items()
+                                        if not sloth_snapshots.is_unchanged(p, text)}
+                    for relative_path_for_display in (p for p in staged_contents if p not in changed_contents):
+                        print(f"{Colors.GREY}⏸️  Без изменений (содержимое совпадает): {relative_path_for_display}{Colors.ENDC}", flush=True)
+                        iteration_noop_files.add(relative_path_for_display)
+
+                    # Этап 2: временные файлы + снимок прежнего содержимого + атомарная замена группой
+                    created_before = {p for p in changed_contents if not os.path.exists(p)}
+                    snapshot_id = sloth_snapshots.write_files_atomically(
+                        os.getcwd(), changed_contents, snapshot_store, iteration_count)
+                    for relative_path_for_display in changed_contents:
+                        print(f"{Colors.OKGREEN}✅ Файл записан: {relative_path_for_display}{Colors.ENDC}", flush=True)
+                    if snapshot_id:
+                        print(f"{Colors.GREY}📸 Снимок #{snapshot_id} (откат: --rollback {snapshot_id}){Colors.ENDC}", flush=True)
+                    success = bool(staged_contents)
+                    iteration_changed_files |= set(changed_contents)
+                    iteration_created_paths |= created_before
+                except sloth_edits.EditError as e:
+                    print(f"{Colors.FAIL}❌ ПРАВКА НЕ ПРИМЕНИЛАСЬ ({current_block['header']}): {e}{Colors.ENDC}", flush=True)
+                    _protocol_bump(protocol_stats, turn_mode, "edit_failed")
+                    success, actions_failed, failed_command = False, True, f"edit_file ({current_block['header']})"
+                    error_message = f"{e}\nНи один файл этого ответа не изменён. Повтори правку, скопировав SEARCH из файла дословно, или пришли write_file целиком."
+                except ValueError as e:
+                    print(f"{Colors.FAIL}❌ ОШИБКА ВАЛИДАЦИИ: {e}{Colors.ENDC}", flush=True)
+                    _protocol_bump(protocol_stats, turn_mode, "validation")
+                    success, actions_failed, failed_command = False, True, _write_failure_target(current_block, e)
+                    error_message = f"{e}\nНи один файл этого ответа не изменён."
+                except Exception as e:
+                    failed_command = _write_failure_target(current_block, e)
+                    print(f"{Colors.FAIL}❌ ОШИБКА при записи файлов ({failed_command}): {e}{Colors.ENDC}", flush=True)
+                    success, actions_failed, error_message = False, True, str(e)
             
-            elif commands_to_run_block:
+            if command_blocks and not actions_failed:
                 action_taken = True
-                print(f"\n{Colors.OKBLUE}🔧 Выполняю shell-команды...{Colors.ENDC}", flush=True)
                 start_cmd_time = time.time()
-                success, failed_command, error_message, changed_files, created_paths = sloth_runner.execute_commands(commands_to_run_block['content'])
-                iteration_changed_files |= set(changed_files or set())
-                iteration_created_paths |= set(created_paths or set())
+                for index, command_block in enumerate(command_blocks, start=1):
+                    position = f" ({index}/{len(command_blocks)})" if len(command_blocks) > 1 else ""
+                    print(f"\n{Colors.OKBLUE}🔧 Выполняю shell-команды{position}...{Colors.ENDC}", flush=True)
+                    # bash меняет файлы сам: прежнее содержимое упомянутых файлов — в снимок до запуска
+                    bash_snapshot_id = snapshot_store.capture(
+                        iteration_count, [p for p in sloth_runner.referenced_paths(command_block['content'])
+                                          if os.path.isfile(p)], label="bash")
+                    success, failed_command, error_message, changed_files, created_paths, deleted_paths, command_results = sloth_runner.execute_commands(
+                        command_block['content'], log_path=run_log_file_path)
+                    iteration_command_results += command_results
+                    bash_snapshot_id = snapshot_store.mark_created(bash_snapshot_id, iteration_count, created_paths or ())
+                    # Изменённые/удалённые пути без pre-image откат не вернёт — фиксируем это в снимке
+                    bash_snapshot_id, unrestorable = snapshot_store.mark_unrestorable(
+                        bash_snapshot_id, iteration_count, set(changed_files or ()) | set(deleted_paths or ()))
+                    if bash_snapshot_id:
+                        print(f"{Colors.GREY}📸 Снимок #{bash_snapshot_id} (откат: --rollback {bash_snapshot_id}){Colors.ENDC}", flush=True)
+                    if unrestorable:
+                        shown = ", ".join(unrestorable[:10]) + (f" … (+{len(unrestorable) - 10})" if len(unrestorable) > 10 else "")
+                        print(f"{Colors.WARNING}⚠️  Без прежнего содержимого в снимке (откат их не вернёт): {shown}{Colors.ENDC}", flush=True)
+                    iteration_changed_files |= set(changed_files or set())
+                    iteration_created_paths |= set(created_paths or set())
+                    iteration_deleted_paths |= set(deleted_paths or set())
+                    if not success:
+                        # Остальные блоки не запускаем: модель получит ровно упавшую команду
+                        actions_failed = True
+                        if position:
+                            failed_command = f"bash{position}: {failed_command}"
+                        break
                 timings['commands'] += time.time() - start_cmd_time
+                if write_file_blocks and success:
+                    # Файлы и команды в одном проходе — без лишнего обращения к модели
+                    _protocol_bump(protocol_stats, turn_mode, "mixed")
+
+            # До любых переходов: изменённые файлы попадут в ближайший скан утечек и в дельту сессии,
+            # на какой бы путь ни ушла итерация
+            leak_scanner.note_changes(iteration_changed_files | iteration_created_paths)
+            chat_session.note_changes(iteration_changed_files | iteration_created_paths | iteration_deleted_paths)
 
             # --- Если модель попросила ручные действия, обрабатываем их НЕМЕДЛЕННО ---
             if manual_block and not is_done:
@@ -677,8 +1031,16 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
             history_entry = f"**Итерация {iteration_count} ({state}):**\n**Стратегия:** {strategy_description}\n"
             if iteration_changed_files or iteration_created_paths:
                 changed_list = ", ".join(sorted(iteration_changed_files)) or "—"
-                created_list = ", ".join(sorted(iteration_created_paths)) or "—"
+                created_list = ", ".join(sorted(sloth_tree.collapse(iteration_created_paths))) or "—"
                 history_entry += f"**Изменены файлы:** {changed_list}\n**Созданы пути:** {created_list}\n"
+            if iteration_deleted_paths:
+                history_entry += f"**Удалены пути:** {', '.join(sorted(sloth_tree.collapse(iteration_deleted_paths)))}\n"
+            if iteration_noop_files:
+                history_entry += f"**Без изменений (содержимое совпало):** {', '.join(sorted(iteration_noop_files))}\n"
+            if iteration_command_results:
+                history_entry += "**Команды:** " + "; ".join(
+                    f"`{r['command']}` → {'таймаут' if r['timed_out'] else 'код ' + str(r['exit_code'])}, {r['duration']:.1f} с"
+                    for r in iteration_command_results) + "\n"
 
             # Простая аннотация повторяющихся правок тех же файлов
             if prev_changed_files is not None and iteration_changed_files == prev_changed_files and iteration_changed_files:
@@ -694,11 +1056,12 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
                 print(f"{Colors.WARNING}{Symbols.WARNING}  Обнаружен повтор правок одних и тех же файлов (>=3 подряд). Форсирую верификацию и анализ логов.{Colors.ENDC}", flush=True)
                 if verify_command is not None:
                     # Быстрый скан на служебные маркеры перед запуском verify
-                    findings = _scan_project_for_token(os.getcwd(), "SLOTH_BOUNDARY")
+                    findings = leak_scanner.scan()
                     if findings:
-                        msg = "Обнаружены служебные маркеры SLOTH_BOUNDARY в коде. Требуется чистка.\n" + "\n".join(findings[:20])
+                        msg = "Обнаружены служебные маркеры протокола в коде (boundary, заголовки блоков, маркеры хунков). Требуется чистка.\n" + "\n".join(findings[:20])
                         _log_run(run_log_file_path, "SLOTH_BOUNDARY FINDINGS (FORCED)", msg)
                         failed_command, error_message = "boundary scan (forced)", msg
+                        _protocol_bump(protocol_stats, turn_mode, "boundary")
                         state = "FIXING_ERROR"
                         attempt_history.append(history_entry + f"**Результат:** ПРОВАЛ\n**Ошибка:** {error_message}")
                         iteration_count += 1
@@ -707,6 +1070,10 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
                     start_verify_time = time.time()
                     rc, stdout, stderr = _execute_verify_with_timeout(verify_command, verify_timeout_seconds)
                     timings['verify'] += time.time() - start_verify_time
+                    # Таймаут (124) для dev-серверов — норма; падением считаем только ненулевой код
+                    if turn_tier == sloth_cascade.TIER_FAST and rc not in (0, 124):
+                        cascade.record_escalation(state, "verify")
+                        force_strong = True
                     def _trim(s, lim=log_trim_limit): return (s[:lim] + "\n...[TRIMMED]...") if len(s) > lim else s
                     logs_collected = f"$ {verify_command}\n(exit={rc})\n\n[STDOUT]\n{_trim(stdout)}\n\n[STDERR]\n{_trim(stderr)}"
                     _log_run(run_log_file_path, "ЛОГИ ВЕРИФИКАЦИИ (FORCED)", logs_collected)
@@ -722,11 +1089,12 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
                 # Если есть verify-команда — сначала проверяем запуском, даже если модель не выдала verify_run
                 if verify_command is not None and verify_command != "":
                     # Скан на служебные маркеры перед запуском
-                    findings = _scan_project_for_token(os.getcwd(), "SLOTH_BOUNDARY")
+                    findings = leak_scanner.scan()
                     if findings:
-                        msg = "Обнаружены служебные маркеры SLOTH_BOUNDARY в коде. Требуется чистка.\n" + "\n".join(findings[:20])
+                        msg = "Обнаружены служебные маркеры протокола в коде (boundary, заголовки блоков, маркеры хунков). Требуется чистка.\n" + "\n".join(findings[:20])
                         _log_run(run_log_file_path, "SLOTH_BOUNDARY FINDINGS (DONE-PATH)", msg)
                         failed_command, error_message = "boundary scan (done)", msg
+                        _protocol_bump(protocol_stats, turn_mode, "boundary")
                         state = "FIXING_ERROR"
                         attempt_history.append(history_entry + f"**Результат:** ПРОВАЛ\n**Ошибка:** {error_message}")
                         iteration_count += 1
@@ -735,6 +1103,10 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
                     start_verify_time = time.time()
                     rc, stdout, stderr = _execute_verify_with_timeout(verify_command, verify_timeout_seconds)
                     timings['verify'] += time.time() - start_verify_time
+                    # Таймаут (124) для dev-серверов — норма; падением считаем только ненулевой код
+                    if turn_tier == sloth_cascade.TIER_FAST and rc not in (0, 124):
+                        cascade.record_escalation(state, "verify")
+                        force_strong = True
                     def _trim(s, lim=log_trim_limit): return (s[:lim] + "\n...[TRIMMED]...") if len(s) > lim else s
                     logs_collected = f"$ {verify_command}\n(exit={rc})\n\n[STDOUT]\n{_trim(stdout)}\n\n[STDERR]\n{_trim(stderr)}"
                     _log_run(run_log_file_path, "ЛОГИ ВЕРИФИКАЦИИ (AUTO-DONE)", logs_collected)
@@ -754,17 +1126,19 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
                 state = "DONE"
             elif not action_taken:
                 print(f"{Colors.FAIL}❌ ЛОГ: Модель не вернула ни команд, ни файла. Перехожу к анализу.{Colors.ENDC}", flush=True)
+                _protocol_bump(protocol_stats, turn_mode, "no_actions")
                 history_entry += "**Результат:** ПРОВАЛ (нет действий)\n**Ошибка:** Модель не сгенерировала действий."
                 state = "REVIEWING"
             elif success:
                 history_entry += "**Результат:** УСПЕХ"
                 if verify_run_present and verify_command is not None:
                     # Быстрый скан на служебные маркеры перед запуском verify
-                    findings = _scan_project_for_token(os.getcwd(), "SLOTH_BOUNDARY")
+                    findings = leak_scanner.scan()
                     if findings:
-                        msg = "Обнаружены служебные маркеры SLOTH_BOUNDARY в коде. Требуется чистка.\n" + "\n".join(findings[:20])
+                        msg = "Обнаружены служебные маркеры протокола в коде (boundary, заголовки блоков, маркеры хунков). Требуется чистка.\n" + "\n".join(findings[:20])
                         _log_run(run_log_file_path, "SLOTH_BOUNDARY FINDINGS", msg)
                         failed_command, error_message = "boundary scan", msg
+                        _protocol_bump(protocol_stats, turn_mode, "boundary")
                         state = "FIXING_ERROR"
                         attempt_history.append(history_entry + f"**Результат:** ПРОВАЛ\n**Ошибка:** {error_message}")
                         iteration_count += 1
@@ -773,6 +1147,10 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
                     start_verify_time = time.time()
                     rc, stdout, stderr = _execute_verify_with_timeout(verify_command, verify_timeout_seconds)
                     timings['verify'] += time.time() - start_verify_time
+                    # Таймаут (124) для dev-серверов — норма; падением считаем только ненулевой код
+                    if turn_tier == sloth_cascade.TIER_FAST and rc not in (0, 124):
+                        cascade.record_escalation(state, "verify")
+                        force_strong = True
                     def _trim(s, lim=log_trim_limit): return (s[:lim] + "\n...[TRIMMED]...") if len(s) > lim else s
                     logs_collected = f"$ {verify_command}\n(exit={rc})\n\n[STDOUT]\n{_trim(stdout)}\n\n[STDERR]\n{_trim(stderr)}"
                     _log_run(run_log_file_path, "ЛОГИ ВЕРИФИКАЦИИ", logs_collected)
@@ -808,6 +1186,14 @@ def main(is_fix_mode, is_fast_mode, history_file_path, run_log_file_path, plan_f
     
     time_report(timings, total_start_time)
     cost_report(cost_log, total_cost)
+    sloth_core.TELEMETRY.report()
+    prompt_profiler.report()
+    chat_session.report()
+    phase_report(cost_log)
+    cascade.report()
+    cascade.save()
+    protocol_report(protocol_stats)
+    sloth_core.backend_health_report()
     return final_message
 
 # --- ТОЧКА ВХОДА ---
@@ -818,11 +1204,41 @@ if __name__ == "__main__":
     parser.add_argument('--fix', action='store_true', help='Запустить в режиме исправления, загрузив настройки из последней сессии.')
     parser.add_argument('--fast', action='store_true', help='Запустить в быстром режиме (игнорируется с --fix).')
     parser.add_argument('--verify-timeout', type=int, default=None, help='Таймаут в секундах для команды верификации (env SLOTH_VERIFY_TIMEOUT, по умолчанию 15).')
+    parser.add_argument('--check-backend', action='store_true', help='Проверить бэкенд модели пробным запросом при старте (по умолчанию проверка откладывается до первого реального запроса).')
     parser.add_argument('--log-trim-limit', type=int, default=None, help='Лимит символов для обрезки stdout/stderr в логах (env SLOTH_LOG_TRIM_LIMIT, по умолчанию 20000).')
+    parser.add_argument('--snapshots', action='store_true', help='Показать снимки файлов последней сессии и выйти.')
+    parser.add_argument('--rollback', type=int, default=None, metavar='ID', help='Откатить файлы проекта последней сессии к состоянию до снимка ID и выйти.')
     args = parser.parse_args()
 
     # --- Управление директорией логов ---
     LOGS_DIR = os.path.join(SLOTH_SCRIPT_DIR, 'logs')
+
+    # --- Снимки: просмотр и откат без модели (до очистки логов) ---
+    if args.snapshots or args.rollback is not None:
+        try:
+            with open(os.path.join(LOGS_DIR, HISTORY_FILE_NAME), 'r', encoding='utf-8') as f:
+                snapshot_project = json.load(f)["last_run_config"]["target_project_path"]
+        except Exception as e:
+            print(f"{Colors.BOLD}{Colors.FAIL}{Symbols.CROSS} ОШИБКА: Не удалось определить проект последней сессии: {e}{Colors.ENDC}", flush=True)
+            sys.exit(1)
+        store = sloth_snapshots.SnapshotStore(os.path.join(LOGS_DIR, "snapshots"), snapshot_project)
+        if args.rollback is None:
+            store.report()
+            sys.exit(0)
+        unrestorable = store.unrestorable(args.rollback)
+        try:
+            restored = store.rollback(args.rollback)
+        except (ValueError, OSError) as e:
+            print(f"{Colors.BOLD}{Colors.FAIL}{Symbols.CROSS} ОШИБКА отката: {e}{Colors.ENDC}", flush=True)
+            sys.exit(1)
+        if unrestorable:
+            print(f"{Colors.WARNING}{Symbols.WARNING}  Частичный откат к снимку #{args.rollback}: восстановлено {len(restored)} путь(ей) в {snapshot_project}, "
+                  f"{len(unrestorable)} путь(ей) вернуть нельзя (см. выше).{Colors.ENDC}", flush=True)
+        else:
+            print(f"{Colors.OKGREEN}{Symbols.CHECK} Откат к состоянию до снимка #{args.rollback}: восстановлено {len(restored)} путь(ей) в {snapshot_project}.{Colors.ENDC}", flush=True)
+        for rel_path in restored:
+            print(f"  {rel_path}", flush=True)
+        sys.exit(0)
     # Если запуск не в режиме исправления, очистить предыдущие логи
     if not args.fix:
         if os.path.exists(LOGS_DIR):
@@ -836,7 +1252,7 @@ if __name__ == "__main__":
         os.makedirs(LOGS_DIR, exist_ok=True)
 
     # --- 1. Инициализация модели ---
-    sloth_core.initialize_model()
+    sloth_core.initialize_model(check_backend=args.check_backend)
     model_instance, _ = sloth_core.get_active_service_details()
     if not model_instance:
         print(f"{Colors.FAIL}❌ КРИТИЧЕСКАЯ ОШИБКА: Не удалось инициализировать модель. "
@@ -868,6 +1284,7 @@ if __name__ == "__main__":
             _cfg_start = sloth_config.get("paths.default_start_dir", DEFAULT_START_DIR)
             _start_dir = _cfg_start if os.path.isdir(_cfg_start) else os.path.expanduser("~")
             if TKINTER_AVAILABLE:
+                from tkinter import Tk, filedialog
                 print(f"{Colors.OKBLUE}Пожалуйста, выберите папку проекта в открывшемся окне...{Colors.ENDC}", flush=True)
                 root = Tk(); root.withdraw()
                 target_project_path = filedialog.askdirectory(title="Выберите папку проекта для Sloth", initialdir=_start_dir)
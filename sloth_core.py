@@ -15,44 +15,20 @@
   совместимый с 2.5-серией в большинстве конфигураций. Можно переопределить env SLOTH_THINKING_BUDGET.
 """
 
+import hashlib
+import json
 import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
 from typing import Any, Dict
 from colors import Colors
 import config as sloth_config
-
-# --- Попытка использовать новый Google GenAI SDK (предпочтительно) ---
-HAS_GOOGLE_GENAI = False
-try:
-    from google import genai as genai_new
-    from google.genai.types import GenerateContentConfig, ThinkingConfig
-    HAS_GOOGLE_GENAI = True
-except Exception:
-    genai_new = None
-    GenerateContentConfig = None
-    ThinkingConfig = None
-    HAS_GOOGLE_GENAI = False
-
-# --- Старый SDK (fallback, без thinking budget) ---
-HAS_LEGACY_GENAI = False
-try:
-    import google.generativeai as genai_legacy
-    HAS_LEGACY_GENAI = True
-except Exception:
-    genai_legacy = None
-    HAS_LEGACY_GENAI = False
-
-# --- Vertex AI SDK ---
-import vertexai
-from vertexai.generative_models import GenerativeModel, HarmCategory, HarmBlockThreshold
-# Эти импорты могут отсутствовать в старых версиях пакета; обрабатываем мягко
-try:
-    from vertexai.generative_models import GenerationConfig as VertexGenerationConfig  # тип конфигурации
-except Exception:
-    VertexGenerationConfig = None
-try:
-    from vertexai.generative_models import ThinkingConfig as VertexThinkingConfig     # thinking конфиг
-except Exception:
-    VertexThinkingConfig = None
+import sloth_backends
+import sloth_health
+import sloth_ratelimit
+import sloth_telemetry
 
 # --- НАСТРОЙКИ ЯДРА ---
 def _pick_cfg(path: str, env_name: str, default: Any) -> Any:
@@ -71,6 +47,12 @@ GOOGLE_CLOUD_LOCATION = _pick_cfg("google.cloud_location", "GOOGLE_CLOUD_LOCATIO
 MODEL_NAME = _pick_cfg("model.name", "SLOTH_MODEL_NAME", "gemini-2.5-pro")
 CONTEXT_PREP_MODEL_NAME = _pick_cfg("model.context_prep_name", "SLOTH_CONTEXT_PREP_MODEL", "gemini-2.5-flash")
 API_TIMEOUT_SECONDS = int(_pick_cfg("api.timeout_seconds", "SLOTH_API_TIMEOUT", "600"))
+# Повторы, когда ни один бэкенд не ответил (в т.ч. по дедлайну): экспоненциальная пауза с джиттером
+API_MAX_RETRIES = int(_pick_cfg("api.max_retries", "SLOTH_API_MAX_RETRIES", "5"))
+API_RETRY_BACKOFF_SECONDS = float(_pick_cfg("api.retry_backoff_seconds", "SLOTH_API_RETRY_BACKOFF", "5"))
+API_RETRY_MAX_BACKOFF_SECONDS = float(sloth_config.get("api.retry_max_backoff_seconds", 120))
+# Потоковые ответы: текст тот же, но время до первого токена (ttft) попадает в телеметрию
+API_STREAM = bool(sloth_config.get("api.stream", True))
 
 # ВАЖНО: максимальный бюджет размышлений.
 THINKING_BUDGET_TOKENS = int(_pick_cfg("thinking.budget_tokens", "SLOTH_THINKING_BUDGET", "24576"))
@@ -125,13 +107,48 @@ _DEFAULT_MODEL_PRICING = {
 }
 
 MODEL_PRICING = _normalize_pricing(sloth_config.get("model_pricing", _DEFAULT_MODEL_PRICING) or _DEFAULT_MODEL_PRICING)
+# Кэшированная часть промпта тарифицируется как доля цены входа (у Gemini 2.5 — 25%)
+CACHED_INPUT_PRICE_FACTOR = float(sloth_config.get("pricing.cached_input_factor", 0.25))
+
+# --- Preflight: оценка размера промпта ДО отправки (секция "preflight" в sloth_config.json) ---
+# tier_boundary_tokens — явная граница тарифа; иначе берётся первая конечная граница input-тарифа модели.
+# safety_margin — доля границы, которую считаем «безопасной» (оценка токенов неточна).
+PREFLIGHT_ENABLED = bool(sloth_config.get("preflight.enabled", True))
+PREFLIGHT_COUNT_TIMEOUT_SECONDS = float(_pick_cfg("preflight.count_timeout_seconds", "SLOTH_PREFLIGHT_TIMEOUT", "3"))
+PREFLIGHT_TIER_BOUNDARY_TOKENS = sloth_config.get("preflight.tier_boundary_tokens", None)
+PREFLIGHT_SAFETY_MARGIN = float(sloth_config.get("preflight.safety_margin", 0.98))
+PREFLIGHT_EXPECTED_OUTPUT_TOKENS = int(sloth_config.get("preflight.expected_output_tokens", 8000))
 
 # --- Глобальные переменные состояния API ---
-model = None  # в режиме google-genai здесь будет client, в остальных — объект модели
+model = None  # активный бэкенд (sloth_backends.ModelBackend)
 ACTIVE_API_SERVICE = "N/A"
 GOOGLE_AI_HAS_FAILED_THIS_SESSION = False
 _last_request_log_key = None  # защита от дублирования логов запроса в рамках одной итерации
 
+# Имена сервисов и их исходный приоритет (меньше — предпочтительнее)
+SERVICE_GENAI = sloth_backends.GenAIBackend.service_name
+SERVICE_LEGACY = sloth_backends.LegacyBackend.service_name
+SERVICE_VERTEX = sloth_backends.VertexBackend.service_name
+SERVICE_LOCAL = sloth_backends.LocalHTTPBackend.service_name
+SERVICE_PRIORITY = {SERVICE_GENAI: 0, SERVICE_LEGACY: 1, SERVICE_VERTEX: 2, SERVICE_LOCAL: 3}
+CLOUD_SERVICES = (SERVICE_GENAI, SERVICE_LEGACY, SERVICE_VERTEX)
+# Короткие имена для sloth_config.json (routing.*)
+SERVICE_ALIASES = {"genai": SERVICE_GENAI, "legacy": SERVICE_LEGACY, "vertex": SERVICE_VERTEX, "local": SERVICE_LOCAL}
+
+# Все успешно инициализированные бэкенды: имя сервиса → ModelBackend
+_BACKENDS: Dict[str, Any] = {}
+# Здоровье бэкендов: латентность, доля ошибок, circuit breaker
+BACKEND_HEALTH = sloth_health.HealthTracker()
+
+# --- Локальный HTTP-бэкенд и маршрутизация по фазам (sloth_config.json) ---
+# "backends": {"local": {"url": "http://127.0.0.1:8080", "api": "openai"|"gemini", "model": "...", "pool_size": 4}}
+# "routing":  {"default": "auto", "phases": {"CONTEXT_PREP": "local", "ANALYZING_LOGS": "local"}, "fallback": true}
+# "auto" — облачные бэкенды по здоровью/латентности; иначе — имя бэкенда (genai|legacy|vertex|local).
+LOCAL_BACKEND_CONFIG = sloth_config.get("backends.local", None) or {}
+ROUTING_DEFAULT = str(sloth_config.get("routing.default", "auto") or "auto").lower()
+ROUTING_PHASES = {str(k).upper(): str(v).lower() for k, v in (sloth_config.get("routing.phases", {}) or {}).items()}
+ROUTING_FALLBACK = bool(sloth_config.get("routing.fallback", True))
+
 # Базовая генерационная конфигурация — БЕЗ max_output_tokens!
 GENERATION_TEMPERATURE = float(_pick_cfg("generation.temperature", "SLOTH_TEMPERATURE", "1"))
 GENERATION_TOP_P = float(_pick_cfg("generation.top_p", "SLOTH_TOP_P", "1"))
@@ -147,243 +164,734 @@ def _log_generation_params():
         f"{Colors.CYAN}🧩 ЛОГ: Бюджет размышлений (thinking_budget) = {THINKING_BUDGET_TOKENS} токенов, если поддерживается SDK/модель.{Colors.ENDC}"
     )
 
-def initialize_model():
-    """Инициализирует модель и выбирает доступный сервис с приоритетом:
-    1) Google GenAI SDK (api key) → thinking_config доступен
-    2) Старый google.generativeai (api key) → thinking_config недоступен
-    3) Vertex AI SDK (ADC/Service Account) → thinking_config доступен
+def _default_generation_options():
+    return {
+        "temperature": GENERATION_TEMPERATURE,
+        "top_p": GENERATION_TOP_P,
+        "top_k": GENERATION_TOP_K,
+        "thinking_budget": THINKING_BUDGET_TOKENS,
+        "timeout_seconds": API_TIMEOUT_SECONDS,
+        "stream": API_STREAM,
+    }
+
+# --- Профили генерации по фазам ---
+# profiles.{ФАЗА} в sloth_config.json: model, thinking_budget, temperature, top_p, top_k, timeout_seconds
+# и список adaptive-правил. Правило срабатывает, когда выполнены его условия
+# (min_failures — подряд неудачных итераций, min_iteration — номер итерации); сработавшие
+# правила применяются по порядку поверх профиля.
+# Ключи, не заданные профилем, берутся из умолчаний бэкенда (_default_generation_options).
+PROFILE_OPTION_KEYS = ("temperature", "top_p", "top_k", "thinking_budget", "timeout_seconds")
+# Исторически анализ логов и подготовка контекста шли на быстрой модели — сохраняем как умолчание
+_BUILTIN_PROFILES = {
+    "CONTEXT_PREP": {"model": CONTEXT_PREP_MODEL_NAME},
+    "ANALYZING_LOGS": {"model": CONTEXT_PREP_MODEL_NAME},
+}
+GENERATION_PROFILES = {
+    str(k).upper(): dict(v) for k, v in (sloth_config.get("profiles", {}) or {}).items() if isinstance(v, dict)
+}
+
+def resolve_generation_profile(phase=None, failures=0, iteration=0):
+    """Профиль генерации для фазы с учётом adaptive-правил.
+
+    Возвращает {"phase", "model", "options", "rules_applied"}; options содержит только
+    явно заданные профилем ключи и передаётся в backend.generate().
     """
-    global model, ACTIVE_API_SERVICE, GOOGLE_AI_HAS_FAILED_THIS_SESSION
+    spec = dict(_BUILTIN_PROFILES.get(phase or "", {}))
+    spec.update(GENERATION_PROFILES.get(phase or "", {}))
+    model_name = spec.get("model") or MODEL_NAME
+    options = {k: spec[k] for k in PROFILE_OPTION_KEYS if spec.get(k) is not None}
+    applied = 0
+    for rule in spec.get("adaptive") or []:
+        if failures < int(rule.get("min_failures", 0)) or iteration < int(rule.get("min_iteration", 0)):
+            continue
+        model_name = rule.get("model") or model_name
+        options.update({k: rule[k] for k in PROFILE_OPTION_KEYS if rule.get(k) is not None})
+        applied += 1
+    return {"phase": phase, "model": model_name, "options": options, "rules_applied": applied}
+
+# --- Протокол ответа исполнителя ---
+# output.mode: "blocks" — fenced-блоки ```write_file``` и т.п. (разбор parse_all_blocks);
+# "json" — один JSON-объект {"actions": [...]} по схеме ACTIONS_RESPONSE_SCHEMA
+# (response_mime_type="application/json"). Если бэкенд фазы не умеет структурированный
+# вывод (старые SDK), промпт и разбор остаются в режиме blocks.
+OUTPUT_MODE = str(_pick_cfg("output.mode", "SLOTH_OUTPUT_MODE", "blocks")).lower()
+EXECUTION_PHASES = ("INITIAL_CODING", "REVIEWING", "FIXING_ERROR", "ANALYZING_LOGS")
+ACTION_TYPES = ("write_file", "edit_file", "bash", "verify_run", "summary", "done_summary", "manual", "files_to_change")
+ACTIONS_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "actions": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "type": {"type": "STRING", "enum": list(ACTION_TYPES)},
+                    "path": {"type": "STRING"},
+                    "content": {"type": "STRING"},
+                },
+                "required": ["type"],
+            },
+        },
+    },
+    "required": ["actions"],
+}
+STRUCTURED_OUTPUT_OPTIONS = {"response_mime_type": "application/json", "response_schema": ACTIONS_RESPONSE_SCHEMA}
 
-    print(f"{Colors.CYAN}⚙️  ЛОГ: Начинаю конфигурацию. Модель: {MODEL_NAME}{Colors.ENDC}")
-    _log_generation_params()
+# Точечные правки (sloth_edits): блок edit_file с хунками SEARCH/REPLACE вместо перезаписи файла целиком.
+# false — в правилах промпта остаётся только write_file (разбор edit_file при этом работает).
+EDITS_ENABLED = bool(sloth_config.get("edits.enabled", True))
 
-    # --- Приоритет: новый Google GenAI SDK (api key) ---
-    if GOOGLE_API_KEY and HAS_GOOGLE_GENAI and not GOOGLE_AI_HAS_FAILED_THIS_SESSION:
-        print(f"{Colors.CYAN}🔑 ЛОГ: Пробую Google GenAI SDK (по API-ключу).{Colors.ENDC}")
-        try:
-            model = genai_new.Client(api_key=GOOGLE_API_KEY)
-            # Тестовый короткий вызов (не задаём max_output_tokens)
-            _ = model.models.generate_content(
-                model=MODEL_NAME,
-                contents="ping"
-            )
-            ACTIVE_API_SERVICE = "Google GenAI SDK"
-            print(f"{Colors.OKGREEN}✅ ЛОГ: Успешно инициализировано через {ACTIVE_API_SERVICE}.{Colors.ENDC}")
-            return
-        except Exception as e:
-            print(f"{Colors.WARNING}⚠️  ПРЕДУПРЕЖДЕНИЕ: Сбой инициализации GenAI SDK: {e}{Colors.ENDC}")
-            GOOGLE_AI_HAS_FAILED_THIS_SESSION = True
-            model = None
+def _init_genai_backend():
+    """Google GenAI SDK (api key) → thinking_config доступен."""
+    print(f"{Colors.CYAN}🔑 ЛОГ: Пробую Google GenAI SDK (по API-ключу).{Colors.ENDC}")
+    return sloth_backends.GenAIBackend(GOOGLE_API_KEY, defaults=_default_generation_options())
 
-    # --- Fallback: старый google.generativeai (api key) ---
-    if GOOGLE_API_KEY and HAS_LEGACY_GENAI and not model:
-        print(f"{Colors.CYAN}🔑 ЛОГ: Пробую старый google.generativeai (API Key).{Colors.ENDC}")
-        try:
-            genai_legacy.configure(api_key=GOOGLE_API_KEY)
-            # ВАЖНО: generation_config без max_output_tokens
-            generation_config = {
-                "temperature": GENERATION_TEMPERATURE,
-                "top_p": GENERATION_TOP_P,
-                "top_k": GENERATION_TOP_K,
-            }
-            model = genai_legacy.GenerativeModel(
-                model_name=MODEL_NAME,
-                generation_config=generation_config,
-                safety_settings={
-                    'HARM_CATEGORY_HARASSMENT': 'block_medium_and_above',
-                    'HARM_CATEGORY_HATE_SPEECH': 'block_medium_and_above',
-                    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'block_medium_and_above',
-                    'HARM_CATEGORY_DANGEROUS_CONTENT': 'block_none',
-                }
-            )
-            # Пробный вызов
-            model.generate_content("test", request_options={"timeout": 60})
-            ACTIVE_API_SERVICE = "Google AI (Legacy SDK)"
-            print(f"{Colors.OKGREEN}✅ ЛОГ: Инициализация через {ACTIVE_API_SERVICE} успешна.{Colors.ENDC}")
-            print(f"{Colors.WARNING}ℹ️  ЛОГ: В этом режиме thinking_budget недоступен. Рекомендую установить 'google-genai'.{Colors.ENDC}")
-            return
-        except Exception as e:
-            print(f"{Colors.WARNING}⚠️  ПРЕДУПРЕЖДЕНИЕ: Не удалось инициализировать старый SDK: {e}{Colors.ENDC}")
-            model = None
+def _init_legacy_backend():
+    """Старый google.generativeai (api key) → thinking_config недоступен."""
+    print(f"{Colors.CYAN}🔑 ЛОГ: Пробую старый google.generativeai (API Key).{Colors.ENDC}")
+    return sloth_backends.LegacyBackend(GOOGLE_API_KEY, defaults=_default_generation_options())
 
-    # --- Резерв: Vertex AI (ADC/Service Account) ---
+def _init_vertex_backend():
+    """Vertex AI SDK (ADC/Service Account) → thinking_config доступен."""
     print(f"{Colors.CYAN}🔩 ЛОГ: Пытаюсь инициализировать через Vertex AI SDK...{Colors.ENDC}")
-    try:
-        vertexai.init(project=GOOGLE_CLOUD_PROJECT, location=GOOGLE_CLOUD_LOCATION)
+    return sloth_backends.VertexBackend(GOOGLE_CLOUD_PROJECT, GOOGLE_CLOUD_LOCATION, defaults=_default_generation_options())
+
+def _init_local_backend():
+    """Локальный сервер модели (OpenAI-/Gemini-совместимый HTTP API)."""
+    cfg = LOCAL_BACKEND_CONFIG
+    print(f"{Colors.CYAN}🏠 ЛОГ: Подключаю локальный бэкенд: {cfg.get('url')} (api={cfg.get('api', 'openai')}).{Colors.ENDC}")
+    defaults = _default_generation_options()
+    if cfg.get("timeout_seconds"):
+        defaults["timeout_seconds"] = int(cfg["timeout_seconds"])
+    return sloth_backends.LocalHTTPBackend(
+        url=cfg.get("url"),
+        api=cfg.get("api", "openai"),
+        model=cfg.get("model"),
+        api_key=cfg.get("api_key"),
+        pool_size=int(cfg.get("pool_size", 4)),
+        defaults=defaults,
+    )
 
-        # Собираем конфиг без max_output_tokens
-        vertex_gen_conf = {
-            "temperature": GENERATION_TEMPERATURE,
-            "top_p": GENERATION_TOP_P,
-            "top_k": GENERATION_TOP_K,
-        }
+def _available_backend_inits():
+    """Список (имя сервиса, фабрика) для бэкендов, которые можно попробовать в этой среде."""
+    inits = []
+    if GOOGLE_API_KEY and sloth_backends.HAS_GOOGLE_GENAI:
+        inits.append((SERVICE_GENAI, _init_genai_backend))
+    if GOOGLE_API_KEY and sloth_backends.HAS_LEGACY_GENAI:
+        inits.append((SERVICE_LEGACY, _init_legacy_backend))
+    if sloth_backends.HAS_VERTEX_AI:
+        inits.append((SERVICE_VERTEX, _init_vertex_backend))
+    if LOCAL_BACKEND_CONFIG.get("url"):
+        inits.append((SERVICE_LOCAL, _init_local_backend))
+    return inits
+
+def _route_services(phase=None):
+    """Кандидаты для запроса фазы phase: [(основные по маршруту)] + облачные по здоровью (если fallback)."""
+    available = [name for name, _ in _available_backend_inits()]
+    cloud = [s for s in available if s in CLOUD_SERVICES]
+    route = ROUTING_PHASES.get(str(phase).upper(), ROUTING_DEFAULT) if phase else ROUTING_DEFAULT
+    if route == "auto":
+        # Без облачных бэкендов (офлайн/CI) auto означает локальный
+        return cloud or [s for s in available if s == SERVICE_LOCAL]
+    service = SERVICE_ALIASES.get(route, route)
+    primary = [service] if service in available else []
+    if not primary:
+        print(f"{Colors.WARNING}⚠️  ЛОГ: Маршрут '{route}' для фазы {phase or 'default'} недоступен. Использую auto.{Colors.ENDC}")
+        return cloud or [s for s in available if s == SERVICE_LOCAL]
+    if ROUTING_FALLBACK:
+        return primary + [s for s in cloud if s not in primary]
+    return primary
+
+# --- Отложенная проверка учётных данных ---
+# Пробные запросы ("ping") при старте больше не отправляются: бэкенд проверяется первым
+# реальным запросом. Результат кэшируется коротко живущим маркером на диске по ключу
+# (сервис, api key / проект, модель), чтобы заведомо нерабочий бэкенд не пробовать снова.
+# Явный режим --check-backend сохраняет прежнее поведение: пинг каждого бэкенда при старте.
+VALIDATION_TTL_SECONDS = int(_pick_cfg("validation.ttl_seconds", "SLOTH_VALIDATION_TTL", "3600"))
+VALIDATION_CACHE_DIR = os.path.expanduser(_pick_cfg("validation.cache_dir", "SLOTH_CACHE_DIR", "~/.cache/sloth"))
+VALIDATION_MARKER_PATH = os.path.join(VALIDATION_CACHE_DIR, "backend_validation.json")
+_VALIDATED_SERVICES = set()
+
+# Признаки ошибок, говорящих именно о неверных учётных данных/доступе (а не о временном сбое).
+# 404/not found сюда не входят: это обычно опечатка в имени модели (profiles.*.model,
+# cascade.fast_model), а маркер пишется на весь бэкенд, а не на запрошенную модель
+_CREDENTIAL_ERROR_MARKERS = (
+    "api key", "api_key", "permission", "unauthenticated", "unauthorized", "forbidden",
+    "401", "403", "credentials",
+)
 
-        # Добавим thinking_config, если класс доступен в установленной версии SDK
-        if VertexThinkingConfig is not None:
-            try:
-                vertex_gen_conf = VertexGenerationConfig(
-                    temperature=GENERATION_TEMPERATURE,
-                    top_p=GENERATION_TOP_P,
-                    top_k=GENERATION_TOP_K,
-                    thinking_config=VertexThinkingConfig(thinking_budget=THINKING_BUDGET_TOKENS),
-                )
-            except Exception:
-                # Если типизированный конфиг недоступен, передадим словарь (некоторые версии принимают dict)
-                vertex_gen_conf = {
-                    "temperature": GENERATION_TEMPERATURE,
-                    "top_p": GENERATION_TOP_P,
-                    "top_k": GENERATION_TOP_K,
-                    "thinking_config": {"thinking_budget": THINKING_BUDGET_TOKENS},
-                }
-
-        model = GenerativeModel(
-            model_name=MODEL_NAME,
-            generation_config=vertex_gen_conf,
-            safety_settings={
-                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-            }
-        )
-        ACTIVE_API_SERVICE = "Vertex AI"
-        # Пробный вызов
-        _ = model.generate_content("ping")
-        print(f"{Colors.OKGREEN}✅ ЛОГ: Vertex AI SDK успешно инициализирован.{Colors.ENDC}")
-    except Exception as e:
-        print(f"{Colors.FAIL}❌ ЛОГ: КРИТИЧЕСКАЯ ОШИБКА: Не удалось инициализировать модель: {e}{Colors.ENDC}")
-        model = None
-        ACTIVE_API_SERVICE = "N/A"
+def _validation_key(service):
+    if service == SERVICE_VERTEX:
+        secret = f"{GOOGLE_CLOUD_PROJECT}:{GOOGLE_CLOUD_LOCATION}"
+    else:
+        secret = GOOGLE_API_KEY or ""
+    digest = hashlib.sha256(f"{service}|{secret}|{MODEL_NAME}".encode("utf-8")).hexdigest()
+    return digest[:24]
 
-def get_active_service_details():
-    """Возвращает текущую модель/клиент и имя активного сервиса."""
-    return model, ACTIVE_API_SERVICE
+def _read_validation_markers():
+    try:
+        with open(VALIDATION_MARKER_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
 
-def _extract_text_and_usage_from_genai_response(resp):
-    # Пытаемся взять текст максимально надёжно
-    full_text = getattr(resp, "text", None)
-    if not full_text:
-        try:
-            # google-genai иногда возвращает candidates
-            cands = getattr(resp, "candidates", None) or []
-            parts_text = []
-            for c in cands:
-                try:
-                    ct = getattr(c, "content", None)
-                    if ct and getattr(ct, "parts", None):
-                        for p in ct.parts:
-                            t = getattr(p, "text", None)
-                            if t:
-                                parts_text.append(t)
-                except Exception:
-                    pass
-            full_text = "".join(parts_text) if parts_text else ""
-        except Exception:
-            full_text = ""
+def _get_validation_marker(service):
+    """Возвращает свежий маркер {"ok": bool, "ts": float, "error": str|None} или None."""
+    marker = _read_validation_markers().get(_validation_key(service))
+    if not isinstance(marker, dict):
+        return None
+    if time.time() - float(marker.get("ts", 0)) > VALIDATION_TTL_SECONDS:
+        return None
+    return marker
 
-    # usage
-    prompt_tokens = 0
-    output_tokens = 0
+def _write_validation_marker(service, ok, error=None):
     try:
-        um = getattr(resp, "usage_metadata", None)
-        if um:
-            prompt_tokens = getattr(um, "prompt_token_count", getattr(um, "input_tokens", 0)) or 0
-            output_tokens = getattr(um, "candidates_token_count", getattr(um, "output_tokens", 0)) or 0
+        os.makedirs(VALIDATION_CACHE_DIR, exist_ok=True)
+        data = _read_validation_markers()
+        now = time.time()
+        # Попутно выбрасываем протухшие записи
+        data = {k: v for k, v in data.items()
+                if isinstance(v, dict) and now - float(v.get("ts", 0)) <= VALIDATION_TTL_SECONDS}
+        data[_validation_key(service)] = {"ok": bool(ok), "ts": now, "error": (str(error)[:300] if error else None)}
+        tmp_path = VALIDATION_MARKER_PATH + f".{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, VALIDATION_MARKER_PATH)
     except Exception:
+        # Кэш — лишь оптимизация, его сбой не должен мешать работе
         pass
-    return full_text, prompt_tokens, output_tokens
 
-def send_request_to_model(model_instance, active_service, prompt_text, iteration_count=0, model_name_override=None):
-    """Возвращает словарь с текстом ответа и информацией о токенах."""
-    global GOOGLE_AI_HAS_FAILED_THIS_SESSION, _last_request_log_key
+def _is_credential_error(error):
+    text = str(error).lower()
+    return any(m in text for m in _CREDENTIAL_ERROR_MARKERS)
+
+def _mark_validated(service):
+    if service not in _VALIDATED_SERVICES:
+        _VALIDATED_SERVICES.add(service)
+        _write_validation_marker(service, True)
+
+def _mark_validation_failed(service, error):
+    _VALIDATED_SERVICES.discard(service)
+    if _is_credential_error(error):
+        _write_validation_marker(service, False, error)
+
+def _set_active_backend(service):
+    global model, ACTIVE_API_SERVICE
+    if service and service in _BACKENDS:
+        model = _BACKENDS[service]
+        ACTIVE_API_SERVICE = service
+    else:
+        model = None
+        ACTIVE_API_SERVICE = "N/A"
 
+def _ensure_backend(service, check=False):
+    """Инициализирует бэкенд при первом обращении (импорт SDK + клиент). Возвращает ModelBackend или None.
+    check=True — дополнительно пингует бэкенд (режим --check-backend)."""
+    global GOOGLE_AI_HAS_FAILED_THIS_SESSION
+    if service in _BACKENDS:
+        return _BACKENDS[service]
+    init_fn = dict(_available_backend_inits()).get(service)
+    if init_fn is None:
+        return None
+    start = time.time()
     try:
-        log_header = f"[Итерация {iteration_count}]" if iteration_count > 0 else "[Этап планирования]"
-        # Анти-дубль: печатаем только если ключ логов поменялся
-        log_key = (iteration_count, active_service)
-        if _last_request_log_key != log_key:
-            print(f"{Colors.CYAN}🧠 ЛОГ: {log_header} Готовлю запрос в модель ({active_service}).{Colors.ENDC}")
-            print(f"{Colors.CYAN}⏳ ЛОГ: Отправляю запрос... (таймаут: {API_TIMEOUT_SECONDS} сек){Colors.ENDC}")
-            _last_request_log_key = log_key
-
-        # Выбор модели: либо override, либо основной MODEL_NAME
-        _model_to_use = model_name_override or MODEL_NAME
-
-        if active_service == "Google GenAI SDK":
-            # Новый клиент + thinking_config
-            cfg = GenerateContentConfig(
-                temperature=GENERATION_TEMPERATURE,
-                top_p=GENERATION_TOP_P,
-                top_k=GENERATION_TOP_K,
-                # критично: не задаём max_output_tokens
-                thinking_config=ThinkingConfig(thinking_budget=THINKING_BUDGET_TOKENS),
-            )
-            print(f"  model={_model_to_use}")
-            print(f"  top_k={GENERATION_TOP_K}")
-            print(f"  thinking_budget={THINKING_BUDGET_TOKENS}")
-            response = model_instance.models.generate_content(
-                model=_model_to_use,
-                contents=prompt_text,
-                config=cfg,
-            )
-            text, in_tok, out_tok = _extract_text_and_usage_from_genai_response(response)
-
-        elif active_service == "Google AI (Legacy SDK)":
-            # Старый generativeai; thinking тут недоступен, max_output_tokens не задаем
-            request_options = {"timeout": API_TIMEOUT_SECONDS}
-            response = model_instance.generate_content(prompt_text, request_options={"timeout": API_TIMEOUT_SECONDS})
-            # Склейка ответа
-            text = getattr(response, "text", None)
-            if not text:
-                try:
-                    text = "".join(part.text for part in response.parts)
-                except Exception:
-                    text = str(response)
-            # usage
-            in_tok = 0
-            out_tok = 0
-            try:
-                um = response.usage_metadata
-                in_tok = getattr(um, "prompt_token_count", 0) or 0
-                out_tok = getattr(um, "candidates_token_count", 0) or 0
-            except Exception:
-                pass
-
-        elif active_service == "Vertex AI":
-            response = model_instance.generate_content(prompt_text)
-            text = getattr(response, "text", None)
-            if not text:
-                try:
-                    text = "".join(part.text for part in response.parts)
-                except Exception:
-                    text = str(response)
-            in_tok = 0
-            out_tok = 0
-            try:
-                um = response.usage_metadata
-                in_tok = getattr(um, "prompt_token_count", 0) or 0
-                out_tok = getattr(um, "candidates_token_count", 0) or 0
-            except Exception:
-                pass
+        backend = init_fn()
+        if check:
+            print(f"{Colors.CYAN}📡 ЛОГ: Проверяю {service} пробным запросом (--check-backend)...{Colors.ENDC}")
+            # Латентность пробного вызова не пишем в окно: она несопоставима с реальными запросами
+            backend.ping(MODEL_NAME)
+            _VALIDATED_SERVICES.add(service)
+            _write_validation_marker(service, True)
+        _BACKENDS[service] = backend
+        print(f"{Colors.OKGREEN}✅ ЛОГ: Успешно инициализировано через {service}.{Colors.ENDC}")
+        if not backend.supports_thinking:
+            print(f"{Colors.WARNING}ℹ️  ЛОГ: В режиме {service} thinking_budget недоступен.{Colors.ENDC}")
+        return backend
+    except Exception as e:
+        BACKEND_HEALTH.record_failure(service, time.time() - start, e)
+        if check:
+            _write_validation_marker(service, False, e)
+        if service == SERVICE_GENAI:
+            GOOGLE_AI_HAS_FAILED_THIS_SESSION = True
+        print(f"{Colors.WARNING}⚠️  ПРЕДУПРЕЖДЕНИЕ: Сбой инициализации {service}: {e}{Colors.ENDC}")
+        return None
+
+def initialize_model(check_backend=False):
+    """Регистрирует доступные бэкенды в трекере здоровья и поднимает первый рабочий по приоритету:
+    1) Google GenAI SDK (api key) → thinking_config доступен
+    2) Старый google.generativeai (api key) → thinking_config недоступен
+    3) Vertex AI SDK (ADC/Service Account) → thinking_config доступен
+    4) Локальный HTTP-бэкенд (backends.local) — по маршрутам routing.* или офлайн
+    Остальные бэкенды (и их SDK) инициализируются лениво — когда маршрут или трекер здоровья
+    впервые направит в них запрос (см. sloth_health).
 
+    Пробные запросы не отправляются: учётные данные проверяет первый реальный запрос.
+    Бэкенд, для которого свежий маркер на диске фиксирует ошибку доступа, идёт последним.
+    check_backend=True — прежнее «жадное» поведение: пинг каждого пробуемого бэкенда.
+    """
+    print(f"{Colors.CYAN}⚙️  ЛОГ: Начинаю конфигурацию. Модель: {MODEL_NAME}{Colors.ENDC}")
+    _log_generation_params()
+
+    services = [name for name, _ in _available_backend_inits()]
+    known_bad = []
+    for service in services:
+        BACKEND_HEALTH.register(service, SERVICE_PRIORITY.get(service, len(SERVICE_PRIORITY)))
+        marker = None if check_backend else _get_validation_marker(service)
+        if marker is None:
+            continue
+        if marker.get("ok"):
+            _VALIDATED_SERVICES.add(service)
+            print(f"{Colors.GREY}ℹ️  ЛОГ: {service}: учётные данные проверены ранее (кэш), пинг пропущен.{Colors.ENDC}")
         else:
-            raise ValueError(f"Неизвестный сервис API: {active_service}")
+            known_bad.append(service)
+            print(f"{Colors.WARNING}⚠️  ЛОГ: {service}: по кэшу недавно был отказ доступа ({marker.get('error')}). Пробую его последним.{Colors.ENDC}")
+
+    ordered = _ordered_candidates(_route_services(None), None)
+    ordered = [s for s in ordered if s not in known_bad] + [s for s in ordered if s in known_bad]
+    for service in ordered:
+        if _ensure_backend(service, check=check_backend) is not None:
+            _set_active_backend(service)
+            break
+    else:
+        _set_active_backend(None)
+
+    if model is None:
+        print(f"{Colors.FAIL}❌ ЛОГ: КРИТИЧЕСКАЯ ОШИБКА: Не удалось инициализировать модель.{Colors.ENDC}")
+    else:
+        print(f"{Colors.OKGREEN}✅ ЛОГ: Активный бэкенд: {ACTIVE_API_SERVICE}.{Colors.ENDC}")
+        if ROUTING_PHASES:
+            routes = ", ".join(f"{k}→{v}" for k, v in ROUTING_PHASES.items())
+            print(f"{Colors.CYAN}🧭 ЛОГ: Маршруты по фазам: {routes} (по умолчанию: {ROUTING_DEFAULT}).{Colors.ENDC}")
 
-        if not text:
+def get_active_service_details():
+    """Возвращает текущий бэкенд (ModelBackend) и имя активного сервиса."""
+    return model, ACTIVE_API_SERVICE
+
+def structured_output_enabled(phase=None):
+    """Отвечать ли JSON-протоколом в этой фазе: output.mode == "json" и бэкенд фазы это умеет."""
+    if OUTPUT_MODE != "json" or phase not in EXECUTION_PHASES:
+        return False
+    if not _BACKENDS:
+        return bool(getattr(model, "supports_structured_output", False))
+    for service in _ordered_candidates(_route_services(phase), ACTIVE_API_SERVICE):
+        backend = _ensure_backend(service)
+        if backend is not None:
+            return bool(backend.supports_structured_output)
+    return False
+
+def _ordered_candidates(route, preferred):
+    """Маршрутизированный бэкенд фазы идёт первым; облачные — в порядке здоровья/латентности."""
+    if not route:
+        return []
+    if route[0] not in CLOUD_SERVICES:
+        rest = BACKEND_HEALTH.ordered(route[1:], preferred=preferred)
+        # Открытая цепь у маршрутизированного бэкенда — пропускаем его вперёд облачных до восстановления
+        if BACKEND_HEALTH.is_available(route[0]) or not rest:
+            return [route[0]] + rest
+        return rest + [route[0]]
+    return BACKEND_HEALTH.ordered(route, preferred=preferred)
+
+# --- Хеджирование запросов ---
+# Если ответа нет дольше, чем hedging.percentile наблюдаемой латентности фазы, отправляем
+# дубликат (в следующий доступный бэкенд или в тот же) — побеждает первый ответ.
+# У каждой попытки свой Deadline: проигравшая отменяется (deadline.cancel() — её generate()
+# сразу завершается) и, если это другой бэкенд, получает cancel_inflight() — локальный закрывает
+# сокет. Облачные SDK прервать запрос в полёте не дают: их поток (daemon) дорабатывает
+# в фоне, ответ отбрасывается, а потраченные токены учитываются в HEDGE_SPEND.
+HEDGING_ENABLED = bool(sloth_config.get("hedging.enabled", False))
+HEDGING_PERCENTILE = float(sloth_config.get("hedging.percentile", 95))
+HEDGING_MIN_SAMPLES = int(sloth_config.get("hedging.min_samples", 5))
+HEDGING_MIN_DELAY_SECONDS = float(sloth_config.get("hedging.min_delay_seconds", 15))
+HEDGING_MAX_PER_RUN = int(sloth_config.get("hedging.max_per_run", 10))
+HEDGING_PHASES = {str(p).upper() for p in (sloth_config.get("hedging.phases", None) or [])}
+_PHASE_LATENCIES: Dict[str, Any] = {}
+# Телеметрия каждого успешного запроса: токены (в т.ч. cached/thinking), ttft и латентность
+TELEMETRY = sloth_telemetry.UsageTelemetry()
+_phase_latency_lock = threading.Lock()
+HEDGE_SPEND = []  # [{"phase", "backend", "model", "input_tokens", "output_tokens", "cached_tokens", "thinking_tokens", "billable", "settled"}]
+_hedges_sent = 0
+
+def _observe_phase_latency(phase, latency):
+    with _phase_latency_lock:
+        _PHASE_LATENCIES.setdefault(phase or "", deque(maxlen=50)).append(float(latency))
+
+def _hedge_delay(phase):
+    """Задержка перед дубликатом для фазы или None, если хеджирование сейчас неприменимо."""
+    if not HEDGING_ENABLED or _hedges_sent >= HEDGING_MAX_PER_RUN:
+        return None
+    if HEDGING_PHASES and (phase or "") not in HEDGING_PHASES:
+        return None
+    with _phase_latency_lock:
+        lats = list(_PHASE_LATENCIES.get(phase or "", ()))
+    if len(lats) < HEDGING_MIN_SAMPLES:
+        return None
+    return max(HEDGING_MIN_DELAY_SECONDS, sloth_health.percentile(lats, HEDGING_PERCENTILE))
+
+def _submit_daemon(fn, *args):
+    """Как executor.submit, но в daemon-потоке: зависший проигравший запрос не держит выход из процесса."""
+    future = Future()
+
+    def _run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_run, daemon=True, name="sloth-hedge").start()
+    return future
+
+# --- Общий лимитер RPM/TPM (см. sloth_ratelimit) ---
+# Квота общая для всех сессий Sloth с тем же ключом API / проектом; локальный сервер не лимитируется.
+RATE_LIMITER = sloth_ratelimit.SharedRateLimiter(key=GOOGLE_API_KEY or GOOGLE_CLOUD_PROJECT or "default")
+_RATE_LIMIT_ERROR_MARKERS = ("429", "resource exhausted", "resource_exhausted", "rate limit", "quota exceeded")
+
+def _is_rate_limit_error(error):
+    text = str(error).lower()
+    return any(m in text for m in _RATE_LIMIT_ERROR_MARKERS)
+
+def _generate_once(service, backend, prompt_text, model_name, options, deadline=None):
+    """Один запрос к бэкенду с учётом здоровья и валидации. Исключение — при ошибке или пустом ответе.
+    deadline — Deadline попытки (хеджирование); отменённая попытка не считается сбоем бэкенда."""
+    limited = service in CLOUD_SERVICES and RATE_LIMITER.active
+    estimated = estimate_prompt_tokens(prompt_text) if limited else 0
+    if limited:
+        RATE_LIMITER.acquire(estimated)
+    start = time.time()
+    try:
+        result = backend.generate(prompt_text, model_name, options, deadline=deadline)
+        if not result.get("text"):
             raise ValueError("Ответ от модели пустой.")
+    except Exception as e:
+        if deadline is not None and deadline.cancelled and not deadline.expired():
+            raise
+        BACKEND_HEALTH.record_failure(service, time.time() - start, e)
+        _mark_validation_failed(service, e)
+        if limited and _is_rate_limit_error(e):
+            RATE_LIMITER.throttled()
+        raise
+    if limited:
+        RATE_LIMITER.settle(estimated, result.get("input_tokens", 0))
+    BACKEND_HEALTH.record_success(service, time.time() - start)
+    _observe_token_ratio(len(prompt_text or ""), result.get("input_tokens", 0))
+    # Первый успешный реальный запрос и есть проверка учётных данных
+    _mark_validated(service)
+    return result
+
+def _release_hedge_loser(future, service, backend, model_name, prompt_text, phase, deadline, winner_backend):
+    """Отменяет проигравший запрос и учитывает его расход в HEDGE_SPEND."""
+    deadline.cancel()
+    if backend is not winner_backend:
+        # У общего с победителем бэкенда cancel_inflight() оборвал бы и чужие запросы
+        try:
+            backend.cancel_inflight()
+        except Exception:
+            pass
+    if future.cancel():
+        return
+    entry = {
+        "phase": phase, "backend": service, "model": model_name,
+        # Пока запрос не завершился — оцениваем вход по длине промпта
+        "input_tokens": estimate_prompt_tokens(prompt_text), "output_tokens": 0,
+        "cached_tokens": 0, "thinking_tokens": 0,
+        "billable": service != SERVICE_LOCAL, "settled": False,
+    }
+    HEDGE_SPEND.append(entry)
 
-        print(f"{Colors.OKGREEN}✅ ЛОГ: Ответ от модели получен успешно.{Colors.ENDC}")
-        return {"text": text, "input_tokens": in_tok, "output_tokens": out_tok}
+    def _settle(f):
+        try:
+            result = f.result()
+            entry["input_tokens"] = result.get("input_tokens", 0) or entry["input_tokens"]
+            entry["output_tokens"] = result.get("output_tokens", 0)
+            entry["cached_tokens"] = result.get("cached_tokens", 0)
+            entry["thinking_tokens"] = result.get("thinking_tokens", 0)
+        except sloth_backends.DeadlineExceeded:
+            # Отменённый запрос уже отправлен: вход оставляем по оценке, выход неизвестен
+            pass
+        except Exception:
+            # Неудачный запрос не тарифицируется
+            entry["input_tokens"] = 0
+        entry["settled"] = True
+
+    future.add_done_callback(_settle)
+
+def _hedged_generate(attempts, prompt_text, options, phase, delay):
+    """attempts — [(service, backend, model_name)]: основной и хедж. Возвращает (service, model_name, result)
+    первого успешного ответа; если оба упали — пробрасывает ошибку основного."""
+    global _hedges_sent
+    futures = {}
+
+    def _submit(attempt):
+        a_service, a_backend, a_model = attempt
+        timeout = {**getattr(a_backend, "defaults", {}), **options}.get("timeout_seconds") or API_TIMEOUT_SECONDS
+        deadline = sloth_backends.Deadline(timeout)
+        future = _submit_daemon(_generate_once, a_service, a_backend, prompt_text, a_model, options, deadline)
+        futures[future] = (a_service, a_backend, a_model, deadline)
+
+    _submit(attempts[0])
+    done, _ = wait(futures, timeout=delay)
+    if not done and len(attempts) > 1:
+        h_service = attempts[1][0]
+        print(f"{Colors.CYAN}🪞 ЛОГ: Нет ответа за {delay:.1f} сек. (p{HEDGING_PERCENTILE:.0f} фазы {phase}) — дублирую запрос в {h_service}.{Colors.ENDC}")
+        _hedges_sent += 1
+        _submit(attempts[1])
+
+    pending, first_error = set(futures), None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            try:
+                result = f.result()
+            except Exception as e:
+                first_error = first_error or e
+                continue
+            w_service, w_backend, w_model, _ = futures[f]
+            for loser in pending:
+                l_service, l_backend, l_model, l_deadline = futures[loser]
+                _release_hedge_loser(loser, l_service, l_backend, l_model, prompt_text, phase, l_deadline, w_backend)
+            if len(futures) > 1:
+                print(f"{Colors.CYAN}🪞 ЛОГ: Хедж: первым ответил {w_service}, второй запрос отменён.{Colors.ENDC}")
+            return w_service, w_model, result
+    raise first_error
+
+def hedge_spend_entries():
+    """Снимок расхода на проигравшие хедж-запросы (для cost_report)."""
+    return [dict(e) for e in HEDGE_SPEND]
+
+def send_request_to_model(model_instance, active_service, prompt_text, iteration_count=0, model_name_override=None, phase=None, profile=None):
+    """Возвращает словарь с текстом ответа и информацией о токенах:
+    {"text", "input_tokens", "output_tokens", "cached_tokens", "thinking_tokens",
+     "backend", "model", "billable", "thinking_budget"}.
+
+    active_service — лишь предпочтение: запрос уходит в бэкенд по маршруту фазы (routing.phases)
+    или в самый здоровый и быстрый облачный бэкенд, при ошибке — в следующий доступный (failover).
+    profile — результат resolve_generation_profile(); по умолчанию берётся профиль фазы.
+    При hedging.enabled долгий запрос дублируется (см. _hedged_generate).
+    """
+    global GOOGLE_AI_HAS_FAILED_THIS_SESSION, _last_request_log_key
+
+    if profile is None:
+        profile = resolve_generation_profile(phase)
+    # Выбор модели: либо override, либо модель профиля фазы
+    _model_to_use = model_name_override or profile["model"]
+    options = profile["options"]
+
+    if _BACKENDS:
+        candidates = _ordered_candidates(_route_services(phase), active_service)
+    else:
+        # Бэкенды не регистрировались (например, модель передана снаружи) — работаем с тем, что дали
+        candidates = [active_service]
+
+    last_service = active_service
+    for index, service in enumerate(candidates):
+        backend = _ensure_backend(service) if _BACKENDS else model_instance
+        if backend is None:
+            continue
+        last_service = service
+        effective_model = getattr(backend, "model", None) or _model_to_use
+        effective = {**getattr(backend, "defaults", {}), **options}
+        effective.setdefault("timeout_seconds", API_TIMEOUT_SECONDS)
+        effective.setdefault("thinking_budget", THINKING_BUDGET_TOKENS)
+        start = time.time()
+        try:
+            log_header = f"[Итерация {iteration_count}]" if iteration_count > 0 else "[Этап планирования]"
+            # Анти-дубль: печатаем только если ключ логов поменялся
+            log_key = (iteration_count, service)
+            if _last_request_log_key != log_key:
+                print(f"{Colors.CYAN}🧠 ЛОГ: {log_header} Готовлю запрос в модель ({service}).{Colors.ENDC}")
+                print(f"{Colors.CYAN}⏳ ЛОГ: Отправляю запрос... (таймаут: {effective['timeout_seconds']} сек){Colors.ENDC}")
+                _last_request_log_key = log_key
+            print(f"  model={effective_model}")
+            if backend.supports_thinking:
+                print(f"  thinking_budget={effective['thinking_budget']}")
+
+            delay = _hedge_delay(phase)
+            if delay is not None:
+                # Хедж — в следующий доступный бэкенд, иначе дубликат в тот же
+                hedge_service = next((c for c in candidates[index + 1:] if BACKEND_HEALTH.is_available(c)), service)
+                hedge_backend = _ensure_backend(hedge_service) if (_BACKENDS and hedge_service != service) else backend
+                if hedge_backend is None:
+                    hedge_service, hedge_backend = service, backend
+                hedge_model = getattr(hedge_backend, "model", None) or _model_to_use
+                service, effective_model, result = _hedged_generate(
+                    [(service, backend, effective_model), (hedge_service, hedge_backend, hedge_model)],
+                    prompt_text, options, phase, delay,
+                )
+                backend = _BACKENDS.get(service, backend)
+            else:
+                result = _generate_once(service, backend, prompt_text, effective_model, options)
+
+            latency = time.time() - start
+            _observe_phase_latency(phase, latency)
+            TELEMETRY.record(phase, service, effective_model, result, latency, result.get("ttft"))
+            # Маршрутизированный локальный бэкенд не становится «активным» для остальных фаз
+            if service != ACTIVE_API_SERVICE and (service in CLOUD_SERVICES or model is None):
+                print(f"{Colors.CYAN}🔄 ЛОГ: Активный бэкенд: {ACTIVE_API_SERVICE} → {service}.{Colors.ENDC}")
+                _set_active_backend(service)
+            print(f"{Colors.OKGREEN}✅ ЛОГ: Ответ от модели получен успешно.{Colors.ENDC}")
+            return {
+                "text": result["text"],
+                "input_tokens": result.get("input_tokens", 0),
+                "output_tokens": result.get("output_tokens", 0),
+                "cached_tokens": result.get("cached_tokens", 0),
+                "thinking_tokens": result.get("thinking_tokens", 0),
+                "backend": service,
+                "model": effective_model,
+                # Локальный сервер не тарифицируется
+                "billable": service != SERVICE_LOCAL,
+                "thinking_budget": effective["thinking_budget"] if backend.supports_thinking else None,
+            }
 
+        except Exception as e:
+            if service == SERVICE_GENAI:
+                GOOGLE_AI_HAS_FAILED_THIS_SESSION = True
+            print(f"{Colors.FAIL}❌ ЛОГ: ОШИБКА при запросе к API ({service}): {e}{Colors.ENDC}")
+            if service != candidates[-1]:
+                print(f"{Colors.CYAN}🔄 ЛОГ: Переключаюсь на следующий доступный бэкенд...{Colors.ENDC}")
+
+    print(f"{Colors.WARNING}⚠️  ЛОГ: Все доступные бэкенды вернули ошибку (последний: {last_service}).{Colors.ENDC}")
+    return None
+
+# --- Preflight-подсчёт токенов ---
+# Точные подсчёты (count_tokens API) кэшируются по хэшу промпта; по ним и по фактическому
+# usage ответов калибруется локальная оценка «символов на токен». Если API считает дольше
+# PREFLIGHT_COUNT_TIMEOUT_SECONDS — возвращаем калиброванную оценку, а точный результат,
+# когда придёт, попадёт в кэш.
+_TOKEN_COUNT_CACHE: "OrderedDict[str, int]" = OrderedDict()
+_TOKEN_COUNT_CACHE_MAX = 256
+_token_count_lock = threading.Lock()
+_chars_per_token = 4.0
+_preflight_executor = None
+
+def _prompt_digest(prompt_text):
+    return hashlib.sha1(str(prompt_text).encode("utf-8", "replace")).hexdigest()
+
+def _observe_token_ratio(text_len, tokens):
+    """Обновляет калибровку «символов на токен» (экспоненциальное сглаживание)."""
+    global _chars_per_token
+    if text_len <= 0 or not tokens:
+        return
+    ratio = max(1.0, min(8.0, text_len / float(tokens)))
+    with _token_count_lock:
+        _chars_per_token = 0.7 * _chars_per_token + 0.3 * ratio
+
+def _cache_token_count(digest, text_len, tokens):
+    with _token_count_lock:
+        _TOKEN_COUNT_CACHE[digest] = int(tokens)
+        _TOKEN_COUNT_CACHE.move_to_end(digest)
+        while len(_TOKEN_COUNT_CACHE) > _TOKEN_COUNT_CACHE_MAX:
+            _TOKEN_COUNT_CACHE.popitem(last=False)
+    _observe_token_ratio(text_len, tokens)
+
+def estimate_prompt_tokens(text):
+    """Локальная оценка токенов с калибровкой по предыдущим точным подсчётам."""
+    if not text:
+        return 0
+    return max(1, int(len(text) / _chars_per_token))
+
+def preflight_count_tokens(prompt_text, model_name=None, phase=None):
+    """Число входных токенов промпта ДО отправки. Возвращает (tokens, source),
+    source ∈ {"cache", "api", "estimate"}."""
+    global _preflight_executor
+    digest = _prompt_digest(prompt_text)
+    with _token_count_lock:
+        cached = _TOKEN_COUNT_CACHE.get(digest)
+    if cached is not None:
+        return cached, "cache"
+
+    text_len = len(prompt_text or "")
+    model_name = model_name or MODEL_NAME
+    backend = None
+    if _BACKENDS:
+        for service in _ordered_candidates(_route_services(phase), ACTIVE_API_SERVICE):
+            backend = _ensure_backend(service)
+            if backend is not None:
+                break
+    if backend is None or PREFLIGHT_COUNT_TIMEOUT_SECONDS <= 0:
+        return estimate_prompt_tokens(prompt_text), "estimate"
+
+    def _count():
+        tokens = backend.count_tokens(prompt_text, getattr(backend, "model", None) or model_name)
+        if tokens:
+            _cache_token_count(digest, text_len, tokens)
+        return tokens
+
+    if _preflight_executor is None:
+        _preflight_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sloth-preflight")
+    future = _preflight_executor.submit(_count)
+    try:
+        tokens = future.result(timeout=PREFLIGHT_COUNT_TIMEOUT_SECONDS)
+        if tokens:
+            return int(tokens), "api"
+    except FutureTimeoutError:
+        print(f"{Colors.GREY}ℹ️  ЛОГ: count_tokens не ответил за {PREFLIGHT_COUNT_TIMEOUT_SECONDS:.0f} сек. — использую локальную оценку.{Colors.ENDC}")
     except Exception as e:
-        print(f"{Colors.FAIL}❌ ЛОГ: ОШИБКА при запросе к API ({active_service}): {e}{Colors.ENDC}")
-        # Автопереключение: при сбое GenAI SDK пробуем Vertex
-        if active_service == "Google GenAI SDK":
-            print(f"{Colors.CYAN}🔄 ЛОГ: Переключаюсь на Vertex AI как резерв...{Colors.ENDC}")
-            GOOGLE_AI_HAS_FAILED_THIS_SESSION = True
-            initialize_model()
+        print(f"{Colors.GREY}ℹ️  ЛОГ: count_tokens недоступен ({e}) — использую локальную оценку.{Colors.ENDC}")
+    return estimate_prompt_tokens(prompt_text), "estimate"
+
+def _pricing_for_model(model_name):
+    name = (model_name or "").lower()
+    if model_name in MODEL_PRICING:
+        return MODEL_PRICING[model_name]
+    for key, mp in MODEL_PRICING.items():
+        if name.startswith(key.lower()) or key.lower() in name:
+            return mp
+    return MODEL_PRICING.get(MODEL_NAME, {})
+
+def tier_boundary_tokens(model_name=None):
+    """Граница тарифа по входным токенам, выше которой цена растёт (None — тариф плоский)."""
+    if PREFLIGHT_TIER_BOUNDARY_TOKENS:
+        return int(PREFLIGHT_TIER_BOUNDARY_TOKENS)
+    tiers = ((_pricing_for_model(model_name or MODEL_NAME).get("input") or {}).get("tiers") or [])
+    bounds = [t.get("up_to") for t in tiers if t.get("up_to") not in (None, float('inf'))]
+    if len(tiers) < 2 or not bounds:
         return None
+    return int(min(float(b) for b in bounds))
+
+def backend_health_report():
+    """Печатает состояние бэкендов: цепь, доля ошибок, p50/p95 латентности и расход токенов."""
+    snap = BACKEND_HEALTH.snapshot()
+    if not snap:
+        return
+    print(f"\n{Colors.BOLD}{Colors.HEADER}--- СОСТОЯНИЕ БЭКЕНДОВ ---{Colors.ENDC}", flush=True)
+    for name, st in snap.items():
+        usage = _BACKENDS[name].usage() if name in _BACKENDS else {}
+        print(
+            f"  {name:<24} | цепь: {st['state']:<9} | запросов: {st['requests']:<3} | "
+            f"ошибки: {st['error_rate'] * 100:.0f}% | p50: {st['p50']:.2f} сек. | p95: {st['p95']:.2f} сек. | "
+            f"токены: {usage.get('input_tokens', 0)}/{usage.get('output_tokens', 0)}",
+            flush=True,
+        )
+    if RATE_LIMITER.waits:
+        print(f"  Лимит RPM/TPM: ожиданий перед отправкой: {RATE_LIMITER.waits}, всего {RATE_LIMITER.waited_seconds:.1f} сек.", flush=True)
+
+class PromptText(str):
+    """Промпт как обычная строка плюс именованные секции (rules, history, context, ...) —
+    для профилировщика состава промпта. Секции с одинаковым именем суммируются."""
+
+    def __new__(cls, sections):
+        sections = tuple((name, str(text)) for name, text in sections if text)
+        obj = super().__new__(cls, "".join(text for _, text in sections))
+        obj.sections = sections
+        return obj
+
+def prompt_breakdown(prompt):
+    """[(секция, символы, оценка токенов)] в порядке первого появления; для обычной строки — одна секция,
+    для хода чат-сессии (Conversation) прошлые ходы считаются секцией session."""
+    turns = getattr(prompt, "turns", None)
+    if turns:
+        # Ход чат-сессии: прошлые ходы диалога — одна секция, новый ход — по своим секциям
+        last = turns[-1][1]
+        sections = (("session", "".join(str(t) for _, t in turns[:-1])),)
+        sections += getattr(last, "sections", None) or (("prompt", str(last)),)
+    else:
+        sections = getattr(prompt, "sections", None) or (("prompt", str(prompt or "")),)
+    sizes = OrderedDict()
+    for name, text in sections:
+        sizes[name] = sizes.get(name, 0) + len(text)
+    return [(name, chars, max(1, int(chars / _chars_per_token)) if chars else 0) for name, chars in sizes.items()]
 
 def get_clarification_and_planning_prompt(context, task, boundary=None):
     """
@@ -484,37 +992,64 @@ def get_clarification_and_planning_prompt(context, task, boundary=None):
 ```
 """
 
-    return f"""{planning_rules}
-{global_rules}
-{boundary_instr}
+    return PromptText([
+        ("rules", f"{planning_rules}\n{global_rules}\n{boundary_instr}\n"),
+        ("context", f"\n--- КОНТЕКСТ ПРОЕКТА (СОКРАЩЕННЫЙ) ---\n{context}\n--- КОНЕЦ КОНТЕКСТА ---\n"),
+        ("task", f"\n--- ЗАДАЧА ПОЛЬЗОВАТЕЛЯ ---\n{task}\n--- КОНЕЦ ЗАДАЧИ ---\n"),
+        ("instructions", "\nПроанализируй задачу и контекст. Следуй правилам этапа планирования.\n"),
+    ])
 
---- КОНТЕКСТ ПРОЕКТА (СОКРАЩЕННЫЙ) ---
-{context}
---- КОНЕЦ КОНТЕКСТА ---
-
---- ЗАДАЧА ПОЛЬЗОВАТЕЛЯ ---
-{task}
---- КОНЕЦ ЗАДАЧИ ---
-
-Проанализируй задачу и контекст. Следуй правилам этапа планирования.
-"""
+def _get_structured_format_rules():
+    edit_rule = ("\n    - edit_file: path — существующий файл, content — хунки SEARCH/REPLACE (формат ниже в разделе ФОРМАТ БЛОКОВ);"
+                 if EDITS_ENABLED else "")
+    return f"""
+Ты работаешь как строгий исполнитель изменений кода. Ответ — ОДИН JSON-объект вида {{"actions": [...]}}. Не возвращай ничего кроме него.
 
-def _get_execution_prompt_rules(boundary=None):
-    """Возвращает общий набор правил для всех этапов исполнения."""
+ОБЯЗАТЕЛЬНЫЕ ПРАВИЛА И ОГРАНИЧЕНИЯ:
+*   Каждое действие — объект {{"type": ..., "path": ..., "content": ...}}. Допустимые type (далее «блоки»):
+    - write_file: path — относительный путь, content — полное содержимое файла (как есть, без экранирования markdown);{edit_rule}
+    - bash: content — команды, по одной на строке;
+    - verify_run: без полей;
+    - summary / done_summary / manual: content — текст (слово ГОТОВО пиши внутри done_summary);
+    - files_to_change: content — список файлов по одному на строке (вспомогательный, не исполняется).
+*   Действия выполняются в порядке массива."""
+
+def _get_edit_format_rules():
+    return """
+*   edit_file — точечная правка существующего файла: только изменённые фрагменты, без перепечатки всего файла.
+    Предпочитай edit_file для небольших правок больших файлов; write_file — для новых файлов и переписывания большей части файла.
+    Содержимое — один или несколько хунков (маркеры — с начала строки, без отступа):
+<<<<<<< SEARCH
+точная копия текущих строк файла (2–3 строки контекста, чтобы фрагмент был уникален)
+=======
+новые строки
+>>>>>>> REPLACE
+    Хунки применяются по порядку; если хотя бы один не найден — файл не меняется, и ты получишь ошибку с ближайшим похожим местом.
+    В этом случае повтори правку, скопировав SEARCH из файла дословно, или пришли write_file целиком."""
+
+def _get_execution_prompt_rules(boundary=None, structured=False):
+    """Возвращает общий набор правил для всех этапов исполнения (structured — JSON-протокол вместо блоков)."""
     b = f"\n\n{boundary}" if boundary else ""
-    return f"""
+    edit_block = f"\n    - ```edit_file path=\"RELATIVE/PATH\"{b}\n...хунки SEARCH/REPLACE...\n```" if EDITS_ENABLED else ""
+    edit_format = _get_edit_format_rules() if EDITS_ENABLED else ""
+    if structured:
+        format_rules = _get_structured_format_rules()
+    else:
+        format_rules = f"""
 Ты работаешь как строгий исполнитель изменений кода. Форматируй ответ ТОЛЬКО блоками ниже. Не возвращай ничего лишнего.
 
 ОБЯЗАТЕЛЬНЫЕ ПРАВИЛА И ОГРАНИЧЕНИЯ:
 *   Разрешены ТОЛЬКО такие блоки:
-    - ```write_file path=\"RELATIVE/PATH\"{b}\n...содержимое файла...\n```
+    - ```write_file path=\"RELATIVE/PATH\"{b}\n...содержимое файла...\n```{edit_block}
     - ```bash\n...команды...\n```
     - ```verify_run```
     - ```summary```
     - ```done_summary```
     - ```manual```
-*   Любой текст вне перечисленных блоков будет проигнорирован.
+*   Любой текст вне перечисленных блоков будет проигнорирован."""
+    return f"""{format_rules}
 *   НЕЛЬЗЯ использовать произвольные скрипты/команды вне белого списка.
+*   Файлы и команды можно сочетать в одном ответе: сначала записываются все файлы, затем по порядку выполняются блоки `bash`, затем `verify_run`. При первой ошибке остальные действия не выполняются. Не откладывай зависимую команду (например, генерацию клиента после правки схемы) на следующую итерацию. Каждая строка блока `bash` — отдельная команда с ограничением по времени: не запускай в нём dev-серверы и watch-режимы.
 *   Если действие невозможно выполнить автоматически — верни блок `manual` с чёткими шагами для человека.
 
 АНТИ-ПЕРФЕКЦИОНИЗМ И ИЗБЕЖАНИЕ ЗАЦИКЛИВАНИЯ:
@@ -549,7 +1084,7 @@ def _get_execution_prompt_rules(boundary=None):
 4) После успешного verify и отсутствия ошибок — сразу `done_summary`.
 
 ФОРМАТ БЛОКОВ:
-*   write_file — перезаписывает файл полностью. Пиши конечное содержимое (без диффов). Если файл отсутствует — он будет создан.
+*   write_file — перезаписывает файл полностью. Пиши конечное содержимое (без диффов). Если файл отсутствует — он будет создан.{edit_format}
 *   bash — набор команд из белого списка, по одной на строке.
 *   verify_run — маркер, что после твоих действий следует запустить проверку.
 
@@ -559,8 +1094,8 @@ def _get_execution_prompt_rules(boundary=None):
 *   **Успешный запуск без ошибок:** Если процесс завершился с кодом `0` и в логах нет ошибок, это тоже успех.
 """
 
-def get_initial_prompt(context, task, fix_history=None, boundary=None):
-    rules = _get_execution_prompt_rules(boundary)
+def get_initial_prompt(context, task, fix_history=None, boundary=None, structured=False):
+    rules = _get_execution_prompt_rules(boundary, structured)
     history_prompt_section = ""
     if fix_history:
         history_prompt_section = f"""
@@ -569,18 +1104,23 @@ def get_initial_prompt(context, task, fix_history=None, boundary=None):
 --- КОНЕЦ ИСТОРИИ ---
 Проанализируй свою прошлую ошибку и начни заново.
 """
-    return f"""{rules}
-{history_prompt_section}
---- КОНТЕКСТ ПРОЕКТА (ПОЛНЫЙ ИЛИ ЧАСТИЧНЫЙ) ---
-{context}
---- КОНЕЦ КОНТЕКСТА ---
-Задача: {task}
-Проанализируй задачу и предоставь ответ, строго следуя правилам исполнения.
-"""
-
-def get_review_prompt(context, goal, iteration_count, attempt_history, boundary=None):
-    return f"""{_get_execution_prompt_rules(boundary)}
-
+    return PromptText([
+        ("rules", f"{rules}\n"),
+        ("history", history_prompt_section),
+        ("context", f"\n--- КОНТЕКСТ ПРОЕКТА (ПОЛНЫЙ ИЛИ ЧАСТИЧНЫЙ) ---\n{context}\n--- КОНЕЦ КОНТЕКСТА ---\n"),
+        ("task", f"Задача: {task}\n"),
+        ("instructions", "Проанализируй задачу и предоставь ответ, строго следуя правилам исполнения.\n"),
+    ])
+
+def format_attempt_history(history):
+    """История попыток для промпта: у sloth_history.AttemptHistory — дайджест старых записей
+    плюс последние дословно; обычный список склеивается целиком."""
+    if not history:
+        return ""
+    entries = history.for_prompt() if hasattr(history, "for_prompt") else list(history)
+    return "\n---\n".join(str(e) for e in entries)
+
+_REVIEW_INSTRUCTIONS = """
 **ЦЕЛЬ:** Проведи осмотр кода и выполни необходимую доработку минимально достаточным количеством действий. Избегай перфекционизма.
 
 Если цель уже достигнута — верни `done_summary` и `ГОТОВО`.
@@ -597,18 +1137,19 @@ path/to/file2
 ```
 Если список файлов совпадает с предыдущими итерациями и нет новых ошибок — остановись и верни `done_summary`.
 
---- ПАМЯТКА ПРО ИСТОРИЮ ---
-Используй краткую историю предыдущих попыток, чтобы избежать повторов и микро‑изменений:
-{attempt_history}
-
-{context}
---- КОНЕЦ КОНТЕКСТА ---
-
-Напоминаю ИСХОДНУЮ ЦЕЛЬ: {goal}
 """
 
-def get_error_fixing_prompt(failed_command, error_message, goal, context, iteration_count, attempt_history, boundary=None):
-    rules = _get_execution_prompt_rules(boundary)
+def get_review_prompt(context, goal, iteration_count, attempt_history, boundary=None, structured=False):
+    return PromptText([
+        ("rules", f"{_get_execution_prompt_rules(boundary, structured)}\n"),
+        ("instructions", _REVIEW_INSTRUCTIONS),
+        ("history", f"--- ПАМЯТКА ПРО ИСТОРИЮ ---\nИспользуй краткую историю предыдущих попыток, чтобы избежать повторов и микро‑изменений:\n{format_attempt_history(attempt_history)}\n\n"),
+        ("context", f"{context}\n--- КОНЕЦ КОНТЕКСТА ---\n\n"),
+        ("task", f"Напоминаю ИСХОДНУЮ ЦЕЛЬ: {goal}\n"),
+    ])
+
+def get_error_fixing_prompt(failed_command, error_message, goal, context, iteration_count, attempt_history, boundary=None, structured=False):
+    rules = _get_execution_prompt_rules(boundary, structured)
     iteration_info = ""
     if iteration_count >= 4:
         iteration_info = f"\n**ОСОБОЕ ВНИМАНИЕ (Итерация {iteration_count}):** Произошла ошибка — подумай шире и исправь её надёжно.\n"
@@ -616,39 +1157,29 @@ def get_error_fixing_prompt(failed_command, error_message, goal, context, iterat
     if attempt_history:
         history_info = (
             "--- ИСТОРИЯ ПРЕДЫДУЩИХ ПОПЫТОК ---\n" +
-            "\n---\n".join(attempt_history) +
+            format_attempt_history(attempt_history) +
             "\n--- КОНЕЦ ИСТОРИИ ---\n"
         )
-    return f"""{rules}
-{iteration_info}
-{history_info}
-**ВАЖНО:** Исправь ошибку. Не пиши `ГОТОВО`.
-
---- ДАННЫЕ ОБ ОШИБКЕ ---
-КОМАНДА: {failed_command}
-СООБЩЕНИЕ (stderr): {error_message}
---- КОНЕЦ ДАННЫХ ОБ ОШИБКЕ ---
-
-Исходная ЦЕЛЬ была: {goal}
-
-Дай исправленный блок команд и `summary`.
-
---- КОНТЕКСТ, ГДЕ ПРОИЗОШЛА ОШИБКА ---
-{context}
---- КОНЕЦ КОНТЕКСТА ---
-"""
-
-def get_log_analysis_prompt(context, goal, history, logs, boundary=None):
-    rules = _get_execution_prompt_rules(boundary)
+    return PromptText([
+        ("rules", f"{rules}\n{iteration_info}\n"),
+        ("history", f"{history_info}\n"),
+        ("instructions", "**ВАЖНО:** Исправь ошибку. Не пиши `ГОТОВО`.\n\n"),
+        ("error", f"--- ДАННЫЕ ОБ ОШИБКЕ ---\nКОМАНДА: {failed_command}\nСООБЩЕНИЕ (stderr): {error_message}\n--- КОНЕЦ ДАННЫХ ОБ ОШИБКЕ ---\n\n"),
+        ("task", f"Исходная ЦЕЛЬ была: {goal}\n\n"),
+        ("instructions", "Дай исправленный блок команд и `summary`.\n\n"),
+        ("context", f"--- КОНТЕКСТ, ГДЕ ПРОИЗОШЛА ОШИБКА ---\n{context}\n--- КОНЕЦ КОНТЕКСТА ---\n"),
+    ])
+
+def get_log_analysis_prompt(context, goal, history, logs, boundary=None, structured=False):
+    rules = _get_execution_prompt_rules(boundary, structured)
     history_info = ""
     if history:
         history_info = (
             "--- ИСТОРИЯ ПРЕДЫДУЩИХ ПОПЫТОК ---\n" +
-            str(history) +
+            format_attempt_history(history) +
             "\n--- КОНЕЦ ИСТОРИИ ---\n"
         )
-    return f"""{rules}
-
+    instructions = """
 Ты находишься в режиме АНАЛИЗА ЛОГОВ (эту стадию выполняет быстрая модель). Программа запускалась примерно 10 секунд и затем целенаправленно останавливалась. Провалом считаются только:
 * явные ошибки (Traceback/Error/SyntaxError/failed/Cannot find module и т.п.),
 * или логи, которые свидетельствуют о несоответствии поставленной цели.
@@ -657,17 +1188,38 @@ def get_log_analysis_prompt(context, goal, history, logs, boundary=None):
 1) Если цель достигнута — верни блок `done_summary` и напиши слово `ГОТОВО`.
 2) Если нет — верни лаконичный `summary` с диагнозом (что не так в логах) и ЧТО должна сделать старшая модель в следующей итерации. Никаких `write_file`/`bash`/`verify_run` здесь не возвращай.
 
-{history_info}
---- ЛОГИ ЗАПУСКА ---
-{logs}
---- КОНЕЦ ЛОГОВ ---
-
---- КОНТЕКСТ ПРОЕКТА (ОБНОВЛЁННЫЙ) ---
-{context}
---- КОНЕЦ КОНТЕКСТА ---
-
-Исходная ЦЕЛЬ: {goal}
 """
+    return PromptText([
+        ("rules", f"{rules}\n"),
+        ("instructions", instructions),
+        ("history", f"{history_info}\n"),
+        ("logs", f"--- ЛОГИ ЗАПУСКА ---\n{logs}\n--- КОНЕЦ ЛОГОВ ---\n\n"),
+        ("context", f"--- КОНТЕКСТ ПРОЕКТА (ОБНОВЛЁННЫЙ) ---\n{context}\n--- КОНЕЦ КОНТЕКСТА ---\n\n"),
+        ("task", f"Исходная ЦЕЛЬ: {goal}\n"),
+    ])
+
+def get_session_turn_prompt(phase, goal, iteration_count, new_history, changed_files_text,
+                            failed_command=None, error_message=None, logs=None):
+    """
+    Очередной ход чат-сессии (sloth_session): правила и контекст проекта модель уже получила
+    в первом сообщении сессии, здесь — только новое: записи истории с прошлого хода,
+    актуальное содержимое изменённых файлов, ошибка/логи и инструкция фазы.
+    """
+    sections = [("rules", f"--- ИТЕРАЦИЯ {iteration_count} ({phase}) ---\n"
+                          "Правила ответа и формат блоков — те же, что в первом сообщении сессии.\n\n")]
+    if new_history:
+        sections.append(("history", "--- НОВОЕ В ИСТОРИИ ПОПЫТОК ---\n" + "\n---\n".join(new_history) + "\n--- КОНЕЦ ИСТОРИИ ---\n\n"))
+    if changed_files_text:
+        sections.append(("context", "--- ИЗМЕНЁННЫЕ ФАЙЛЫ (АКТУАЛЬНОЕ СОДЕРЖИМОЕ) ---" + changed_files_text + "\n--- КОНЕЦ ИЗМЕНЁННЫХ ФАЙЛОВ ---\n\n"))
+    if phase == "FIXING_ERROR":
+        sections.append(("error", f"--- ДАННЫЕ ОБ ОШИБКЕ ---\nКОМАНДА: {failed_command}\nСООБЩЕНИЕ (stderr): {error_message}\n--- КОНЕЦ ДАННЫХ ОБ ОШИБКЕ ---\n\n"))
+        sections.append(("instructions", "**ВАЖНО:** Исправь ошибку. Не пиши `ГОТОВО`. Дай исправленный блок команд и `summary`.\n\n"))
+    else:
+        if logs:
+            sections.append(("logs", f"--- ПОСЛЕДНИЕ ЛОГИ ---\n{logs}\n--- КОНЕЦ ЛОГОВ ---\n\n"))
+        sections.append(("instructions", _REVIEW_INSTRUCTIONS.lstrip("\n")))
+    sections.append(("task", f"Напоминаю ИСХОДНУЮ ЦЕЛЬ: {goal}\n"))
+    return PromptText(sections)
 
 def get_context_prep_prompt(context_chunk: str, goal: str, boundary: str | None = None) -> str:
     """
@@ -699,6 +1251,19 @@ def get_context_prep_prompt(context_chunk: str, goal: str, boundary: str | None
 Выведи только список путей в блоке ```files```. Пути должны быть относительными к корню проекта.
 """
 
+def get_history_summary_prompt(digest: str, goal: str) -> str:
+    """Промпт для дешёвой модели: ужать дайджест старых попыток (sloth_history) до нескольких пунктов."""
+    return f"""Сожми историю прошлых попыток агента до 5–8 коротких пунктов: что пробовали, какие файлы трогали,
+какие ошибки повторялись и что точно НЕ сработало. Не предлагай решений, не добавляй фактов, которых нет в истории.
+Ответь только списком пунктов, без вступления.
+
+Исходная ЦЕЛЬ: {goal}
+
+--- ИСТОРИЯ ---
+{digest}
+--- КОНЕЦ ИСТОРИИ ---
+"""
+
 planning_rules = f"""
 Ты — AI-планировщик. Первая задача — убедиться, что исходная задача понятна.
 
@@ -0,0 +1,199 @@
+# Файл: sloth_edits.py
+"""
+Точечные правки файлов (блок edit_file) для Sloth.
+
+write_file заставляет модель заново генерировать весь файл ради пары строк; edit_file
+передаёт только изменённые фрагменты. Содержимое блока — один или несколько хунков
+в одном из двух форматов:
+
+  SEARCH/REPLACE:              unified diff (строки хунков после @@):
+    <<<<<<< SEARCH               @@ -10,3 +10,4 @@
+    старые строки                 контекст
+    =======                      -старая строка
+    новые строки                 +новая строка
+    >>>>>>> REPLACE               контекст
+
+Применение (apply_edit) — в памяти, по порядку хунков:
+  1) точное совпадение фрагмента целыми строками (должно быть единственным);
+  2) без учёта пробелов в конце строк;
+  3) без учёта отступов — замена переотступается на разницу отступов найденного места.
+Неоднозначное или отсутствующее совпадение — EditError с номером хунка и ближайшим
+похожим местом файла (строка и степень сходства). Файл не трогается, если не применился
+хотя бы один хунк. Пустой SEARCH допустим только для нового/пустого файла.
+Маркеры распознаются только с начала строки — строки с отступом внутри хунков
+(например, сами маркеры в тексте промпта) считаются содержимым.
+"""
+
+import difflib
+import re
+from typing import List, Optional, Tuple
+
+import config as sloth_config
+
+SEARCH_MARKER = "<<<<<<< SEARCH"
+DIVIDER_MARKER = "======="
+REPLACE_MARKER = ">>>>>>> REPLACE"
+_HUNK_HEADER_RE = re.compile(r"^@@.*@@")
+WHITESPACE_TOLERANT = bool(sloth_config.get("edits.whitespace_tolerant", True))
+
+
+class EditError(ValueError):
+    """Правка не применилась; сообщение пригодно для отправки модели как есть."""
+
+
+def parse_hunks(content: str) -> List[Tuple[str, str]]:
+    """Хунки блока edit_file: [(search, replace)]. Формат определяется по маркерам."""
+    if any(line.rstrip() == SEARCH_MARKER for line in content.splitlines()):
+        return _parse_search_replace(content)
+    if any(_HUNK_HEADER_RE.match(line) for line in content.splitlines()):
+        return _parse_unified_diff(content)
+    raise EditError(f"edit_file: не найдено ни одного хунка (ожидались маркеры {SEARCH_MARKER} / {DIVIDER_MARKER} / {REPLACE_MARKER} или заголовки @@ unified diff).")
+
+
+def _parse_search_replace(content: str) -> List[Tuple[str, str]]:
+    hunks, lines = [], content.splitlines()
+    i = 0
+    while i < len(lines):
+        if lines[i].rstrip() != SEARCH_MARKER:
+            i += 1
+            continue
+        start = i + 1
+        try:
+            mid = next(j for j in range(start, len(lines)) if lines[j].rstrip() == DIVIDER_MARKER)
+            end = next(j for j in range(mid + 1, len(lines)) if lines[j].rstrip() == REPLACE_MARKER)
+        except StopIteration:
+            raise EditError(f"edit_file: хунк {len(hunks) + 1} не закрыт (нет {DIVIDER_MARKER} или {REPLACE_MARKER}).")
+        hunks.append(("\n".join(lines[start:mid]), "\n".join(lines[mid + 1:end])))
+        i = end + 1
+    return hunks
+
+
+def _parse_unified_diff(content: str) -> List[Tuple[str, str]]:
+    hunks, search, replace, in_hunk = [], [], [], False
+
+    def flush():
+        if in_hunk and (search or replace):
+            hunks.append(("\n".join(search), "\n".join(replace)))
+
+    for line in content.splitlines():
+        if line.startswith(("--- ", "+++ ")) and not in_hunk:
+            continue
+        if _HUNK_HEADER_RE.match(line):
+            flush()
+            search, replace, in_hunk = [], [], True
+            continue
+        if not in_hunk or line.startswith("\\"):
+            # "\ No newline at end of file" и текст до первого @@
+            continue
+        tag, text = (line[:1], line[1:]) if line else (" ", "")
+        if tag == "-":
+            search.append(text)
+        elif tag == "+":
+            replace.append(text)
+        else:
+            search.append(text)
+            replace.append(text)
+    flush()
+    return hunks
+
+
+def _indent(line: str) -> str:
+    return line[: len(line) - len(line.lstrip())]
+
+
+def _find_lines(lines: List[str], needle: List[str], key) -> List[int]:
+    """Начальные индексы всех вхождений needle в lines при сравнении строк по key."""
+    if not needle or len(needle) > len(lines):
+        return []
+    keyed = [key(l) for l in lines]
+    target = [key(l) for l in needle]
+    first = target[0]
+    return [i for i in range(len(lines) - len(needle) + 1)
+            if keyed[i] == first and keyed[i:i + len(needle)] == target]
+
+
+def _closest(lines: List[str], needle: List[str]) -> Optional[Tuple[int, float]]:
+    """Ближайший по сходству фрагмент файла той же длины: (номер строки с 1, сходство)."""
+    if not needle or not lines:
+        return None
+    target = "\n".join(l.strip() for l in needle)
+    stripped = [l.strip() for l in lines]
+    window = len(needle)
+    best = (0, 0.0)
+    for i in range(max(1, len(lines) - window + 1)):
+        matcher = difflib.SequenceMatcher(None, "\n".join(stripped[i:i + window]), target, autojunk=False)
+        if matcher.quick_ratio() <= best[1]:
+            continue
+        ratio = matcher.ratio()
+        if ratio > best[1]:
+            best = (i + 1, ratio)
+    return best
+
+
+def _apply_hunk(text: str, search: str, replace: str, number: int) -> str:
+    if not search.strip():
+        if text.strip():
+            raise EditError(f"Хунк {number}: пустой SEARCH допустим только для нового или пустого файла.")
+        return replace + ("\n" if replace and not replace.endswith("\n") else "")
+
+    lines = text.split("\n")
+    needle = search.split("\n")
+    # Пустые строки по краям SEARCH модель часто добавляет/теряет — не считаем их значимыми
+    new_lines = replace.split("\n")
+    while needle and not needle[0].strip():
+        needle.pop(0)
+        if new_lines and not new_lines[0].strip():
+            new_lines.pop(0)
+    while needle and not needle[-1].strip():
+        needle.pop()
+        if new_lines and not new_lines[-1].strip():
+            new_lines.pop()
+    # Совпадение ищется только целыми строками: `val = 2` не должен попасть в `my_val = 2`
+    steps = [(lambda l: l, False)]
+    if WHITESPACE_TOLERANT:
+        steps += [(str.rstrip, False), (str.strip, True)]
+    for key, reindent in steps:
+        found = _find_lines(lines, needle, key)
+        if len(found) > 1:
+            what = "фрагмент SEARCH" if key is steps[0][0] else "фрагмент SEARCH (без учёта пробелов)"
+            raise EditError(f"Хунк {number}: {what} встречается в файле {len(found)} раз "
+                            f"(строки {', '.join(str(i + 1) for i in found[:5])}) — добавь строк контекста, чтобы он стал уникальным.")
+        if found:
+            start = found[0]
+            if reindent:
+                new_lines = _reindent(new_lines, needle[0], lines[start])
+            return "\n".join(lines[:start] + new_lines + lines[start + len(needle):])
+
+    hint = ""
+    closest = _closest(lines, needle)
+    if closest and closest[1] >= 0.5:
+        line_no, ratio = closest
+        snippet = "\n".join(lines[line_no - 1:line_no - 1 + min(len(needle), 8)])
+        hint = f"\nБлиже всего (сходство {ratio:.0%}) строки {line_no}–{line_no + len(needle) - 1}:\n{snippet}"
+    raise EditError(f"Хунк {number}: фрагмент SEARCH не найден в файле (первая строка: {needle[0].strip()[:120]!r}).{hint}")
+
+
+def _reindent(new_lines: List[str], search_first: str, found_first: str) -> List[str]:
+    """Сдвигает отступ замены на разницу между отступом SEARCH и найденного места."""
+    want, have = _indent(found_first), _indent(search_first)
+    if want == have:
+        return new_lines
+    result = []
+    for line in new_lines:
+        if line.startswith(have):
+            result.append(want + line[len(have):])
+        else:
+            result.append(line)
+    return result
+
+
+def apply_edit(original: str, content: str) -> Tuple[str, int]:
+    """Применяет все хунки блока к тексту файла. Возвращает (новый текст, число хунков)."""
+    hunks = parse_hunks(content)
+    if not hunks:
+        raise EditError("edit_file: блок не содержит хунков.")
+    crlf = "\r\n" in original
+    text = original.replace("\r\n", "\n") if crlf else original
+    for number, (search, replace) in enumerate(hunks, start=1):
+        text = _apply_hunk(text, search, replace, number)
+    return (text.replace("\n", "\r\n") if crlf else text), len(hunks)
@@ -0,0 +1,240 @@
+# Файл: sloth_health.py
+"""
+Трекер здоровья бэкендов модели (GenAI / Legacy / Vertex) для Sloth.
+
+- Для каждого бэкенда держим скользящее окно последних запросов: латентность и успех/ошибка.
+- По окну считаем перцентили латентности (p50/p95) и долю ошибок.
+- Circuit breaker: CLOSED → OPEN (после серии ошибок или высокой доли ошибок)
+  → HALF_OPEN (после cooldown, пропускаем один пробный запрос) → CLOSED при успехе.
+- pick() выбирает самый здоровый и быстрый бэкенд; когда цепь восстанавливается,
+  бэкенд автоматически снова участвует в выборе.
+
+Настройки (sloth_config.json, секция "health"):
+  window, failure_threshold, error_rate_threshold, min_samples,
+  cooldown_seconds, max_cooldown_seconds.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+import config as sloth_config
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль (линейная интерполяция) для небольшого списка значений."""
+    if not values:
+        return 0.0
+    data = sorted(values)
+    if len(data) == 1:
+        return float(data[0])
+    k = (len(data) - 1) * max(0.0, min(100.0, pct)) / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(data) - 1)
+    return float(data[lo] + (data[hi] - data[lo]) * (k - lo))
+
+
+class BackendHealth:
+    """Состояние одного бэкенда: окно наблюдений и цепь."""
+
+    def __init__(self, name: str, priority: int, window: int):
+        self.name = name
+        self.priority = priority
+        self.samples = deque(maxlen=window)  # (timestamp, latency_sec, ok)
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+        self.probe_in_flight = False
+        self.last_error = None
+
+    def latencies(self) -> List[float]:
+        return [lat for _, lat, ok in self.samples if ok]
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+
+class HealthTracker:
+    def __init__(self, window: Optional[int] = None, failure_threshold: Optional[int] = None,
+                 error_rate_threshold: Optional[float] = None, min_samples: Optional[int] = None,
+                 cooldown_seconds: Optional[float] = None, max_cooldown_seconds: Optional[float] = None):
+        self.window = int(window if window is not None else sloth_config.get("health.window", 20))
+        self.failure_threshold = int(failure_threshold if failure_threshold is not None
+                                     else sloth_config.get("health.failure_threshold", 3))
+        self.error_rate_threshold = float(error_rate_threshold if error_rate_threshold is not None
+                                          else sloth_config.get("health.error_rate_threshold", 0.5))
+        self.min_samples = int(min_samples if min_samples is not None else sloth_config.get("health.min_samples", 4))
+        self.cooldown_seconds = float(cooldown_seconds if cooldown_seconds is not None
+                                      else sloth_config.get("health.cooldown_seconds", 60))
+        self.max_cooldown_seconds = float(max_cooldown_seconds if max_cooldown_seconds is not None
+                                          else sloth_config.get("health.max_cooldown_seconds", 600))
+        self._backends: Dict[str, BackendHealth] = {}
+        self._lock = threading.Lock()
+
+    # --- регистрация ---
+    def register(self, name: str, priority: int = 0) -> None:
+        with self._lock:
+            if name not in self._backends:
+                self._backends[name] = BackendHealth(name, priority, self.window)
+            else:
+                self._backends[name].priority = priority
+
+    def _get(self, name: str) -> BackendHealth:
+        b = self._backends.get(name)
+        if b is None:
+            b = BackendHealth(name, len(self._backends), self.window)
+            self._backends[name] = b
+        return b
+
+    # --- состояние цепи ---
+    def _refresh_state(self, b: BackendHealth, now: float) -> None:
+        if b.state == OPEN and now - b.opened_at >= b.cooldown:
+            b.state = HALF_OPEN
+            b.probe_in_flight = False
+
+    def _open(self, b: BackendHealth, now: float) -> None:
+        # Повторное открытие из HALF_OPEN удваивает cooldown (до потолка)
+        if b.state == HALF_OPEN and b.cooldown:
+            b.cooldown = min(self.max_cooldown_seconds, b.cooldown * 2)
+        else:
+            b.cooldown = self.cooldown_seconds
+        b.state = OPEN
+        b.opened_at = now
+        b.probe_in_flight = False
+
+    def state(self, name: str) -> str:
+        with self._lock:
+            b = self._get(name)
+            self._refresh_state(b, time.time())
+            return b.state
+
+    def is_available(self, name: str) -> bool:
+        with self._lock:
+            b = self._get(name)
+            self._refresh_state(b, time.time())
+            if b.state == CLOSED:
+                return True
+            if b.state == HALF_OPEN:
+                return not b.probe_in_flight
+            return False
+
+    # --- наблюдения ---
+    def record_success(self, name: str, latency: float) -> None:
+        with self._lock:
+            now = time.time()
+            b = self._get(name)
+            b.samples.append((now, float(latency), True))
+            b.consecutive_failures = 0
+            b.last_error = None
+            if b.state != CLOSED:
+                b.state = CLOSED
+                b.cooldown = 0.0
+            b.probe_in_flight = False
+
+    def record_failure(self, name: str, latency: float = 0.0, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            now = time.time()
+            b = self._get(name)
+            b.samples.append((now, float(latency), False))
+            b.consecutive_failures += 1
+            b.last_error = str(error) if error is not None else None
+            self._refresh_state(b, now)
+            if b.state == HALF_OPEN:
+                self._open(b, now)
+            elif b.state == CLOSED:
+                too_many_in_row = b.consecutive_failures >= self.failure_threshold
+                too_many_in_window = (len(b.samples) >= self.min_samples
+                                      and b.error_rate() >= self.error_rate_threshold)
+                if too_many_in_row or too_many_in_window:
+                    self._open(b, now)
+
+    # --- выбор ---
+    def _score(self, b: BackendHealth) -> tuple:
+        lats = b.latencies()
+        if not lats:
+            return (0.0, b.priority)
+        p50 = percentile(lats, 50)
+        p95 = percentile(lats, 95)
+        # Ошибки штрафуют латентность: бэкенд с 50% ошибок «в полтора раза медленнее»
+        penalized = (0.7 * p50 + 0.3 * p95) * (1.0 + b.error_rate())
+        return (penalized, b.priority)
+
+    def pick(self, candidates: Iterable[str], preferred: Optional[str] = None) -> Optional[str]:
+        """Возвращает самый здоровый и быстрый бэкенд из candidates (или None).
+
+        Бэкенды без наблюдений выбираются по приоритету раньше, чем бэкенды со статистикой,
+        только если статистики нет ни у кого — иначе сравниваем по латентности.
+        В HALF_OPEN бэкенд получает ровно один пробный запрос.
+        """
+        with self._lock:
+            now = time.time()
+            names = [c for c in candidates]
+            if not names:
+                return None
+            allowed: List[BackendHealth] = []
+            for n in names:
+                b = self._get(n)
+                self._refresh_state(b, now)
+                if b.state == CLOSED or (b.state == HALF_OPEN and not b.probe_in_flight):
+                    allowed.append(b)
+            if not allowed:
+                # Все цепи открыты — берём тот, у которого cooldown истечёт раньше всех
+                b = min((self._get(n) for n in names), key=lambda x: x.opened_at + x.cooldown)
+                return b.name
+            # Пробный запрос в HALF_OPEN имеет приоритет: так восстановление происходит автоматически
+            half_open = [b for b in allowed if b.state == HALF_OPEN]
+            if half_open:
+                b = min(half_open, key=lambda x: x.priority)
+                b.probe_in_flight = True
+                return b.name
+            known = [b for b in allowed if b.latencies()]
+            unknown = [b for b in allowed if not b.latencies()]
+            if unknown and not known:
+                if preferred and any(b.name == preferred for b in unknown):
+                    return preferred
+                return min(unknown, key=lambda x: x.priority).name
+            if unknown:
+                # Неопробованный бэкенд с более высоким приоритетом, чем лучший известный, — пробуем его
+                best_known = min(known, key=self._score)
+                best_unknown = min(unknown, key=lambda x: x.priority)
+                if best_unknown.priority < best_known.priority:
+                    return best_unknown.name
+                return best_known.name
+            return min(known, key=self._score).name
+
+    def ordered(self, candidates: Iterable[str], preferred: Optional[str] = None) -> List[str]:
+        """Порядок обхода бэкендов для failover: лучший первым, затем остальные доступные по скору."""
+        names = list(candidates)
+        first = self.pick(names, preferred)
+        if first is None:
+            return []
+        rest = [n for n in names if n != first and self.is_available(n)]
+        with self._lock:
+            rest.sort(key=lambda n: self._score(self._get(n)))
+        return [first] + rest
+
+    # --- отчёт ---
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        with self._lock:
+            now = time.time()
+            out: Dict[str, Dict[str, object]] = {}
+            for name, b in self._backends.items():
+                self._refresh_state(b, now)
+                lats = b.latencies()
+                out[name] = {
+                    "state": b.state,
+                    "requests": len(b.samples),
+                    "error_rate": b.error_rate(),
+                    "p50": percentile(lats, 50),
+                    "p95": percentile(lats, 95),
+                    "last_error": b.last_error,
+                }
+            return out
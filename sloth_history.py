@@ -0,0 +1,149 @@
+# Файл: sloth_history.py
+"""
+История попыток (attempt_history) для Sloth с ограниченным размером.
+
+Раньше каждая запись (стратегия целиком, ошибки, изменённые файлы) копилась без
+ограничений и целиком уходила в каждый промпт ревью/исправления/анализа логов.
+
+AttemptHistory ведёт себя как список записей, но в промпт отдаёт for_prompt():
+  - последние history.keep_last записей — дословно;
+  - более старые свёрнуты в детерминированный дайджест: по итерации — фаза, исход,
+    начало стратегии, затронутые файлы и сигнатура ошибки; плюс сводка часто меняемых файлов и
+    повторяющихся ошибок. Дайджест ужимается под history.digest_max_tokens
+    (сначала выпадают самые старые строки, сводка остаётся).
+  - опционально (history.llm_summary) поверх дайджеста — короткое резюме от дешёвой
+    модели; при любой ошибке остаётся детерминированный вариант.
+
+Настройки (sloth_config.json, секция "history"):
+  keep_last, digest_max_tokens, max_error_chars, llm_summary.
+"""
+
+import re
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+import config as sloth_config
+
+_ITERATION_RE = re.compile(r"\*\*Итерация (\d+) \(([A-Z_]+)\):\*\*")
+_STRATEGY_RE = re.compile(r"\*\*Стратегия:\*\* ([^\n]*)")
+_FILES_RE = re.compile(r"\*\*Изменены файлы:\*\* ([^\n]*)")
+_RESULT_RE = re.compile(r"\*\*Результат:\*\* ([^\n]*)")
+_ERROR_RE = re.compile(r"\*\*Ошибка:\*\* (.*)", re.S)
+# Строка, по которой ошибку проще всего узнать: имя исключения или явный маркер
+_ERROR_LINE_RE = re.compile(r"(\w+(?:Error|Exception)\b.*|.*\b(?:error|failed|cannot|not found)\b.*)", re.I)
+_NOISE_RE = re.compile(r"0x[0-9a-f]+|\d+", re.I)
+
+
+def error_signature(message: str, max_chars: int = 120) -> str:
+    """Короткая стабильная сигнатура ошибки: характерная строка без номеров строк/адресов."""
+    lines = [l.strip() for l in (message or "").splitlines() if l.strip()]
+    if not lines:
+        return ""
+    matches = [l for l in lines if _ERROR_LINE_RE.fullmatch(l)]
+    line = matches[-1] if matches else lines[-1]
+    line = _NOISE_RE.sub("N", line)
+    return line if len(line) <= max_chars else line[:max_chars - 1] + "…"
+
+
+def _estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+class AttemptHistory(list):
+    def __init__(self, keep_last: Optional[int] = None, max_digest_tokens: Optional[int] = None,
+                 summarizer: Optional[Callable[[str], Optional[str]]] = None):
+        super().__init__()
+        self.keep_last = max(1, int(keep_last if keep_last is not None else sloth_config.get("history.keep_last", 4)))
+        self.max_digest_tokens = int(max_digest_tokens if max_digest_tokens is not None
+                                     else sloth_config.get("history.digest_max_tokens", 800))
+        self.max_error_chars = int(sloth_config.get("history.max_error_chars", 120))
+        self.summarizer = summarizer if sloth_config.get("history.llm_summary", False) else None
+        self._digest_cache: Dict[int, str] = {}
+
+    # --- разбор записи ---
+    def _facts(self, entry: str) -> Dict[str, str]:
+        head = _ITERATION_RE.search(entry)
+        strategy = _STRATEGY_RE.search(entry)
+        files = _FILES_RE.search(entry)
+        result = _RESULT_RE.search(entry)
+        error = _ERROR_RE.search(entry)
+        return {
+            "iteration": head.group(1) if head else "?",
+            "phase": head.group(2) if head else "—",
+            "strategy": strategy.group(1).strip() if strategy else "",
+            "files": files.group(1).strip() if files else "",
+            "outcome": result.group(1).strip() if result else "—",
+            "error": error_signature(error.group(1), self.max_error_chars) if error else "",
+        }
+
+    # --- дайджест ---
+    def digest(self) -> str:
+        """Детерминированный дайджест свёрнутых записей (всех, кроме последних keep_last)."""
+        folded = self[:-self.keep_last] if len(self) > self.keep_last else []
+        if not folded:
+            return ""
+        cached = self._digest_cache.get(len(folded))
+        if cached is not None:
+            return cached
+        facts = [self._facts(e) for e in folded]
+        lines = []
+        for f in facts:
+            line = f"- Итерация {f['iteration']} ({f['phase']}): {f['outcome']}"
+            if f["strategy"]:
+                strategy = f["strategy"]
+                line += f"; стратегия: {strategy if len(strategy) <= 80 else strategy[:79] + '…'}"
+            if f["files"]:
+                line += f"; файлы: {f['files']}"
+            if f["error"]:
+                line += f"; ошибка: {f['error']}"
+            lines.append(line)
+        file_counts = Counter(p.strip() for f in facts for p in f["files"].split(",") if p.strip() and p.strip() != "—")
+        error_counts = Counter(f["error"] for f in facts if f["error"])
+        summary = []
+        if file_counts:
+            summary.append("Чаще всего менялись: " + ", ".join(f"{p}×{n}" for p, n in file_counts.most_common(8)))
+        repeated = [(e, n) for e, n in error_counts.most_common(5) if n > 1]
+        if repeated:
+            summary.append("Повторяющиеся ошибки: " + "; ".join(f"{e} (×{n})" for e, n in repeated))
+
+        header = f"**Сжатая история (итерации {facts[0]['iteration']}–{facts[-1]['iteration']}, {len(facts)} шт.):**"
+        body = self._fit(header, lines, summary)
+        if self.summarizer:
+            body = self._with_model_summary(header, body, summary)
+        self._digest_cache = {len(folded): body}
+        return body
+
+    def _fit(self, header: str, lines: List[str], summary: List[str]) -> str:
+        """Собирает дайджест под лимит токенов: выбрасывает самые старые строки, сводку сохраняет."""
+        dropped = 0
+        while True:
+            shown = lines[dropped:]
+            parts = [header]
+            if dropped:
+                parts.append(f"- …ещё {dropped} ранних итераций опущено")
+            parts += shown + summary
+            text = "\n".join(parts)
+            if _estimate_tokens(text) <= self.max_digest_tokens or not shown:
+                break
+            dropped += 1
+        limit = self.max_digest_tokens * 4
+        return text if len(text) <= limit else text[:limit - 1] + "…"
+
+    def _with_model_summary(self, header: str, body: str, summary: List[str]) -> str:
+        try:
+            text = (self.summarizer(body) or "").strip()
+        except Exception:
+            text = ""
+        if not text:
+            return body
+        return self._fit(header, [text], summary)
+
+    # --- для промпта ---
+    def for_prompt(self) -> List[str]:
+        """Записи для промпта: дайджест старых + последние keep_last дословно."""
+        recent = list(self[-self.keep_last:])
+        digest = self.digest()
+        return ([digest] if digest else []) + recent
+
+    def render(self) -> str:
+        return "\n---\n".join(self.for_prompt())
@@ -0,0 +1,143 @@
+# Файл: sloth_leaks.py
+"""
+Поиск утечек протокола в файлах проекта перед verify для Sloth.
+
+Модель иногда оставляет в коде служебные куски ответа: маркер SLOTH_BOUNDARY
+(в том числе SLOTH_BOUNDARY_<hex> текущего запуска), заголовки блоков протокола
+(```write_file, ```edit_file, ```verify_run …) и маркеры хунков edit_file
+(<<<<<<< SEARCH / >>>>>>> REPLACE). Раньше перед каждым verify весь проект
+обходился заново, а пропуск node_modules/.git не работал: `continue` по имени
+папки не мешал os.walk спускаться в её подпапки.
+
+LeakScanner:
+  - сканирует только файлы, изменённые с прошлого скана (note_changes() после
+    каждой итерации); первый скан сессии — полный, чтобы поймать утечки
+    прошлых запусков. Файлы с находками остаются в очереди до исправления;
+  - при обходе папок отсекает их целиком (dirnames[:] = …): sloth_tree.OPAQUE_DIRS
+    и скрытые папки (явно изменённые файлы в скрытых папках проверяются);
+  - шаблоны проверяются по байтам файла в два шага: сначала быстрые поиски
+    подстрок (SLOTH_BOUNDARY, ```, <<<<<<<, >>>>>>>) на C-скорости отсеивают
+    чистые файлы — а это почти все; затем только в подозрительных файлах одно
+    регулярное выражение с альтернативами находит все виды утечек за один проход
+    (альтернация в re сама по себе в десятки раз медленнее поиска подстроки).
+    Номер строки считается только для совпадений.
+Заголовки блоков ищутся только с начала строки и не в документации (.md и т.п.):
+там ```bash и подобное — обычный текст.
+"""
+
+import os
+import re
+from typing import Iterable, List, Optional, Set
+
+import sloth_tree
+
+# Типы блоков протокола (sloth_core.ACTION_TYPES) без bash/summary — те встречаются в обычной документации
+FENCE_TYPES = ("write_file", "edit_file", "verify_run", "done_summary", "files_to_change", "manual")
+_BOUNDARY = rb"(?P<boundary>SLOTH_BOUNDARY\w*)"
+_FENCE = rb"(?P<fence>^[ \t]*```(?:" + b"|".join(t.encode() for t in FENCE_TYPES) + rb")\b)"
+_HUNK = rb"(?P<hunk>^(?:<<<<<<< SEARCH|>>>>>>> REPLACE)[ \t]*\r?$)"
+ALL_PATTERNS = re.compile(b"|".join((_BOUNDARY, _FENCE, _HUNK)), re.MULTILINE)
+BOUNDARY_ONLY = re.compile(_BOUNDARY)
+# Подстроки, без которых ни один шаблон не совпадёт (быстрый отсев чистых файлов)
+ALL_LITERALS = (b"SLOTH_BOUNDARY", b"```", b"<<<<<<< SEARCH", b">>>>>>> REPLACE")
+BOUNDARY_LITERALS = (b"SLOTH_BOUNDARY",)
+KIND_LABELS = {"boundary": "маркер boundary", "fence": "заголовок блока", "hunk": "маркер хунка"}
+
+DOC_EXTENSIONS = {".md", ".mdx", ".markdown", ".rst", ".txt"}
+BINARY_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".pdf", ".zip", ".tar", ".gz", ".woff", ".woff2",
+    ".ttf", ".eot", ".mp4", ".mov", ".mp3", ".bin",
+}
+MAX_FILE_BYTES = 2 * 1024 * 1024
+
+
+def _skip_dir(name: str) -> bool:
+    return name in sloth_tree.OPAQUE_DIRS or name.startswith(".")
+
+
+def _scan_bytes(data: bytes, pattern, max_per_file: int) -> List[tuple]:
+    """Совпадения в данных файла: [(номер строки, вид, строка)]."""
+    hits = []
+    line_no, counted_to = 1, 0
+    for match in pattern.finditer(data):
+        start = match.start()
+        line_no += data.count(b"\n", counted_to, start)
+        counted_to = start
+        line_start = data.rfind(b"\n", 0, start) + 1
+        line_end = data.find(b"\n", start)
+        line = data[line_start:line_end if line_end >= 0 else len(data)]
+        hits.append((line_no, match.lastgroup, line.decode("utf-8", errors="replace").strip()))
+        if len(hits) >= max_per_file:
+            break
+    return hits
+
+
+class LeakScanner:
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        # None — ещё не было скана: первый скан полный
+        self.pending: Optional[Set[str]] = None
+        self.files_scanned = 0
+
+    def note_changes(self, rel_paths: Iterable[str]) -> None:
+        """Пути (файлы или папки), изменённые/созданные итерацией."""
+        if self.pending is not None:
+            self.pending |= {sloth_tree.normalize(p) for p in rel_paths if p}
+
+    def _expand(self, rel_paths: Iterable[str]) -> Set[str]:
+        """Файлы для скана: пути как есть, папки — обходом с отсечением служебных подпапок."""
+        files = set()
+        for rel in rel_paths:
+            if any(part in sloth_tree.OPAQUE_DIRS for part in rel.split("/")[:-1]):
+                continue
+            path = os.path.join(self.root, rel)
+            if os.path.isfile(path):
+                files.add(rel)
+                continue
+            if not os.path.isdir(path) or os.path.basename(rel) in sloth_tree.OPAQUE_DIRS:
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = [d for d in dirnames if not _skip_dir(d)]
+                rel_dir = os.path.relpath(dirpath, self.root)
+                for name in filenames:
+                    files.add(sloth_tree.normalize(os.path.join(rel_dir, name)))
+        return files
+
+    def scan(self, max_per_file: int = 3, max_findings: int = 50) -> List[str]:
+        """Находки вида "путь:строка: [вид] текст строки". Пустой список — утечек нет."""
+        targets = self._expand(["."] if self.pending is None else sorted(self.pending))
+        findings: List[str] = []
+        dirty: Set[str] = set()
+        self.files_scanned = 0
+        for rel in sorted(targets):
+            hits = self._scan_file(rel, max_per_file)
+            if hits:
+                dirty.add(rel)
+                findings += [f"{rel}:{line_no}: [{KIND_LABELS[kind]}] {text}" for line_no, kind, text in hits]
+                if len(findings) >= max_findings:
+                    # Остальные файлы очереди проверим в следующий раз
+                    dirty |= {t for t in targets if t > rel}
+                    break
+        self.pending = dirty
+        return findings[:max_findings]
+
+    def _scan_file(self, rel: str, max_per_file: int) -> List[tuple]:
+        ext = os.path.splitext(rel)[1].lower()
+        if ext in BINARY_EXTENSIONS:
+            return []
+        path = os.path.join(self.root, rel)
+        try:
+            if os.path.getsize(path) > MAX_FILE_BYTES:
+                return []
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return []
+        if b"\0" in data[:8192]:
+            return []
+        self.files_scanned += 1
+        pattern, literals = (BOUNDARY_ONLY, BOUNDARY_LITERALS) if ext in DOC_EXTENSIONS else (ALL_PATTERNS, ALL_LITERALS)
+        if not any(literal in data for literal in literals):
+            return []
+        return _scan_bytes(data, pattern, max_per_file)
+
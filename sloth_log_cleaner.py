@@ -2,7 +2,6 @@
 import os
 import sys
 import argparse
-from tkinter import Tk, filedialog
 
 from colors import Colors, Symbols
 
@@ -91,6 +90,7 @@ if __name__ == '__main__':
     if args.here:
         target_dir = os.getcwd()
     else:
+        from tkinter import Tk, filedialog
         print(f"{Colors.OKBLUE}Выберите папку проекта для очистки логов {SLOTH_TAG}...{Colors.ENDC}")
         root = Tk(); root.withdraw()
         target_dir = filedialog.askdirectory(title='Выберите папку проекта для очистки логов')
@@ -0,0 +1,147 @@
+# Файл: sloth_ratelimit.py
+"""
+Клиентский лимитер запросов к API модели (RPM/TPM) для Sloth, общий для всех процессов.
+
+- Два token bucket: запросы в минуту (rpm) и входные токены в минуту (tpm).
+  Ёмкость — минутная квота, пополнение — равномерно (квота / 60 в секунду).
+- Состояние вёдер лежит в локальном JSON-файле и меняется только под fcntl.flock,
+  поэтому несколько сессий Sloth с одним ключом API делят одну квоту.
+- acquire() не отправляет запрос «на удачу»: ждёт (с небольшим случайным сдвигом,
+  чтобы сессии не просыпались синхронно), пока в обоих вёдрах хватит места.
+- settle() поправляет ведро токенов по фактическому usage ответа (оценка → факт).
+- throttled() после 429 от API закрывает квоту для всех сессий на паузу
+  с экспоненциальным ростом и джиттером.
+
+Настройки (sloth_config.json, секция "ratelimit"):
+  enabled, rpm, tpm, state_dir, backoff_seconds, max_backoff_seconds.
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: только внутрипроцессная блокировка
+    fcntl = None
+
+from colors import Colors
+import config as sloth_config
+
+
+class SharedRateLimiter:
+    def __init__(self, key: str, rpm: Optional[float] = None, tpm: Optional[float] = None,
+                 state_dir: Optional[str] = None, enabled: Optional[bool] = None):
+        self.enabled = bool(enabled if enabled is not None else sloth_config.get("ratelimit.enabled", False))
+        self.rpm = float(rpm if rpm is not None else sloth_config.get("ratelimit.rpm", 0) or 0)
+        self.tpm = float(tpm if tpm is not None else sloth_config.get("ratelimit.tpm", 0) or 0)
+        self.backoff_seconds = float(sloth_config.get("ratelimit.backoff_seconds", 5))
+        self.max_backoff_seconds = float(sloth_config.get("ratelimit.max_backoff_seconds", 120))
+        state_dir = os.path.expanduser(state_dir or sloth_config.get("ratelimit.state_dir", "~/.cache/sloth"))
+        # Квота привязана к ключу/проекту: разные ключи не делят вёдра
+        digest = hashlib.sha1(str(key).encode("utf-8")).hexdigest()[:16]
+        self.state_path = os.path.join(state_dir, f"ratelimit_{digest}.json")
+        self._thread_lock = threading.Lock()
+        self.waited_seconds = 0.0
+        self.waits = 0
+
+    @property
+    def active(self) -> bool:
+        return self.enabled and (self.rpm > 0 or self.tpm > 0)
+
+    # --- общее состояние ---
+    @contextmanager
+    def _locked_state(self):
+        with self._thread_lock:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path, "a+", encoding="utf-8") as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or "{}")
+                    except ValueError:
+                        state = {}
+                    self._refill(state, time.time())
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                    f.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _refill(self, state: dict, now: float) -> None:
+        last = float(state.get("ts", now))
+        elapsed = max(0.0, now - last)
+        state["requests"] = min(self.rpm, float(state.get("requests", self.rpm)) + elapsed * self.rpm / 60.0)
+        state["tokens"] = min(self.tpm, float(state.get("tokens", self.tpm)) + elapsed * self.tpm / 60.0)
+        state["ts"] = now
+
+    # --- API ---
+    def acquire(self, tokens: int = 0) -> float:
+        """Ждёт места в обоих вёдрах и резервирует 1 запрос и tokens токенов. Возвращает время ожидания."""
+        if not self.active:
+            return 0.0
+        # Запрос больше минутной квоты всё равно должен пройти — ограничиваем ёмкостью
+        need_tokens = min(float(tokens or 0), self.tpm) if self.tpm > 0 else 0.0
+        started = time.time()
+        announced = False
+        while True:
+            with self._locked_state() as state:
+                now = time.time()
+                wait = max(0.0, float(state.get("blocked_until", 0)) - now)
+                if self.rpm > 0 and state["requests"] < 1.0:
+                    wait = max(wait, (1.0 - state["requests"]) * 60.0 / self.rpm)
+                if self.tpm > 0 and state["tokens"] < need_tokens:
+                    wait = max(wait, (need_tokens - state["tokens"]) * 60.0 / self.tpm)
+                if wait <= 0:
+                    if self.rpm > 0:
+                        state["requests"] -= 1.0
+                    if self.tpm > 0:
+                        state["tokens"] -= need_tokens
+                    waited = now - started
+                    if waited > 0.05:
+                        self.waited_seconds += waited
+                        self.waits += 1
+                    return waited
+            if not announced:
+                print(f"{Colors.GREY}⏱️  ЛОГ: Лимит RPM/TPM: жду {wait:.1f} сек. перед отправкой запроса...{Colors.ENDC}", flush=True)
+                announced = True
+            # Джиттер разводит сессии, проснувшиеся одновременно
+            time.sleep(min(wait, 5.0) + random.uniform(0.0, 0.25))
+
+    def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Поправка ведра токенов по фактическому usage (может уйти в минус — это «долг» квоты)."""
+        if not self.active or self.tpm <= 0 or not actual_tokens:
+            return
+        delta = float(actual_tokens) - min(float(estimated_tokens or 0), self.tpm)
+        if abs(delta) < 1:
+            return
+        with self._locked_state() as state:
+            state["tokens"] = min(self.tpm, state["tokens"] - delta)
+
+    def throttled(self) -> float:
+        """API ответил 429: закрываем квоту для всех сессий. Возвращает длительность паузы."""
+        if not self.active:
+            return 0.0
+        with self._locked_state() as state:
+            now = time.time()
+            streak = int(state.get("throttle_streak", 0)) + 1 if now - float(state.get("throttled_at", 0)) < 120 else 1
+            pause = min(self.max_backoff_seconds, self.backoff_seconds * (2 ** (streak - 1)))
+            pause *= random.uniform(0.8, 1.2)
+            state["blocked_until"] = max(float(state.get("blocked_until", 0)), now + pause)
+            state["throttle_streak"] = streak
+            state["throttled_at"] = now
+            # Вёдра обнуляем: квота на стороне API уже исчерпана
+            state["requests"] = min(state["requests"], 0.0)
+            state["tokens"] = min(state["tokens"], 0.0)
+        print(f"{Colors.WARNING}⏱️  ЛОГ: API вернул 429 — пауза {pause:.1f} сек. для всех сессий с этим ключом.{Colors.ENDC}", flush=True)
+        return pause
@@ -2,9 +2,12 @@
 import subprocess
 import platform
 import re
-import hashlib
 import os
+import time
 from colors import Colors
+import config as sloth_config
+import sloth_shell
+import sloth_tree
 
 # --- БЕЛЫЙ СПИСОК КОМАНД ---
 # Синхронизирован со списком в prompt (см. sloth_core.py)
@@ -14,16 +17,29 @@ ALLOWED_COMMANDS = (
     "prisma", "bunx", "bun"
 )
 
-def get_file_hash(filepath):
-    """Вычисляет SHA256 хэш файла."""
-    if not os.path.exists(filepath) or os.path.isdir(filepath): return None
-    h = hashlib.sha256()
-    with open(filepath, 'rb') as f:
-        while True:
-            chunk = f.read(8192)
-            if not chunk: break
-            h.update(chunk)
-    return h.hexdigest()
+def referenced_paths(commands_str):
+    """Пути-кандидаты, упомянутые в блоке команд (в том числе в кавычках)."""
+    return re.findall(r'[\'"]?([a-zA-Z0-9_\-\.\/]+)[\'"]?', commands_str)
+
+# Блоки выполняются в одной оболочке на сессию (sloth_shell); false — новая оболочка на каждый блок.
+# Экономит запуск bash; переменные и cd между командами при белом списке не сохраняются
+PERSISTENT_SHELL = bool(sloth_config.get("runner.shell.persistent", True))
+# Вывод команд печатается в консоль по мере появления (в run log пишется всегда)
+STREAM_OUTPUT = bool(sloth_config.get("runner.stream_output", True))
+
+def _format_duration(seconds):
+    return f"{seconds * 1000:.0f} мс" if seconds < 1 else f"{seconds:.1f} с"
+
+def _failure_message(result):
+    """Текст ошибки команды для модели: причина и хвост вывода."""
+    output = result["stderr_tail"].strip() or result["stdout_tail"].strip()
+    if result["timed_out"]:
+        reason = f"Команда не завершилась за {sloth_shell.COMMAND_TIMEOUT:.0f} с и была прервана (код {result['exit_code']})."
+        return reason + (f"\nПоследний вывод:\n{output}" if output else "")
+    if result["exit_code"] == sloth_shell.CPU_LIMIT_EXIT_CODE:
+        reason = f"Команда превысила лимит процессорного времени ({sloth_shell.CPU_SECONDS} с) и была остановлена."
+        return reason + (f"\nПоследний вывод:\n{output}" if output else "")
+    return output or "Команда провалилась без вывода в stderr."
 
 def _adapt_commands_for_project_root(s: str) -> str:
     cwd = os.getcwd(); root = os.path.basename(cwd.rstrip(os.sep))
@@ -34,10 +50,13 @@ def _adapt_commands_for_project_root(s: str) -> str:
     s = re.sub(r'([ \t\'"])' + re.escape(root_posix + "/"), r'\1', s)
     return s
 
-def execute_commands(commands_str):
+def execute_commands(commands_str, log_path=None):
     """
-    Выполняет блок shell-команд.
-    Возвращает кортеж: (success, failed_command, error_message, changed_files, created_paths)
+    Выполняет блок shell-команд по одной, в порядке следования, до первой ошибки.
+    Возвращает кортеж: (success, failed_command, error_message, changed_files, created_paths, deleted_paths,
+    command_results), где command_results — по словарю на запущенную команду (sloth_shell.ShellWorker.run_command).
+    Изменения определяются сравнением снимков дерева проекта до и после (sloth_tree).
+    Вывод команд печатается по мере появления и дописывается в log_path (run log).
     """
     print(f"{Colors.OKBLUE}  [Детали] Запуск выполнения блока команд...{Colors.ENDC}")
 
@@ -76,67 +95,101 @@ def execute_commands(commands_str):
                 + " и паттерн 'cd <subdir> && <разрешённая команда>'"
             )
             print(f"{Colors.FAIL}❌ ЛОГ: {error_msg}{Colors.ENDC}")
-            return False, commands_str, error_msg, set(), set()
-
-    # ИЗМЕНЕНО: Более надежный способ поиска путей, включая те, что в кавычках
-    filepaths = re.findall(r'[\'"]?([a-zA-Z0-9_\-\.\/]+)[\'"]?', commands_str)
-    
-    # Собираем информацию о состоянии ДО выполнения команд
-    hashes_before = {fp: get_file_hash(fp) for fp in filepaths if os.path.isfile(fp)}
-    dirs_before = {fp for fp in filepaths if os.path.isdir(fp)}
-    files_before = {fp for fp in filepaths if os.path.exists(fp)} # Все пути, включая папки
+            return False, commands_str, error_msg, set(), set(), set(), []
+
+    # Состояние ДО: метаданные всего дерева + хэши файлов, упомянутых в командах
+    # (по ним отличаем «переписан тем же содержимым» от реального изменения)
+    tree_started = time.perf_counter()
+    tree_before = sloth_tree.take(".")
+    before_digests = sloth_tree.baseline(".", tree_before, referenced_paths(commands_str))
+    tree_ms = (time.perf_counter() - tree_started) * 1000
     
+    worker = sloth_shell.get_worker(".") if PERSISTENT_SHELL else sloth_shell.ShellWorker(".")
+    command_results = []
+    log_file = None
     try:
         is_macos = platform.system() == "Darwin"
-        # Чистим возможные префиксы корня проекта в путях
-        commands_str_fixed = _adapt_commands_for_project_root(commands_str)
-        # Для macOS добавляем флаг .bak для sed -i, чтобы он работал как в Linux
-        commands_str_adapted = re.sub(r"sed -i ", "sed -i '.bak' ", commands_str_fixed) if is_macos else commands_str_fixed
-        full_command = f"set -e\n{commands_str_adapted}"
-
-        print(f"{Colors.WARNING}⚡️ ЛОГ: Выполняю блок команд (bash, set -e)...{Colors.ENDC}")
-        result = subprocess.run(['bash', '-c', full_command], capture_output=True, text=True, encoding='utf-8')
-
-        if result.returncode != 0:
-            error_msg = f"Команда завершилась с ненулевым кодом выхода ({result.returncode}).\nОшибка (STDERR): {result.stderr.strip()}"
-            print(f"{Colors.FAIL}❌ ЛОГ: КРИТИЧЕСКАЯ ОШИБКА при выполнении блока команд.\n{error_msg}{Colors.ENDC}")
-            return False, commands_str, result.stderr.strip() or "Команда провалилась без вывода в stderr.", set(), set()
-
-        if result.stderr:
-            print(f"{Colors.WARNING}⚠️  ПРЕДУПРЕЖДЕНИЕ (STDERR от успешной команды):\n{result.stderr.strip()}{Colors.ENDC}")
+        if log_path:
+            try:
+                log_file = open(log_path, "a", encoding="utf-8")
+            except OSError as e:
+                print(f"{Colors.WARNING}⚠️  Не удалось открыть run log {log_path}: {e}{Colors.ENDC}")
+
+        def _on_line(stream, line):
+            if STREAM_OUTPUT:
+                color = Colors.WARNING if stream == "stderr" else Colors.GREY
+                print(f"{color}    │ {line.rstrip()}{Colors.ENDC}", flush=True)
+            if log_file:
+                log_file.write(("[stderr] " if stream == "stderr" else "") + line + ("" if line.endswith("\n") else "\n"))
+                log_file.flush()
+
+        shell_kind = "постоянная оболочка" if PERSISTENT_SHELL else "отдельная оболочка"
+        print(f"{Colors.WARNING}⚡️ ЛОГ: Выполняю блок команд ({shell_kind}, по одной, таймаут {sloth_shell.COMMAND_TIMEOUT:.0f} с)...{Colors.ENDC}")
+        failed = None
+        for index, command in enumerate(commands_to_run, start=1):
+            # Чистим возможные префиксы корня проекта в путях
+            command_fixed = _adapt_commands_for_project_root(command)
+            # Для macOS добавляем флаг .bak для sed -i, чтобы он работал как в Linux
+            command_adapted = re.sub(r"sed -i ", "sed -i '.bak' ", command_fixed) if is_macos else command_fixed
+            print(f"{Colors.OKBLUE}  ▶ [{index}/{len(commands_to_run)}] {command}{Colors.ENDC}", flush=True)
+            if log_file:
+                log_file.write("\n" + "=" * 80 + f"\nКОМАНДА [{index}/{len(commands_to_run)}]: {command}\n" + "-" * 80 + "\n")
+            result = worker.run_command(command_adapted, on_line=_on_line)
+            result["command"] = command
+            command_results.append(result)
+            status = "таймаут" if result["timed_out"] else f"код {result['exit_code']}"
+            if log_file:
+                log_file.write(f"--> {status}, {_format_duration(result['duration'])}\n")
+                log_file.flush()
+            color = Colors.OKGREEN if result["exit_code"] == 0 else Colors.FAIL
+            print(f"{color}  ⏱  [{index}/{len(commands_to_run)}] {status}, {_format_duration(result['duration'])}{Colors.ENDC}", flush=True)
+            if result["exit_code"] != 0:
+                failed = result
+                break
 
         # Удаляем временные файлы .bak, созданные sed на macOS
         if is_macos:
             subprocess.run("find . -name '*.bak' -delete", shell=True, check=True, capture_output=True)
 
-        # --- НОВАЯ, БОЛЕЕ НАДЕЖНАЯ ПРОВЕРКА ИЗМЕНЕНИЙ ---
-        hashes_after = {fp: get_file_hash(fp) for fp in hashes_before.keys()}
-        files_after = {fp for fp in filepaths if os.path.exists(fp)}
-
-        # Проверяем, изменился ли хэш у существующих файлов
-        modified_files = any(hashes_before.get(fp) != hashes_after.get(fp) for fp in hashes_before)
-        # Проверяем, появились ли новые файлы или папки
-        created_paths = files_after - files_before
-        changed_files = {fp for fp in hashes_before.keys() if hashes_before.get(fp) != hashes_after.get(fp)}
-        
-        if not modified_files and not created_paths:
-            # Если ничего не изменилось и не создалось - это ошибка логики
-            error_msg = ("Команда выполнилась успешно, но не изменила и не создала ни одного файла или папки. "
+        # --- ПРОВЕРКА ИЗМЕНЕНИЙ: снимок дерева после и сравнение ---
+        # Считаем и при ошибке: команды до упавшей могли изменить дерево (это нужно снимкам для отката)
+        tree_started = time.perf_counter()
+        tree_after = sloth_tree.take(".")
+        changed_files, created_paths, deleted_paths = sloth_tree.diff(".", tree_before, tree_after, before_digests)
+        tree_ms += (time.perf_counter() - tree_started) * 1000
+        print(f"{Colors.OKBLUE}  [Детали] Снимок дерева: {len(tree_after)} путей, {tree_ms:.0f} мс (до + после).{Colors.ENDC}")
+
+        if failed:
+            error_msg = _failure_message(failed)
+            print(f"{Colors.FAIL}❌ ЛОГ: КРИТИЧЕСКАЯ ОШИБКА при выполнении блока команд. Упала команда: {failed['command']}\n"
+                  f"Команда завершилась с ненулевым кодом выхода ({failed['exit_code']}).\nОшибка: {error_msg}{Colors.ENDC}")
+            return False, failed["command"], error_msg, changed_files, created_paths, deleted_paths, command_results
+
+        if not changed_files and not created_paths and not deleted_paths:
+            # Если ничего не изменилось, не создалось и не удалилось - это ошибка логики
+            error_msg = ("Команда выполнилась успешно, но не изменила, не создала и не удалила ни одного файла или папки. "
                          "Вероятно, шаблон (например, в sed) не был найден или путь к файлу неверен.")
-            final_error_message = result.stderr.strip() if result.stderr else error_msg
+            stderr = "".join(r["stderr_tail"] for r in command_results).strip()
+            final_error_message = stderr if stderr else error_msg
             print(f"{Colors.FAIL}❌ ЛОГ: ОШИБКА ЛОГИКИ: {error_msg}{Colors.ENDC}")
-            if result.stderr:
+            if stderr:
                 print(f"Причина из STDERR: {final_error_message}")
-            return False, commands_str, final_error_message, set(), set()
+            return False, commands_str, final_error_message, set(), set(), set(), command_results
+
+        # Если были изменения, создания или удаления, все хорошо
+        for label, paths in (("Изменены", changed_files), ("Созданы", created_paths), ("Удалены", deleted_paths)):
+            paths = sloth_tree.collapse(paths)
+            if paths:
+                shown = ", ".join(sorted(paths)[:20]) + (f" … (+{len(paths) - 20})" if len(paths) > 20 else "")
+                print(f"{Colors.OKGREEN}✅ ЛОГ: Блок команд успешно выполнен. {label} пути: {shown}{Colors.ENDC}")
 
-        # Если были изменения или создания, все хорошо
-        if modified_files:
-            print(f"{Colors.OKGREEN}✅ ЛОГ: Блок команд успешно выполнен. Файлы были изменены.{Colors.ENDC}")
-        if created_paths:
-            print(f"{Colors.OKGREEN}✅ ЛОГ: Блок команд успешно выполнен. Были созданы новые пути: {', '.join(created_paths)}{Colors.ENDC}")
-            
-        return True, None, None, changed_files, created_paths
+        return True, None, None, changed_files, created_paths, deleted_paths, command_results
 
     except Exception as e:
         print(f"{Colors.FAIL}❌ ЛОГ: Непредвиденная ОШИБКА в исполнителе: {e}{Colors.ENDC}")
-        return False, commands_str, str(e), set(), set()
\ No newline at end of file
+        return False, commands_str, str(e), set(), set(), set(), command_results
+    finally:
+        if log_file:
+            log_file.close()
+        if not PERSISTENT_SHELL:
+            worker.close()
@@ -0,0 +1,129 @@
+# Файл: sloth_session.py
+"""
+Режим чат-сессии для Sloth (opt-in, session.enabled).
+
+Без сессии каждая итерация — отдельный запрос с полным промптом: правила, вся история
+и заново собранный контекст проекта. В режиме сессии:
+  - первый ход исполнения (якорь) отправляется полным промптом, как обычно;
+  - следующие ходы той же модели в фазах session.phases отправляют только новое
+    (sloth_core.get_session_turn_prompt): записи истории с прошлого хода, содержимое
+    изменённых файлов, ошибку/логи и инструкцию фазы. Запрос идёт как многоходовый
+    диалог (sloth_backends.Conversation): префикс диалога стабилен и попадает в
+    неявный кэш промптов API, поэтому оплачиваемый вход и время до первого токена падают.
+
+История диалога ограничена: при превышении session.max_turns ходов или
+session.max_history_tokens токенов, при смене модели или после простоя дольше
+session.cache_ttl_seconds (кэш префикса у API к тому времени уже истёк) сессия
+пересобирается — следующий ход снова отправляется полным промптом со свежим
+контекстом и сжатой историей, и он становится новым якорем.
+
+Настройки (sloth_config.json, секция "session"):
+  enabled, phases, max_turns, max_history_tokens, cache_ttl_seconds.
+"""
+
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from colors import Colors
+import config as sloth_config
+from sloth_backends import Conversation, estimate_tokens
+
+
+class ChatSession:
+    def __init__(self, enabled: Optional[bool] = None):
+        self.enabled = bool(enabled if enabled is not None else sloth_config.get("session.enabled", False))
+        self.phases = {str(p).upper() for p in sloth_config.get(
+            "session.phases", ["INITIAL_CODING", "REVIEWING", "FIXING_ERROR"])}
+        self.max_turns = int(sloth_config.get("session.max_turns", 8))
+        self.max_history_tokens = int(sloth_config.get("session.max_history_tokens", 150000))
+        self.cache_ttl_seconds = float(sloth_config.get("session.cache_ttl_seconds", 300))
+        self.model: Optional[str] = None
+        self.turns: List[Tuple[str, str]] = []
+        self.history_seen = 0
+        self.last_used = 0.0
+        self.pending_files: Set[str] = set()
+        self.logs_seen: Optional[str] = None
+        self.stats: Dict[str, int] = {"anchors": 0, "delta_turns": 0, "anchor_tokens": 0, "delta_tokens": 0}
+        self.rebases: Dict[str, int] = {}
+
+    # --- состояние ---
+    def covers(self, phase: str) -> bool:
+        return self.enabled and phase in self.phases
+
+    def _tokens(self) -> int:
+        return sum(estimate_tokens(text) for _, text in self.turns)
+
+    def _rebase_reason(self, model: str) -> Optional[str]:
+        if not self.turns:
+            return None
+        if model != self.model:
+            return "model"
+        if len(self.turns) // 2 >= self.max_turns:
+            return "turns"
+        if self._tokens() >= self.max_history_tokens:
+            return "tokens"
+        if time.time() - self.last_used > self.cache_ttl_seconds:
+            return "cache_ttl"
+        return None
+
+    def reset(self, reason: str) -> None:
+        if self.turns:
+            self.rebases[reason] = self.rebases.get(reason, 0) + 1
+            print(f"{Colors.CYAN}🔁 ЛОГ: Сессия пересобирается (причина: {reason}) — следующий ход полным промптом.{Colors.ENDC}", flush=True)
+        self.turns, self.model = [], None
+        self.pending_files.clear()
+
+    def can_continue(self, phase: str, model: str) -> bool:
+        """Можно ли отправить этот ход дельтой. Если сессию пора пересобрать — сбрасывает её."""
+        if not self.covers(phase) or not self.turns:
+            return False
+        reason = self._rebase_reason(model)
+        if reason:
+            self.reset(reason)
+            return False
+        return True
+
+    def note_changes(self, paths: Iterable[str]) -> None:
+        """Файлы, изменённые после последнего хода сессии, — уйдут в следующую дельту."""
+        if self.turns:
+            self.pending_files |= {p for p in paths if p}
+
+    def unseen_logs(self, logs: Optional[str]) -> Optional[str]:
+        """Логи верификации, если модель в этой сессии их ещё не видела."""
+        return logs if logs and logs != self.logs_seen else None
+
+    # --- ходы ---
+    def conversation(self, delta_prompt: str) -> Conversation:
+        return Conversation(self.turns + [("user", delta_prompt)])
+
+    def record(self, prompt: str, reply: str, model: str, history_len: int, delta: bool,
+               logs: Optional[str] = None) -> None:
+        """Запоминает успешный ход: полный промпт становится якорем, дельта дописывается в диалог."""
+        if delta:
+            self.turns += [("user", str(prompt)), ("model", reply)]
+            self.stats["delta_turns"] += 1
+            self.stats["delta_tokens"] += estimate_tokens(prompt)
+        else:
+            self.turns = [("user", str(prompt)), ("model", reply)]
+            self.model = model
+            self.stats["anchors"] += 1
+            self.stats["anchor_tokens"] += estimate_tokens(prompt)
+        self.history_seen = history_len
+        self.logs_seen = logs
+        self.last_used = time.time()
+        self.pending_files.clear()
+
+    # --- отчёт ---
+    def report(self) -> None:
+        if not self.enabled or not self.stats["anchors"]:
+            return
+        anchors, deltas = self.stats["anchors"], self.stats["delta_turns"]
+        avg_anchor = self.stats["anchor_tokens"] // anchors
+        avg_delta = self.stats["delta_tokens"] // deltas if deltas else 0
+        rebases = ", ".join(f"{k}: {v}" for k, v in self.rebases.items()) or "нет"
+        print(f"\n{Colors.BOLD}{Colors.HEADER}--- ЧАТ-СЕССИЯ ---{Colors.ENDC}", flush=True)
+        print(
+            f"  Якорей (полный промпт): {anchors} (~{avg_anchor} т. в среднем) | "
+            f"ходов-дельт: {deltas} (~{avg_delta} т. нового в среднем) | пересборки: {rebases}",
+            flush=True,
+        )
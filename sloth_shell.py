@@ -0,0 +1,311 @@
+# Файл: sloth_shell.py
+"""
+Постоянный bash-процесс для блоков команд Sloth.
+
+Раньше каждый блок запускался новым `bash -c` с `set -e`, и запуск оболочки
+оплачивался каждый раз. ShellWorker держит один `bash --noprofile --norc`
+на сессию и общается с ним через каналы.
+
+Что именно переживает блок: при настройках по умолчанию — почти ничего, выигрыш
+только в стоимости запуска. Белый список (sloth_runner.ALLOWED_COMMANDS) не пускает
+export, source и голый cd, `cd <подпапка> && …` отменяется возвратом в корень
+(keep_cwd: false), а после упавшей команды оболочка перезапускается
+(reset_on_error: true). Переменные и текущая папка между командами не сохраняются.
+
+Протокол:
+
+  - команды выполняются по одной (run_command): команда записывается во временный
+    файл ВНЕ проекта и выполняется через `source <файл> </dev/null` — у неё нет
+    доступа к управляющему stdin, а незакрытая кавычка не сломает протокол;
+  - после команды печатается уникальный для процесса маркер с кодом выхода
+    (в stdout) и маркер в stderr — по ним отделяется вывод каждой команды;
+  - вывод читается построчно по мере появления: on_line получает каждую строку
+    (живой вывод в консоль и run log), а в результат попадает только хвост
+    (runner.limits.tail_chars) — память не растёт с объёмом вывода;
+  - у каждой команды свой таймаут: по его истечении вся группа процессов оболочки
+    завершается эскалацией SIGINT → SIGTERM → SIGKILL, код 124;
+  - лимиты CPU и памяти (runner.limits.cpu_seconds / memory_mb) ставятся оболочке
+    через setrlimit и наследуются каждой командой; время CPU считается для
+    каждого процесса отдельно, поэтому лимит фактически на команду;
+  - перед командой оболочка возвращается в корень проекта (runner.shell.keep_cwd:
+    false), чтобы пути в командах, как и раньше, считались от корня;
+  - если команда завершила саму оболочку (`exit`), это код выхода команды,
+    а следующая команда запустит новую оболочку;
+  - runner.shell.reset_on_error: после упавшей команды оболочка перезапускается,
+    чтобы полуприменённое состояние не влияло на следующие попытки.
+Оболочка живёт в своей группе процессов и завершается вместе с Sloth.
+
+Проверка команд по белому списку остаётся в sloth_runner.execute_commands.
+"""
+
+import atexit
+import os
+import queue
+import shlex
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Dict, Optional
+
+import config as sloth_config
+
+try:
+    import resource  # только POSIX
+except ImportError:
+    resource = None
+
+KEEP_CWD = bool(sloth_config.get("runner.shell.keep_cwd", False))
+RESET_ON_ERROR = bool(sloth_config.get("runner.shell.reset_on_error", True))
+COMMAND_TIMEOUT = float(sloth_config.get("runner.limits.timeout_seconds", 600))
+CPU_SECONDS = int(sloth_config.get("runner.limits.cpu_seconds", 600))
+# RLIMIT_AS по умолчанию выключен: node/V8 резервирует гигабайты адресного пространства заранее
+MEMORY_MB = int(sloth_config.get("runner.limits.memory_mb", 0))
+TAIL_CHARS = int(sloth_config.get("runner.limits.tail_chars", 4000))
+TIMEOUT_EXIT_CODE = 124
+# Так завершается процесс, превысивший RLIMIT_CPU (128 + SIGXCPU)
+CPU_LIMIT_EXIT_CODE = 128 + getattr(signal, "SIGXCPU", 24)
+
+
+class ShellError(RuntimeError):
+    """Оболочку не удалось запустить или она перестала отвечать."""
+
+
+class _Tail:
+    """Последние max_chars символов потока строк; помнит, сколько строк отброшено."""
+
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self.lines: deque = deque()
+        self.size = 0
+        self.dropped = 0
+
+    def append(self, line: str) -> None:
+        self.lines.append(line)
+        self.size += len(line)
+        while self.size > self.max_chars and len(self.lines) > 1:
+            self.size -= len(self.lines.popleft())
+            self.dropped += 1
+
+    def text(self) -> str:
+        body = "".join(self.lines)
+        if len(body) > self.max_chars:
+            body = body[-self.max_chars:]
+        if self.dropped:
+            body = f"… (пропущено строк: {self.dropped})\n" + body
+        return body
+
+
+def _apply_limits() -> None:
+    """preexec_fn оболочки: мягкие лимиты CPU и памяти, наследуемые командами."""
+    if resource is None:
+        return
+    for limit, value in ((resource.RLIMIT_CPU, CPU_SECONDS), (resource.RLIMIT_AS, MEMORY_MB << 20)):
+        if value <= 0:
+            continue
+        soft, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        try:
+            resource.setrlimit(limit, (value, hard))
+        except (ValueError, OSError):
+            pass
+
+
+class ShellWorker:
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.sentinel = f"__SLOTH_DONE_{uuid.uuid4().hex}__"
+        self.proc: Optional[subprocess.Popen] = None
+        self._output: "queue.Queue" = queue.Queue()
+        self.commands_run = 0
+
+    # --- жизненный цикл ---
+    def start(self) -> None:
+        env = dict(os.environ)
+        # Без пользовательских rc-файлов и истории: поведение не зависит от машины
+        for key in ("BASH_ENV", "ENV", "PROMPT_COMMAND"):
+            env.pop(key, None)
+        env["HISTFILE"] = "/dev/null"
+        try:
+            self.proc = subprocess.Popen(
+                ["bash", "--noprofile", "--norc"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=self.root, env=env, text=True, encoding="utf-8", errors="replace",
+                start_new_session=True, preexec_fn=_apply_limits if resource else None,
+            )
+        except OSError as e:
+            raise ShellError(f"Не удалось запустить bash: {e}")
+        self._output = queue.Queue()
+        for pipe, stream in ((self.proc.stdout, "stdout"), (self.proc.stderr, "stderr")):
+            threading.Thread(target=self._pump, args=(pipe, stream, self._output), daemon=True).start()
+        self.commands_run = 0
+
+    @staticmethod
+    def _pump(pipe, stream: str, sink) -> None:
+        for line in iter(pipe.readline, ""):
+            sink.put((stream, line))
+        sink.put((stream, None))
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def _signal_group(self, sig) -> None:
+        try:
+            os.killpg(self.proc.pid, sig)
+        except OSError:
+            try:
+                self.proc.send_signal(sig)
+            except OSError:
+                pass
+
+    def close(self, gentle: bool = False) -> None:
+        """Завершает оболочку и всех её потомков (группа процессов). gentle — начать с SIGINT."""
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        signals = (signal.SIGINT, signal.SIGTERM, signal.SIGKILL) if gentle else (signal.SIGTERM, signal.SIGKILL)
+        for sig in signals:
+            if self.proc.poll() is not None:
+                # Сама оболочка уже вышла, но фоновые потомки из её группы могли остаться
+                self._signal_group(signal.SIGTERM)
+                break
+            self._signal_group(sig)
+            try:
+                self.proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                continue
+        self.proc = None
+
+    def reset(self) -> None:
+        self.close()
+        self.start()
+
+    # --- выполнение ---
+    def run_command(self, command: str, timeout: Optional[float] = None,
+                    on_line: Optional[Callable[[str, str], None]] = None) -> Dict:
+        """
+        Выполняет одну команду. on_line(stream, line) получает вывод по мере появления.
+        Возвращает {command, exit_code, duration, timed_out, stdout_tail, stderr_tail}.
+        """
+        if not self.alive():
+            self.start()
+        timeout = COMMAND_TIMEOUT if timeout is None else timeout
+        fd, script_path = tempfile.mkstemp(prefix="sloth-cmd-", suffix=".sh")
+        started = time.perf_counter()
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(command + "\n")
+            frame = []
+            if not KEEP_CWD:
+                frame.append(f"cd -- {shlex.quote(self.root)}")
+            frame += [
+                f"source {shlex.quote(script_path)} </dev/null",
+                f"printf '\\n%s:%d\\n' {self.sentinel} \"$?\"",
+                f"printf '\\n%s\\n' {self.sentinel} >&2",
+            ]
+            try:
+                self.proc.stdin.write("\n".join(frame) + "\n")
+                self.proc.stdin.flush()
+            except OSError as e:
+                self.close()
+                raise ShellError(f"bash не принимает команды: {e}")
+            # Сообщения bash об ошибках начинаются с имени временного файла — для модели это шум
+            noise = script_path + ": "
+            exit_code, timed_out, tails = self._collect(started + timeout if timeout > 0 else None, on_line, noise)
+        finally:
+            os.remove(script_path)
+        self.commands_run += 1
+        if timed_out:
+            exit_code = TIMEOUT_EXIT_CODE
+        elif exit_code is None:
+            # Команда завершила саму оболочку (exit): её код — код команды
+            exit_code = self.proc.wait()
+            self.close()
+        elif exit_code != 0 and RESET_ON_ERROR:
+            self.close()
+        return {
+            "command": command,
+            "exit_code": exit_code,
+            "duration": time.perf_counter() - started,
+            "timed_out": timed_out,
+            "stdout_tail": tails["stdout"].text(),
+            "stderr_tail": tails["stderr"].text(),
+        }
+
+    def _collect(self, deadline: Optional[float], on_line, noise: str = ""):
+        """Читает оба канала до маркеров. Возвращает (код или None, истёк ли таймаут, хвосты)."""
+        tails = {"stdout": _Tail(TAIL_CHARS), "stderr": _Tail(TAIL_CHARS)}
+        pending = {"stdout": None, "stderr": None}
+        exit_code, done = None, set()
+        while len(done) < 2:
+            try:
+                wait = None if deadline is None else max(0.0, deadline - time.perf_counter())
+                stream, line = self._output.get(timeout=wait)
+            except queue.Empty:
+                self.close(gentle=True)
+                for stream, held in pending.items():
+                    if held:
+                        tails[stream].append(held.replace(noise, "") if noise else held)
+                return None, True, tails
+            if line is None:
+                done.add(stream)
+                continue
+            if line.startswith(self.sentinel):
+                if stream == "stdout":
+                    code = line.strip()[len(self.sentinel) + 1:]
+                    exit_code = int(code) if code else 0
+                # Перевод строки перед маркером к выводу команды не относится
+                held = pending[stream]
+                if held and held != "\n":
+                    self._emit(tails, on_line, stream, held[:-1], noise)
+                pending[stream] = None
+                done.add(stream)
+                continue
+            # Строка выдаётся с задержкой на одну: последняя может оказаться служебным переводом строки
+            if pending[stream] is not None:
+                self._emit(tails, on_line, stream, pending[stream], noise)
+            pending[stream] = line
+        for stream, held in pending.items():
+            if held:
+                self._emit(tails, on_line, stream, held, noise)
+        return exit_code, False, tails
+
+    @staticmethod
+    def _emit(tails, on_line, stream: str, line: str, noise: str = "") -> None:
+        if noise:
+            line = line.replace(noise, "")
+        tails[stream].append(line)
+        if on_line:
+            on_line(stream, line)
+
+
+_worker: Optional[ShellWorker] = None
+
+
+def get_worker(root: str = ".") -> ShellWorker:
+    """Оболочка сессии; при смене корня проекта запускается новая."""
+    global _worker
+    root = os.path.abspath(root)
+    if _worker is not None and _worker.root != root:
+        _worker.close()
+        _worker = None
+    if _worker is None:
+        _worker = ShellWorker(root)
+    return _worker
+
+
+def shutdown() -> None:
+    global _worker
+    if _worker is not None:
+        _worker.close()
+        _worker = None
+
+
+atexit.register(shutdown)
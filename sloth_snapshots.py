@@ -0,0 +1,354 @@
+# Файл: sloth_snapshots.py
+"""
+Транзакционная запись файлов и снимки по итерациям для Sloth.
+
+write_files_atomically() применяет все write_file/edit_file одной итерации группой:
+  1) каждый новый файл пишется во временный файл рядом с целью (.sloth-tmp-*),
+     flush + fsync; любая ошибка на этом шаге удаляет временные файлы —
+     дерево проекта не тронуто;
+  2) прежнее содержимое (pre-image) всех целей сохраняется в снимок итерации
+     и fsync-ается ДО замены;
+  3) os.replace() временных файлов поверх целей (атомарно для каждого файла)
+     и fsync директорий.
+Цель-папка отклоняется до записи (ValueError). Если os.replace() упадёт посреди шага 3,
+уже заменённые файлы возвращаются из снимка, оставшиеся временные удаляются; если упадёт
+сам процесс, снимок уже на диске, и `--rollback` вернёт группу.
+
+Хранилище снимков (по умолчанию logs/snapshots):
+  blobs/<sha1>        — содержимое файлов, zlib, без дубликатов;
+  NNNN.json           — манифест снимка: id, корень проекта (root), итерация, время,
+                        {путь: sha1 | null} (null — файла до итерации не было)
+                        и unrestorable — изменённые пути без pre-image.
+Каталог из snapshots.dir не очищается вместе с logs/ и может быть общим для разных
+проектов: list(), rollback() и report() видят только манифесты своего root,
+а id снимков сквозные по всему каталогу.
+Файлы, содержимое которых уже совпадает с новым (is_unchanged), не перезаписываются —
+mtime не меняется, dev-серверы и watcher-ы не перезапускаются.
+Снимок пишется только для итераций, которые меняли файлы. rollback(id) откатывает
+снимок id и все более поздние — без ходов модели: возвращает сохранённые pre-image
+и удаляет созданные пути.
+
+Для bash-блоков pre-image есть только у файлов, названных в тексте команды (их
+сохраняют до запуска). Файлы, которые команда изменила или удалила, не называя их
+(package-lock.json после `npm install`, `prisma generate`, `git checkout`, содержимое
+удалённой папки), становятся известны лишь после запуска — их прежнего содержимого
+нет. Такие пути записываются в манифест как "unrestorable": rollback их не
+возвращает и предупреждает об этом, --snapshots показывает их у каждого снимка.
+
+Настройки (sloth_config.json, секция "snapshots"): enabled, dir.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from colors import Colors
+import config as sloth_config
+import sloth_tree
+
+
+def _fsync_dir(path: str) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Windows и некоторые ФС не умеют fsync директорий
+        pass
+    finally:
+        os.close(fd)
+
+
+def _default_mode() -> int:
+    # mkstemp создаёт файлы с правами 0600; новым файлам даём обычные права с учётом umask
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def _copy_mode(tmp_path: str, path: str) -> None:
+    mode = os.stat(path).st_mode & 0o7777 if os.path.exists(path) else _default_mode()
+    os.chmod(tmp_path, mode)
+
+
+def _new_dirs(root: str, rel_paths: Iterable[str]) -> List[str]:
+    """Родительские папки путей, которых ещё нет (их создаст запись)."""
+    missing = set()
+    for rel_path in rel_paths:
+        parent = os.path.dirname(rel_path)
+        while parent and not os.path.isdir(os.path.join(root, parent)):
+            missing.add(parent)
+            parent = os.path.dirname(parent)
+    return sorted(missing)
+
+
+def _write_durable(path: str, data: bytes) -> None:
+    """Атомарная запись одного файла: временный файл рядом + fsync + os.replace."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".sloth-tmp-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        _copy_mode(tmp_path, path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(directory)
+
+
+class SnapshotStore:
+    def __init__(self, store_dir: str, root: str, enabled: Optional[bool] = None):
+        self.enabled = bool(enabled if enabled is not None else sloth_config.get("snapshots.enabled", True))
+        self.store_dir = os.path.expanduser(sloth_config.get("snapshots.dir", None) or store_dir)
+        # realpath: сессия пишет с корнем os.getcwd(), а --rollback берёт путь из истории (возможна симлинка)
+        self.root = os.path.realpath(root)
+        self.blobs_dir = os.path.join(self.store_dir, "blobs")
+
+    # --- хранилище ---
+    def _put_blob(self, data: bytes) -> str:
+        digest = hashlib.sha1(data).hexdigest()
+        path = os.path.join(self.blobs_dir, digest)
+        if not os.path.exists(path):
+            _write_durable(path, zlib.compress(data, 6))
+        return digest
+
+    def _get_blob(self, digest: str) -> bytes:
+        with open(os.path.join(self.blobs_dir, digest), "rb") as f:
+            return zlib.decompress(f.read())
+
+    def list(self) -> List[Dict]:
+        """Манифесты этого проекта (root), по возрастанию id."""
+        return [m for m in self._all() if m.get("root") == self.root]
+
+    def _all(self) -> List[Dict]:
+        if not os.path.isdir(self.store_dir):
+            return []
+        manifests = []
+        for name in sorted(os.listdir(self.store_dir)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.store_dir, name), "r", encoding="utf-8") as f:
+                    manifests.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(manifests, key=lambda m: m.get("id", 0))
+
+    def _next_id(self) -> int:
+        return max((m.get("id", 0) for m in self._all()), default=0) + 1
+
+    # --- снимки ---
+    def capture(self, iteration: int, rel_paths: Iterable[str], label: str = "write") -> Optional[int]:
+        """Сохраняет pre-image файлов как новый снимок. Возвращает id снимка (None — нечего/выключено)."""
+        if not self.enabled:
+            return None
+        files = {}
+        # Ключи — в том же виде, что пути из sloth_tree (без ./ и лишних слэшей)
+        for rel_path in sorted({sloth_tree.normalize(p) for p in rel_paths}):
+            path = os.path.join(self.root, rel_path)
+            if os.path.isdir(path):
+                continue
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    files[rel_path] = self._put_blob(f.read())
+            else:
+                files[rel_path] = None
+        if not files:
+            return None
+        os.makedirs(self.store_dir, exist_ok=True)
+        snapshot_id = self._next_id()
+        return self._save(self._new_manifest(snapshot_id, iteration, label, files))
+
+    def _new_manifest(self, snapshot_id: int, iteration: int, label: str, files: Dict) -> Dict:
+        return {"id": snapshot_id, "root": self.root, "iteration": iteration, "label": label,
+                "ts": time.time(), "files": files}
+
+    def _load_or_new(self, snapshot_id: Optional[int], iteration: int, label: str) -> Dict:
+        manifest = next((m for m in self.list() if m.get("id") == snapshot_id), None)
+        if manifest is None:
+            os.makedirs(self.store_dir, exist_ok=True)
+            manifest = self._new_manifest(self._next_id(), iteration, label, {})
+        return manifest
+
+    def _save(self, manifest: Dict) -> int:
+        _write_durable(os.path.join(self.store_dir, f"{manifest['id']:04d}.json"),
+                       json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8"))
+        return manifest["id"]
+
+    def mark_created(self, snapshot_id: Optional[int], iteration: int, rel_paths: Iterable[str],
+                     label: str = "bash") -> Optional[int]:
+        """Дописывает в снимок пути, которых до итерации не было (их rollback удалит)."""
+        paths = {p for p in rel_paths if p}
+        if not self.enabled or not paths:
+            return snapshot_id
+        manifest = self._load_or_new(snapshot_id, iteration, label)
+        for rel_path in paths:
+            manifest["files"].setdefault(rel_path, None)
+        return self._save(manifest)
+
+    def mark_unrestorable(self, snapshot_id: Optional[int], iteration: int, rel_paths: Iterable[str],
+                          label: str = "bash") -> Tuple[Optional[int], List[str]]:
+        """
+        Отмечает изменённые/удалённые пути, у которых в снимке нет pre-image.
+        Возвращает (id снимка, отмеченные пути — папка вместо её содержимого).
+        """
+        if not self.enabled:
+            return snapshot_id, []
+        manifest = next((m for m in self.list() if m.get("id") == snapshot_id), None)
+        captured = set(manifest.get("files", {})) if manifest else set()
+        paths = sorted(sloth_tree.collapse(p for p in rel_paths if p and p not in captured))
+        if not paths:
+            return snapshot_id, []
+        manifest = manifest or self._load_or_new(snapshot_id, iteration, label)
+        manifest["unrestorable"] = sorted(set(manifest.get("unrestorable", [])) | set(paths))
+        return self._save(manifest), paths
+
+    def unrestorable(self, snapshot_id: int) -> List[str]:
+        """Пути, которые откат к снимку snapshot_id вернуть не сможет."""
+        return sorted({p for m in self.list() if m.get("id", 0) >= snapshot_id for p in m.get("unrestorable", [])})
+
+    def discard(self, snapshot_id: Optional[int]) -> None:
+        """Удаляет манифест снимка (blob-ы остаются: их могут делить другие снимки)."""
+        if snapshot_id is None:
+            return
+        try:
+            os.remove(os.path.join(self.store_dir, f"{snapshot_id:04d}.json"))
+        except FileNotFoundError:
+            pass
+
+    def restore(self, manifest: Dict, rel_paths: Optional[Iterable[str]] = None) -> List[str]:
+        """Возвращает pre-image путей манифеста (по умолчанию всех): файлы — из blob-ов, созданные — удаляет."""
+        files = manifest.get("files", {})
+        wanted = set(files) if rel_paths is None else set(rel_paths) & set(files)
+        restored = []
+        # Обратный порядок путей: вложенные файлы удаляются раньше созданных папок
+        for rel_path in sorted(wanted, reverse=True):
+            digest = files[rel_path]
+            path = os.path.join(self.root, rel_path)
+            if digest is None:
+                if os.path.isfile(path) or os.path.islink(path):
+                    os.remove(path)
+                elif os.path.isdir(path):
+                    try:
+                        os.rmdir(path)
+                    except OSError:
+                        # Непустую папку не трогаем: в ней могли появиться файлы пользователя
+                        pass
+            else:
+                _write_durable(path, self._get_blob(digest))
+            restored.append(rel_path)
+        return restored
+
+    def rollback(self, snapshot_id: int) -> List[str]:
+        """Возвращает дерево в состояние до снимка snapshot_id. Возвращает список восстановленных путей."""
+        manifests = [m for m in self.list() if m.get("id", 0) >= snapshot_id]
+        if not manifests:
+            raise ValueError(f"Снимок #{snapshot_id} не найден.")
+        unrestorable = self.unrestorable(snapshot_id)
+        restored = []
+        for manifest in reversed(manifests):
+            restored += self.restore(manifest)
+            self.discard(manifest["id"])
+        if unrestorable:
+            print(f"{Colors.WARNING}⚠️  Откат неполный: эти пути менялись bash-командами без сохранённого "
+                  f"прежнего содержимого и остались как есть ({len(unrestorable)}):{Colors.ENDC}", flush=True)
+            for rel_path in unrestorable:
+                print(f"{Colors.WARNING}  {rel_path}{Colors.ENDC}", flush=True)
+        return sorted(set(restored))
+
+    def report(self) -> None:
+        manifests = self.list()
+        if not manifests:
+            print(f"{Colors.GREY}Снимков нет ({self.store_dir}).{Colors.ENDC}", flush=True)
+            return
+        print(f"{Colors.BOLD}{Colors.HEADER}--- СНИМКИ ({self.store_dir}) ---{Colors.ENDC}", flush=True)
+        for m in manifests:
+            when = time.strftime("%H:%M:%S", time.localtime(m.get("ts", 0)))
+            files = m.get("files", {})
+            shown = ", ".join(sorted(files)[:6]) + (" …" if len(files) > 6 else "")
+            print(f"  #{m['id']:<4} итерация {m.get('iteration', '?'):<3} {when} [{m.get('label', '')}] {len(files)} путь(ей): {shown}", flush=True)
+            lost = m.get("unrestorable", [])
+            if lost:
+                shown = ", ".join(lost[:6]) + (" …" if len(lost) > 6 else "")
+                print(f"{Colors.WARNING}        ⚠️  откат не вернёт {len(lost)} путь(ей): {shown}{Colors.ENDC}", flush=True)
+
+
+def is_unchanged(path: str, text: str) -> bool:
+    """Содержимое файла уже равно text: сначала дешёвое сравнение размера, затем хэш (sloth_tree)."""
+    data = text.encode("utf-8")
+    try:
+        if not os.path.isfile(path) or os.path.getsize(path) != len(data):
+            return False
+    except OSError:
+        return False
+    return sloth_tree.file_digest(path) == sloth_tree.digest_bytes(data)
+
+
+def write_files_atomically(root: str, contents: Dict[str, str], store: Optional[SnapshotStore] = None,
+                           iteration: int = 0) -> Optional[int]:
+    """
+    Записывает {rel_path: текст} группой (см. описание модуля). Возвращает id снимка.
+    Исключение на этапе подготовки оставляет дерево без изменений.
+    """
+    for rel_path in contents:
+        if os.path.isdir(os.path.join(root, rel_path)):
+            raise ValueError(f"Нельзя записать файл {rel_path}: по этому пути уже есть папка.")
+    staged = []
+    new_dirs = _new_dirs(root, contents)
+    try:
+        for rel_path, text in contents.items():
+            path = os.path.join(root, rel_path)
+            directory = os.path.dirname(path) or "."
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".sloth-tmp-", dir=directory)
+            staged.append((tmp_path, path, rel_path))
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            # Права доступа (например, исполняемый бит) сохраняем
+            _copy_mode(tmp_path, path)
+        snapshot_id = None
+        if store:
+            snapshot_id = store.capture(iteration, contents.keys())
+            snapshot_id = store.mark_created(snapshot_id, iteration, new_dirs, label="write")
+    except BaseException:
+        for tmp_path, _, _ in staged:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        # Папки, созданные при подготовке, — тоже: сначала самые глубокие
+        for directory in sorted(new_dirs, key=lambda d: d.count(os.sep), reverse=True):
+            try:
+                os.rmdir(os.path.join(root, directory))
+            except OSError:
+                pass
+        raise
+    replaced = []
+    try:
+        for tmp_path, path, rel_path in staged:
+            os.replace(tmp_path, path)
+            replaced.append(rel_path)
+    except BaseException:
+        for tmp_path, _, _ in staged:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        # Группа не должна остаться применённой наполовину: заменённые файлы — обратно из снимка
+        manifest = next((m for m in store.list() if m.get("id") == snapshot_id), None) if store and snapshot_id else None
+        if manifest is not None:
+            store.restore(manifest, {sloth_tree.normalize(p) for p in replaced + new_dirs})
+            store.discard(snapshot_id)
+        raise
+    for directory in {os.path.dirname(path) or "." for _, path, _ in staged}:
+        _fsync_dir(directory)
+    return snapshot_id
@@ -0,0 +1,142 @@
+# Файл: sloth_telemetry.py
+"""
+Телеметрия запросов к модели для Sloth.
+
+Каждый успешный запрос записывается с фазой, бэкендом и моделью, токенами
+(prompt / cached / thinking / output), временем до первого токена (ttft,
+только для потоковых ответов, api.stream) и полной латентностью.
+
+report() печатает по фазам перцентили (p50/p90/p99) латентности и ttft, суммы токенов
+и общую гистограмму латентности. Если задан telemetry.file, каждая запись
+дописывается туда строкой JSON (JSONL) для последующего анализа.
+
+PromptProfiler — состав промптов по секциям (rules, history, context, ...):
+оценка токенов каждой секции на каждой итерации и итог сессии — какие секции
+росли от итерации к итерации (обычно history и logs) и насколько.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from colors import Colors
+import config as sloth_config
+from sloth_health import percentile
+
+# Границы корзин гистограммы латентности, сек.
+LATENCY_BUCKETS = (2, 5, 10, 30, 60, 120, 300)
+TOKEN_KEYS = ("input_tokens", "cached_tokens", "thinking_tokens", "output_tokens")
+
+
+class UsageTelemetry:
+    def __init__(self, export_path: Optional[str] = None):
+        path = export_path or sloth_config.get("telemetry.file", None)
+        self.export_path = os.path.expanduser(path) if path else None
+        self.records: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def record(self, phase: Optional[str], backend: str, model: str, usage: Dict[str, Any],
+               latency: float, ttft: Optional[float] = None) -> None:
+        entry = {
+            "ts": time.time(), "phase": phase or "—", "backend": backend, "model": model,
+            "latency": round(float(latency), 3), "ttft": round(float(ttft), 3) if ttft is not None else None,
+        }
+        entry.update({k: int(usage.get(k, 0) or 0) for k in TOKEN_KEYS})
+        with self._lock:
+            self.records.append(entry)
+        if self.export_path:
+            try:
+                with open(self.export_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError:
+                # telemetry.file в несуществующей папке или на read-only диске: запись остаётся
+                # в self.records и попадёт в report() в конце сессии
+                pass
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(r) for r in self.records]
+
+    @staticmethod
+    def _histogram(values: List[float]) -> List[tuple]:
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        for v in values:
+            idx = next((i for i, b in enumerate(LATENCY_BUCKETS) if v < b), len(LATENCY_BUCKETS))
+            counts[idx] += 1
+        labels = [f"< {LATENCY_BUCKETS[0]} сек."]
+        labels += [f"{lo}–{hi} сек." for lo, hi in zip(LATENCY_BUCKETS, LATENCY_BUCKETS[1:])]
+        labels += [f"≥ {LATENCY_BUCKETS[-1]} сек."]
+        return list(zip(labels, counts))
+
+    def report(self) -> None:
+        records = self.snapshot()
+        if not records:
+            return
+        print(f"\n{Colors.BOLD}{Colors.HEADER}--- ТЕЛЕМЕТРИЯ ЗАПРОСОВ К МОДЕЛИ ---{Colors.ENDC}", flush=True)
+        phases: Dict[str, List[Dict[str, Any]]] = {}
+        for r in records:
+            phases.setdefault(r["phase"], []).append(r)
+        for phase, rows in phases.items():
+            lats = [r["latency"] for r in rows]
+            ttfts = [r["ttft"] for r in rows if r["ttft"] is not None]
+            sums = {k: sum(r[k] for r in rows) for k in TOKEN_KEYS}
+            ttft_str = (f"ttft p50 {percentile(ttfts, 50):.2f} / p90 {percentile(ttfts, 90):.2f} сек."
+                        if ttfts else "ttft —")
+            print(
+                f"  {phase:<14} | n={len(rows):<3} | латентность p50 {percentile(lats, 50):.2f} / "
+                f"p90 {percentile(lats, 90):.2f} / p99 {percentile(lats, 99):.2f} / max {max(lats):.2f} сек. | {ttft_str}",
+                flush=True,
+            )
+            print(
+                f"  {'':<14} | токены: вход {sums['input_tokens']} (кэш {sums['cached_tokens']}), "
+                f"размышления {sums['thinking_tokens']}, выход {sums['output_tokens']} | "
+                f"модели: {', '.join(sorted({r['model'] for r in rows}))} | бэкенды: {', '.join(sorted({r['backend'] for r in rows}))}",
+                flush=True,
+            )
+        hist = self._histogram([r["latency"] for r in records])
+        peak = max(c for _, c in hist) or 1
+        print(f"  Гистограмма латентности ({len(records)} запросов):", flush=True)
+        for label, count in hist:
+            bar = "█" * int(round(30 * count / peak)) if count else ""
+            print(f"    {label:>12} | {bar} {count if count else ''}", flush=True)
+
+
+class PromptProfiler:
+    def __init__(self):
+        self.rows: List[Dict[str, Any]] = []
+
+    def record(self, phase: Optional[str], iteration: int, breakdown: List[tuple]) -> str:
+        """Запоминает разбивку [(секция, символы, токены)] и возвращает строку для лога."""
+        sections = {name: int(tokens) for name, _chars, tokens in breakdown}
+        self.rows.append({"phase": phase or "—", "iteration": iteration, "sections": sections})
+        total = sum(sections.values()) or 1
+        parts = [f"{name} {tok} ({tok * 100 / total:.0f}%)"
+                 for name, tok in sorted(sections.items(), key=lambda kv: kv[1], reverse=True)]
+        return f"~{sum(sections.values())} т.: " + ", ".join(parts)
+
+    def report(self) -> None:
+        if len(self.rows) < 2:
+            return
+        names: List[str] = []
+        for row in self.rows:
+            names.extend(n for n in row["sections"] if n not in names)
+        print(f"\n{Colors.BOLD}{Colors.HEADER}--- СОСТАВ ПРОМПТОВ ПО СЕКЦИЯМ ({len(self.rows)} запросов) ---{Colors.ENDC}", flush=True)
+        first, last = self.rows[0]["sections"], self.rows[-1]["sections"]
+        growth = []
+        for name in names:
+            values = [row["sections"].get(name, 0) for row in self.rows]
+            present = [v for v in values if v]
+            # Рост — сумма приростов между соседними запросами, где секция есть в обоих
+            grew = sum(max(0, b - a) for a, b in zip(values, values[1:]) if a and b)
+            growth.append((grew, name))
+            print(
+                f"  {name:<14} | первый: {first.get(name, 0):<7} | последний: {last.get(name, 0):<7} | "
+                f"макс.: {max(values):<7} | среднее: {int(sum(present) / len(present)) if present else 0:<7} | "
+                f"рост: +{grew} т.",
+                flush=True,
+            )
+        growing = [f"{name} (+{grew} т.)" for grew, name in sorted(growth, reverse=True) if grew > 0]
+        if growing:
+            print(f"{Colors.WARNING}  Росли за сессию: {', '.join(growing)}{Colors.ENDC}", flush=True)
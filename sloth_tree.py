@@ -0,0 +1,227 @@
+# Файл: sloth_tree.py
+"""
+Снимок дерева проекта по метаданным файлов для Sloth.
+
+execute_commands раньше угадывал затронутые пути по словам из текста команды и хэшировал
+их до и после: файлы, созданные `npm install`, `prisma generate` или git, не замечались,
+а слова, не являющиеся путями, хэшировались впустую.
+
+take() обходит проект через os.scandir и запоминает для каждого пути только метаданные:
+  файл — (размер, mtime_ns, inode); папка — сам факт; симлинк — цель;
+  «непрозрачная» папка (runner.opaque_dirs: .git, node_modules, venv, сборки…) — отпечаток
+  из её mtime и метаданных прямых потомков, без обхода вглубь: изменение в ней видно
+  как изменение одного пути ("node_modules"), а обход остаётся миллисекундным.
+diff() сравнивает два снимка. Содержимое перехэшируется только у файлов, у которых
+изменились метаданные при том же размере, и только если есть хэш «до» (baseline()
+для упомянутых в командах файлов или память хэшей): `sed -i` без совпадений
+переписывает файл, но не меняет его — это не изменение. Без хэша «до» изменение
+метаданных считается изменением.
+
+Хэширование (file_digest / hash_files):
+  - xxh3_128 из необязательного пакета xxhash, иначе SHA-256 (аппаратно ускорен на
+    современных CPU); маленькие файлы читаются целиком, средние — буфером 1 МБ,
+    большие — через mmap;
+  - много файлов хэшируются пулом потоков (runner.hash_workers): чтение и хэш
+    отпускают GIL;
+  - память хэшей по (inode, mtime_ns, размер): неизменённый файл не
+    перечитывается. Файлы, изменённые меньше RACY_NS назад, не запоминаются —
+    правка в тот же тик часов не изменила бы mtime.
+"""
+
+import hashlib
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import config as sloth_config
+
+try:
+    import xxhash  # необязательная зависимость: pip install xxhash
+except ImportError:
+    xxhash = None
+
+OPAQUE_DIRS = set(sloth_config.get("runner.opaque_dirs", [
+    ".git", "node_modules", ".venv", "venv", "__pycache__", ".pytest_cache", ".mypy_cache",
+    ".next", "dist", "build", "coverage", ".idea", ".vscode",
+]))
+HASH_WORKERS = max(1, int(sloth_config.get("runner.hash_workers", min(8, os.cpu_count() or 2))))
+DIGEST_NAME = "xxh3_128" if xxhash else "sha256"
+_READ_BUFFER = 1 << 20
+_MMAP_THRESHOLD = 8 << 20
+RACY_NS = 100_000_000
+
+# (st_ino, st_mtime_ns, st_size) → хэш содержимого
+_MEMO: Dict[Tuple[int, int, int], str] = {}
+_memo_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _new_digest():
+    return xxhash.xxh3_128() if xxhash else hashlib.sha256()
+
+
+def digest_bytes(data: bytes) -> str:
+    """Хэш данных тем же алгоритмом, что и file_digest()."""
+    h = _new_digest()
+    h.update(data)
+    return h.hexdigest()
+
+
+def _digest_file(f, size: int, h) -> str:
+    if size >= _MMAP_THRESHOLD:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            h.update(mapped)
+    elif size <= _READ_BUFFER:
+        h.update(f.read())
+    else:
+        buf = bytearray(_READ_BUFFER)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def _memo_key(st) -> Tuple[int, int, int]:
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def file_digest(path: str) -> Optional[str]:
+    """Хэш содержимого файла с памятью по метаданным. None — файла нет или это не файл."""
+    try:
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            key = _memo_key(st)
+            with _memo_lock:
+                cached = _MEMO.get(key)
+            if cached is not None:
+                return cached
+            digest = _digest_file(f, st.st_size, _new_digest())
+    except (OSError, ValueError):
+        return None
+    if time.time_ns() - st.st_mtime_ns > RACY_NS:
+        with _memo_lock:
+            _MEMO[key] = digest
+    return digest
+
+
+def _memo_lookup(key: Tuple[int, int, int]) -> Optional[str]:
+    with _memo_lock:
+        return _MEMO.get(key)
+
+
+def hash_files(paths: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Хэши многих файлов: пулом потоков, если файлов больше одного."""
+    global _executor
+    paths = list(dict.fromkeys(paths))
+    if len(paths) <= 1 or HASH_WORKERS == 1:
+        return {p: file_digest(p) for p in paths}
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="sloth-hash")
+    return dict(zip(paths, _executor.map(file_digest, paths)))
+
+
+def _fingerprint(path: str) -> Tuple:
+    """Отпечаток непрозрачной папки: её mtime, число прямых потомков и их самый свежий mtime."""
+    st = os.stat(path)
+    count, latest = 0, st.st_mtime_ns
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                count += 1
+                try:
+                    latest = max(latest, entry.stat(follow_symlinks=False).st_mtime_ns)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return (st.st_mtime_ns, count, latest)
+
+
+def take(root: str = ".") -> Dict[str, Tuple]:
+    """Снимок дерева: {относительный путь через '/': метаданные}."""
+    entries: Dict[str, Tuple] = {}
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, rel_dir) if rel_dir else root)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                try:
+                    if entry.is_symlink():
+                        entries[rel] = ("l", os.readlink(entry.path))
+                    elif entry.is_dir():
+                        if entry.name in OPAQUE_DIRS:
+                            entries[rel] = ("o",) + _fingerprint(entry.path)
+                        else:
+                            entries[rel] = ("d",)
+                            stack.append(rel)
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        entries[rel] = ("f", st.st_size, st.st_mtime_ns, st.st_ino)
+                except OSError:
+                    continue
+    return entries
+
+
+def normalize(path: str) -> str:
+    return os.path.normpath(path).replace(os.sep, "/")
+
+
+def baseline(root: str, snapshot: Dict[str, Tuple], rel_paths: Iterable[str]) -> Dict[str, Tuple[Tuple, str]]:
+    """Хэши «до» для указанных файлов (тех, что упомянуты в командах): {путь: (метаданные, хэш)}."""
+    rels = [rel for rel in {normalize(p) for p in rel_paths} if snapshot.get(rel, ("",))[0] == "f"]
+    digests = hash_files(os.path.join(root, rel) for rel in rels)
+    return {rel: (snapshot[rel], digests[os.path.join(root, rel)]) for rel in rels
+            if digests.get(os.path.join(root, rel))}
+
+
+def diff(root: str, before: Dict[str, Tuple], after: Dict[str, Tuple],
+         before_digests: Optional[Dict[str, Tuple[Tuple, str]]] = None) -> Tuple[Set[str], Set[str], Set[str]]:
+    """
+    Сравнивает снимки. Возвращает (изменённые, созданные, удалённые) пути.
+    Файлы из before_digests сверяются по содержимому даже при равных метаданных.
+    """
+    before_digests = before_digests or {}
+    modified, created = set(), set()
+    to_compare: Dict[str, str] = {}
+    for rel, meta in after.items():
+        old = before.get(rel)
+        if old is None:
+            created.add(rel)
+        elif old[0] == meta[0] == "d":
+            continue
+        elif old == meta and rel not in before_digests:
+            continue
+        elif old[0] == meta[0] == "f" and old[1] == meta[1]:
+            known = before_digests.get(rel)
+            digest = known[1] if known and known[0] == old else None
+            if digest is None and old != meta:
+                # Хэш прежней версии файла мог остаться в памяти с прошлых сравнений
+                digest = _memo_lookup((old[3], old[2], old[1]))
+            if digest is None:
+                modified.add(rel)
+            else:
+                to_compare[rel] = digest
+        else:
+            modified.add(rel)
+    if to_compare:
+        current = hash_files(os.path.join(root, rel) for rel in to_compare)
+        modified |= {rel for rel, digest in to_compare.items() if current.get(os.path.join(root, rel)) != digest}
+    deleted = set(before) - set(after)
+    return modified, created, deleted
+
+
+def collapse(paths: Iterable[str]) -> Set[str]:
+    """Для отчёта: из созданных/удалённых папок оставляет саму папку, без её содержимого."""
+    paths = set(paths)
+    return {p for p in paths if p.rsplit("/", 1)[0] not in paths or "/" not in p}